@@ -0,0 +1,74 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+"""
+Micro-benchmark of the revision to DynamoDB item conversion in lambda_stream_transactions.
+Compares the former JSON round trip and strptime/strftime timestamp path with ddb_item_converter.
+
+Usage (from the src/ directory, with the stream Lambda requirements installed):
+   python benchmarks/bench_item_converter.py [--iterations 20000]
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+import timeit
+from decimal import Decimal
+import amazon.ion.simpleion as ion
+from amazon.ion.json_encoder import IonToJSONEncoder
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lambda',
+                                'lambda_stream_transactions'))
+
+from ddb_item_converter import revision_to_ddb_item  # noqa: E402
+
+SAMPLE_REVISION = ion.loads(
+    '{data: {accountId: "account-000123", balance: 1520.75}, '
+    'metadata: {id: "8Wq2Fdn2XKz1f5fKQCw2ul", version: 42, txTime: 2021-03-18T17:06:42.123Z, '
+    'txId: "Jyr5nZ8Nq1dFSbGEjxLO0L"}}')
+
+
+def legacy_revision_to_ddb_item(revision_data, revision_metadata):
+    ddb_item = json.loads(json.dumps(revision_data, cls=IonToJSONEncoder), parse_float=Decimal)
+    string_datetime = ion.dumps(revision_metadata['txTime'], binary=False).split()[1]
+    parsed_datetime = time.strptime(string_datetime, "%Y-%m-%dT%H:%M:%S.%fZ")
+    unix_time = int(time.strftime('%s', parsed_datetime))
+    ddb_item['txTime'] = string_datetime
+    ddb_item['txId'] = revision_metadata['txId']
+    ddb_item['timestamp'] = unix_time
+    return ddb_item
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--iterations', type=int, default=20000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    data = SAMPLE_REVISION['data']
+    metadata = SAMPLE_REVISION['metadata']
+
+    legacy = legacy_revision_to_ddb_item(data, metadata)
+    direct = revision_to_ddb_item(data, metadata)
+    if legacy['txTime'] != direct['txTime']:
+        print(f"txTime mismatch: legacy {legacy['txTime']} != direct {direct['txTime']}")
+    if legacy['timestamp'] != direct['timestamp']:
+        # The legacy path interprets the UTC time in the local timezone
+        print(f"timestamp differs: legacy {legacy['timestamp']} != direct {direct['timestamp']} "
+              f"(TZ={os.getenv('TZ', 'unset')})")
+
+    results = {}
+    for name, function in (('legacy', legacy_revision_to_ddb_item), ('direct', revision_to_ddb_item)):
+        timings = timeit.repeat(lambda: function(data, metadata), number=args.iterations, repeat=args.repeat)
+        best = min(timings)
+        results[name] = best
+        print(f"{name:>7}: {best / args.iterations * 1e6:8.2f} us/item  "
+              f"{args.iterations / best:12.0f} items/s")
+
+    print(f"speedup: {results['legacy'] / results['direct']:.2f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,325 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+"""
+Offline throughput benchmark of lambda_stream_transactions, the QLDB stream to DynamoDB projection.
+Synthetic QLDB REVISION_DETAILS and BLOCK_SUMMARY Ion records are wrapped in Kinesis events, aggregated or not,
+and lambda_handler writes them to in-memory stand-ins of the transactions and balances tables.
+
+For every batch size and table mix it reports:
+   - records per second of lambda_handler, end to end
+   - time per stage (deaggregate, base64, filter, Ion decode, convert, write), measured on the same events
+     by running the handler's steps one after the other
+   - memory high-water mark of one handler call (tracemalloc peak) and the process maximum RSS
+
+Usage (from the src/ directory, with the stream Lambda requirements installed):
+   python benchmarks/bench_stream_pipeline.py [--batch-sizes 100,500,1000] [--mixes wallet-only,mixed,summaries]
+                                              [--aggregation both|aggregated|unaggregated] [--repeat 5]
+                                              [--put-latency-ms 5] [--write-concurrency 8]
+"""
+
+import argparse
+import base64
+import logging
+import os
+import random
+import resource
+import sys
+import time
+import tracemalloc
+import amazon.ion.simpleion as ion
+from aws_kinesis_agg.aggregator import RecordAggregator
+
+QLDB_TABLE_NAME = 'Wallet'
+OTHER_TABLE_NAME = 'Audit'
+STREAM_ARN = 'arn:aws:qldb:us-east-1:123456789012:stream/wallet/bench'
+EVENT_SOURCE_ARN = 'arn:aws:kinesis:us-east-1:123456789012:stream/kinesis-stream-wallet'
+
+# Share of REVISION_DETAILS records for the wallet table, for another table, and of BLOCK_SUMMARY records
+TABLE_MIXES = {
+    'wallet-only': (1.0, 0.0, 0.0),
+    'mixed': (0.6, 0.2, 0.2),
+    'summaries': (0.3, 0.1, 0.6)
+}
+
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+os.environ.setdefault('LOG_LEVEL', 'WARNING')
+os.environ['QLDB_TABLE_NAME'] = QLDB_TABLE_NAME
+os.environ['DDB_TABLE_NAME'] = 'bench-transactions'
+os.environ['BALANCES_TABLE_NAME'] = 'bench-balances'
+os.environ.pop('DLQ_URL', None)
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lambda',
+                                'lambda_stream_transactions'))
+
+import lambda_function  # noqa: E402
+from aws_kinesis_agg.deaggregator import deaggregate_records  # noqa: E402
+from ddb_batch_writer import BatchWriter  # noqa: E402
+from ddb_item_converter import balance_view_item, revision_to_ddb_item  # noqa: E402
+from ddb_versioned_writer import RecentRevisions, VersionedWriter  # noqa: E402
+from ion_header_reader import read_record_header  # noqa: E402
+from local_dynamodb import LocalDynamoDB, LocalTable  # noqa: E402
+
+STAGES = ('deaggregate', 'base64', 'filter', 'ion_decode', 'convert', 'write')
+
+
+def revision_record(table_name, account_id, version, tx_time):
+    return ion.loads(
+        f'{{qldbStreamArn: "{STREAM_ARN}", recordType: "REVISION_DETAILS", '
+        f'payload: {{tableInfo: {{tableName: "{table_name}", tableId: "7Pk0JdlQtZ06zBAvZpV0pK"}}, '
+        f'revision: {{blockAddress: {{strandId: "Jyr5nZ8Nq1dFSbGEjxLO0L", sequenceNo: {version * 3}}}, '
+        f'hash: {{{{h0yuCPHpKHV+1D0hgMyyORFC2PMD1ij6iWRTOTPHMvQ=}}}}, '
+        f'data: {{accountId: "{account_id}", balance: {version * 10}.25}}, '
+        f'metadata: {{id: "doc-{account_id}", version: {version}, txTime: {tx_time}, '
+        f'txId: "tx-{account_id}-{version}"}}}}}}}}')
+
+
+def block_summary_record(sequence_no, tx_time):
+    statements = ', '.join(f'{{statement: "UPDATE Wallet SET balance = ? WHERE accountId = ?", '
+                           f'startTime: {tx_time}, statementDigest: {{{{U2FtcGxlIGRpZ2VzdA==}}}}}}'
+                           for _ in range(3))
+    return ion.loads(
+        f'{{qldbStreamArn: "{STREAM_ARN}", recordType: "BLOCK_SUMMARY", '
+        f'payload: {{blockAddress: {{strandId: "Jyr5nZ8Nq1dFSbGEjxLO0L", sequenceNo: {sequence_no}}}, '
+        f'transactionId: "tx-{sequence_no}", blockTimestamp: {tx_time}, '
+        f'blockHash: {{{{h0yuCPHpKHV+1D0hgMyyORFC2PMD1ij6iWRTOTPHMvQ=}}}}, '
+        f'entriesHash: {{{{h0yuCPHpKHV+1D0hgMyyORFC2PMD1ij6iWRTOTPHMvQ=}}}}, '
+        f'transactionInfo: {{statements: [{statements}]}}, '
+        f'revisionSummaries: [{{hash: {{{{h0yuCPHpKHV+1D0hgMyyORFC2PMD1ij6iWRTOTPHMvQ=}}}}, '
+        f'documentId: "doc-{sequence_no}"}}]}}}}')
+
+
+def ion_timestamp(epoch_millis):
+    seconds, millis = divmod(epoch_millis, 1000)
+    return time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(seconds)) + f".{millis:03d}Z"
+
+
+def generate_payloads(count, mix, accounts, seed):
+    """
+    Returns (partition_key, Ion binary payload) tuples in the proportions of the table mix.
+    Wallet revisions cycle over the accounts with increasing versions, as QLDB would publish them.
+    """
+
+    rng = random.Random(seed)
+    wallet_share, other_share, _ = mix
+    versions = {}
+    epoch_millis = 1616087202123
+    payloads = []
+
+    for sequence_no in range(count):
+        epoch_millis += rng.randint(1, 50)
+        tx_time = ion_timestamp(epoch_millis)
+        draw = rng.random()
+        account_id = f"account-{rng.randrange(accounts):06d}"
+        if draw < wallet_share + other_share:
+            table_name = QLDB_TABLE_NAME if draw < wallet_share else OTHER_TABLE_NAME
+            versions[account_id] = versions.get(account_id, -1) + 1
+            record = revision_record(table_name, account_id, versions[account_id], tx_time)
+        else:
+            record = block_summary_record(sequence_no, tx_time)
+        payloads.append((account_id, ion.dumps(record, binary=True)))
+
+    return payloads
+
+
+def kinesis_record(sequence_number, partition_key, data):
+    return {
+        'kinesis': {
+            'kinesisSchemaVersion': '1.0',
+            'partitionKey': partition_key,
+            'sequenceNumber': str(sequence_number),
+            'data': base64.b64encode(data).decode('ascii'),
+            'approximateArrivalTimestamp': 1616087202.123
+        },
+        'eventSource': 'aws:kinesis',
+        'eventVersion': '1.0',
+        'eventName': 'aws:kinesis:record',
+        'eventSourceARN': EVENT_SOURCE_ARN
+    }
+
+
+def build_event(payloads, aggregated):
+    """
+    Wraps payloads in a Kinesis event, one Kinesis record per payload or KPL-aggregated records
+    """
+
+    sequence_number = 49590338271490256608559692538361571095921575989136588898
+    records = []
+    if not aggregated:
+        for partition_key, data in payloads:
+            sequence_number += 1
+            records.append(kinesis_record(sequence_number, partition_key, data))
+        return {'Records': records}
+
+    aggregator = RecordAggregator()
+    aggregated_records = []
+    for partition_key, data in payloads:
+        aggregated_record = aggregator.add_user_record(partition_key, data)
+        if aggregated_record:
+            aggregated_records.append(aggregated_record)
+    if aggregator.get_num_user_records():
+        aggregated_records.append(aggregator.clear_and_get())
+
+    for aggregated_record in aggregated_records:
+        partition_key, _, data = aggregated_record.get_contents()
+        sequence_number += 1
+        records.append(kinesis_record(sequence_number, partition_key, data))
+    return {'Records': records}
+
+
+def reset_projection(put_latency=0.0):
+    """
+    Points the handler at empty local tables and empty revision caches, so every run writes every revision
+    """
+
+    lambda_function.dynamodb = LocalDynamoDB([LocalTable(os.environ['DDB_TABLE_NAME'], ('accountId', 'txTime'))],
+                                             put_latency)
+    lambda_function.balances_table = LocalTable(os.environ['BALANCES_TABLE_NAME'], ('accountId',), put_latency)
+    lambda_function.recent_revisions = RecentRevisions(lambda_function.RECENT_REVISIONS_CACHE_SIZE)
+    lambda_function.recent_balance_revisions = RecentRevisions(lambda_function.RECENT_REVISIONS_CACHE_SIZE)
+
+
+def run_handler(event, put_latency):
+    reset_projection(put_latency)
+    started = time.perf_counter()
+    response = lambda_function.lambda_handler(event, None)
+    elapsed = time.perf_counter() - started
+    if response['batchItemFailures']:
+        raise RuntimeError(f"Unexpected batch item failures: {response['batchItemFailures']}")
+    return elapsed
+
+
+def run_stages(event, put_latency):
+    """
+    Runs the handler's steps one after the other over the whole batch and times each of them
+    Returns:
+       (timings, user_records): seconds per stage and the number of deaggregated records
+    """
+
+    reset_projection(put_latency)
+    timings = dict.fromkeys(STAGES, 0.0)
+
+    started = time.perf_counter()
+    records = deaggregate_records(event['Records'])
+    timings['deaggregate'] = time.perf_counter() - started
+
+    started = time.perf_counter()
+    payloads = [base64.b64decode(record['kinesis']['data']) for record in records]
+    timings['base64'] = time.perf_counter() - started
+
+    started = time.perf_counter()
+    selected = []
+    for payload in payloads:
+        record_type, table_name = read_record_header(
+            payload, stop_unless_record_type=lambda_function.REVISION_DETAILS_RECORD_TYPE)
+        if record_type == lambda_function.REVISION_DETAILS_RECORD_TYPE and table_name == QLDB_TABLE_NAME:
+            selected.append(payload)
+    timings['filter'] = time.perf_counter() - started
+
+    started = time.perf_counter()
+    revisions = [lambda_function.get_data_metdata_from_revision_record(ion.loads(payload)) for payload in selected]
+    timings['ion_decode'] = time.perf_counter() - started
+
+    started = time.perf_counter()
+    items = [revision_to_ddb_item(data, metadata) for data, metadata in revisions if data]
+    balance_items = [balance_view_item(item) for item in items]
+    timings['convert'] = time.perf_counter() - started
+
+    started = time.perf_counter()
+    writer = BatchWriter(lambda_function.dynamodb, lambda_function.DDB_TABLE_NAME,
+                         key_attributes=('accountId', 'txTime'), recent_revisions=lambda_function.recent_revisions,
+                         max_workers=lambda_function.WRITE_CONCURRENCY)
+    balance_writer = VersionedWriter(lambda_function.balances_table, key_attributes=('accountId',),
+                                     recent_revisions=lambda_function.recent_balance_revisions,
+                                     max_workers=lambda_function.WRITE_CONCURRENCY)
+    for position, (item, balance_item) in enumerate(zip(items, balance_items)):
+        writer.add(item, position)
+        balance_writer.add(balance_item, position)
+    writer.flush()
+    balance_writer.flush()
+    timings['write'] = time.perf_counter() - started
+
+    return timings, len(records)
+
+
+def peak_memory(event):
+    reset_projection()
+    tracemalloc.start()
+    try:
+        lambda_function.lambda_handler(event, None)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return peak
+
+
+def max_rss_mb():
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return max_rss / (1024 * 1024) if sys.platform == 'darwin' else max_rss / 1024
+
+
+def benchmark(batch_size, mix_name, aggregated, args):
+    payloads = generate_payloads(batch_size, TABLE_MIXES[mix_name], args.accounts, args.seed)
+    event = build_event(payloads, aggregated)
+
+    put_latency = args.put_latency_ms / 1000
+    best = min(run_handler(event, put_latency) for _ in range(args.repeat))
+    stage_runs = [run_stages(event, put_latency) for _ in range(args.repeat)]
+    user_records = stage_runs[0][1]
+    stages = {stage: min(timings[stage] for timings, _ in stage_runs) for stage in STAGES}
+
+    return {
+        'batch_size': batch_size,
+        'mix': mix_name,
+        'aggregation': 'aggregated' if aggregated else 'unaggregated',
+        'kinesis_records': len(event['Records']),
+        'records_per_second': user_records / best,
+        'handler_ms': best * 1000,
+        'stages_ms': {stage: seconds * 1000 for stage, seconds in stages.items()},
+        'peak_kb': peak_memory(event) / 1024
+    }
+
+
+def print_result(result):
+    stages = '  '.join(f"{stage} {ms:7.2f}" for stage, ms in result['stages_ms'].items())
+    print(f"{result['batch_size']:>6} {result['mix']:>12} {result['aggregation']:>13} "
+          f"{result['kinesis_records']:>8} {result['records_per_second']:>12.0f} {result['handler_ms']:>10.2f} "
+          f"{result['peak_kb']:>9.0f}   {stages}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--batch-sizes', default='100,500,1000',
+                        help='Comma separated numbers of QLDB records per invocation')
+    parser.add_argument('--mixes', default=','.join(TABLE_MIXES),
+                        help=f"Comma separated table mixes among {', '.join(TABLE_MIXES)}")
+    parser.add_argument('--aggregation', choices=('both', 'aggregated', 'unaggregated'), default='both')
+    parser.add_argument('--accounts', type=int, default=1000, help='Number of distinct accounts')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--put-latency-ms', type=float, default=0.0,
+                        help='Simulated round trip of every DynamoDB write, e.g. 5 to see the effect of concurrency')
+    parser.add_argument('--write-concurrency', type=int, default=None,
+                        help='Overrides WRITE_CONCURRENCY, the number of accounts written concurrently')
+    args = parser.parse_args()
+
+    if args.write_concurrency:
+        lambda_function.WRITE_CONCURRENCY = args.write_concurrency
+
+    logging.getLogger().setLevel(logging.WARNING)
+    modes = {'both': (False, True), 'aggregated': (True,), 'unaggregated': (False,)}[args.aggregation]
+
+    print(f"{'batch':>6} {'mix':>12} {'aggregation':>13} {'kinesis':>8} {'records/s':>12} {'handler ms':>10} "
+          f"{'peak KB':>9}   stage ms")
+    for batch_size in (int(size) for size in args.batch_sizes.split(',')):
+        for mix_name in args.mixes.split(','):
+            for aggregated in modes:
+                print_result(benchmark(batch_size, mix_name, aggregated, args))
+
+    print(f"max RSS: {max_rss_mb():.1f} MB")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,73 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+"""
+In-memory stand-ins for the boto3 DynamoDB service and Table resources, used by the benchmarks.
+Only the calls made by the stream consumer are supported: batch_write_item of ddb_batch_writer, and put_item with
+the version condition of ddb_versioned_writer.
+"""
+
+import time
+from botocore.exceptions import ClientError
+
+
+class LocalTable:
+    """
+    Parameters:
+       name (string): Table name
+       key_attributes (tuple): Partition and sort key attribute names
+       put_latency (float): Seconds slept on every write, to approximate the round trip to DynamoDB
+    """
+
+    def __init__(self, name, key_attributes, put_latency=0.0):
+        self.name = name
+        self.key_attributes = key_attributes
+        self.put_latency = put_latency
+        self.items = {}
+        self.calls = {'put_item': 0}
+
+    def item_key(self, item):
+        return tuple(item[attribute] for attribute in self.key_attributes)
+
+    def put_item(self, Item, ConditionExpression=None, ExpressionAttributeNames=None, ExpressionAttributeValues=None):
+        self.calls['put_item'] += 1
+        if self.put_latency:
+            time.sleep(self.put_latency)
+
+        key = self.item_key(Item)
+        if ConditionExpression:
+            # The only condition used is: attribute_not_exists(#version) OR #version < :version
+            attribute = ExpressionAttributeNames['#version']
+            stored = self.items.get(key)
+            if stored is not None and attribute in stored and \
+                    not stored[attribute] < ExpressionAttributeValues[':version']:
+                raise ClientError({'Error': {'Code': 'ConditionalCheckFailedException',
+                                             'Message': 'The conditional request failed'}}, 'PutItem')
+
+        self.items[key] = dict(Item)
+        return {}
+
+
+class LocalDynamoDB:
+    """
+    Parameters:
+       tables (list): LocalTable instances, written by batch_write_item
+       put_latency (float): Seconds slept on every call, to approximate the round trip to DynamoDB
+    """
+
+    def __init__(self, tables, put_latency=0.0):
+        self.tables = {table.name: table for table in tables}
+        self.put_latency = put_latency
+        self.calls = {'batch_write_item': 0}
+
+    def batch_write_item(self, RequestItems):
+        self.calls['batch_write_item'] += 1
+        if self.put_latency:
+            time.sleep(self.put_latency)
+
+        for table_name, requests in RequestItems.items():
+            table = self.tables[table_name]
+            for request in requests:
+                item = request['PutRequest']['Item']
+                table.items[table.item_key(item)] = dict(item)
+        return {'UnprocessedItems': {}}
@@ -0,0 +1,27 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import os
+import logging
+import time
+from wallet_core import clients
+from wallet_core.archive import archive_from_environment, archive_history
+
+
+logger = logging.getLogger()
+logger.setLevel(os.getenv('LOG_LEVEL'))
+TABLE_NAME = os.getenv('DDB_TABLE_NAME')
+EXPIRE_AFTER_DAYS = int(os.getenv('EXPIRE_AFTER_DAYS'))
+# Items are archived this many days before their TTL expiry
+ARCHIVE_LEAD_DAYS = int(os.getenv('ARCHIVE_LEAD_DAYS', 2))
+
+
+def archive_cutoff(now, expire_after_days=EXPIRE_AFTER_DAYS, lead_days=ARCHIVE_LEAD_DAYS):
+    # Midnight UTC, so runs on the same day archive up to the same txTime
+    return time.strftime('%Y-%m-%dT00:00:00Z', time.gmtime(now - (expire_after_days - lead_days) * 86400))
+
+
+def lambda_handler(event, context):
+    until = archive_cutoff(time.time())
+    logger.info(f"Archiving history until {until}")
+    return archive_history(clients.table(TABLE_NAME), archive_from_environment(), until, dynamodb=clients.dynamodb())
@@ -0,0 +1,84 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import os
+import logging
+from wallet_core import clients
+from wallet_core.accounts import AccountRepository
+from wallet_core.errors import BadRequest, WalletError
+from wallet_core.mutations import (
+    MAX_DOCUMENTS_PER_TRANSACTION,
+    MutationsRejected,
+    apply_mutations,
+    chunk_by_accounts,
+    distinct_accounts,
+    validate_mutations
+)
+from wallet_core.responses import handle_api_request
+
+
+logger = logging.getLogger()
+logger.setLevel(os.getenv('LOG_LEVEL'))
+
+QLDB_TABLE_NAME = os.getenv('QLDB_TABLE_NAME')
+MAX_BULK_ITEMS = int(os.getenv('MAX_BULK_ITEMS', 1000))
+
+# All items succeed or none is applied
+ATOMIC_MODE = 'atomic'
+# Items are applied in transactions of up to MAX_DOCUMENTS_PER_TRANSACTION accounts, each succeeding or failing as a whole
+CHUNKED_MODE = 'chunked'
+# Statuses of the items of a chunk whose transaction failed, and of the chunks after it, which are not attempted
+FAILED = 'failed'
+NOT_ATTEMPTED = 'not_attempted'
+
+
+def apply_in_transaction(mutations):
+    return clients.qldb_driver().execute_lambda(
+        lambda executor: apply_mutations(AccountRepository(executor, QLDB_TABLE_NAME), mutations))
+
+
+def unapplied_results(mutations, status, message):
+    return [dict(mutation, status=status, message=message) for mutation in mutations]
+
+
+def process_request(body):
+    mutations = validate_mutations(body.get('items'), MAX_BULK_ITEMS)
+    mode = body.get('mode', ATOMIC_MODE)
+
+    if mode == ATOMIC_MODE:
+        if len(distinct_accounts(mutations)) > MAX_DOCUMENTS_PER_TRANSACTION:
+            raise BadRequest(f"Atomic mode supports at most {MAX_DOCUMENTS_PER_TRANSACTION} distinct accounts, "
+                             f"use {CHUNKED_MODE} mode for larger batches")
+        results = apply_in_transaction(mutations)
+        return {'mode': mode, 'applied': len(results), 'rejected': 0, 'results': results}
+
+    if mode != CHUNKED_MODE:
+        raise BadRequest(f"mode must be {ATOMIC_MODE} or {CHUNKED_MODE}")
+
+    chunks = list(chunk_by_accounts(mutations))
+    results = []
+    applied = 0
+    for position, chunk in enumerate(chunks):
+        try:
+            results.extend(apply_in_transaction(chunk))
+            applied += len(chunk)
+        except MutationsRejected as e:
+            logger.error(e.message)
+            results.extend(e.results)
+        except Exception as e:
+            # The earlier chunks are committed: their results are returned, so a retry only resends the items
+            # that were not applied
+            message = e.message if isinstance(e, WalletError) else 'Transaction failed, the items were not applied'
+            logger.error(f"Error applying chunk {position + 1} of {len(chunks)}: {e}")
+            results.extend(unapplied_results(chunk, FAILED, message))
+            for remaining in chunks[position + 1:]:
+                results.extend(unapplied_results(remaining, NOT_ATTEMPTED, 'Not attempted after a failed chunk'))
+            break
+
+    failed = sum(1 for result in results if result['status'] in (FAILED, NOT_ATTEMPTED))
+    return {'mode': mode, 'applied': applied, 'rejected': len(results) - applied - failed, 'failed': failed,
+            'results': results}
+
+
+def lambda_handler(event, context):
+    return handle_api_request(event, process_request, context, handler_name='bulkMutations')
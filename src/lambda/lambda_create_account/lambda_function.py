@@ -1,92 +1,99 @@
 # Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
 # SPDX-License-Identifier: MIT-0
 
-from pyqldb.driver.qldb_driver import QldbDriver
-from pyqldb.config.retry_config import RetryConfig
 import os
 import logging
-import json
-from aws_xray_sdk.core import xray_recorder
-from aws_xray_sdk.core import patch_all
+from wallet_core import clients
+from wallet_core.accounts import MAX_BUCKETS, AccountRepository, validate_account_id
+from wallet_core.errors import BadRequest, WalletError
+from wallet_core.qldb import chunk_documents
+from wallet_core.responses import handle_api_request
 
 
 logger = logging.getLogger()
 logger.setLevel(os.getenv('LOG_LEVEL'))
 
-LEDGER_NAME = os.getenv('LEDGER_NAME')
 QLDB_TABLE_NAME = os.getenv('QLDB_TABLE_NAME')
-retry_config = RetryConfig(retry_limit=3)
+MAX_BULK_ACCOUNTS = int(os.getenv('MAX_BULK_ACCOUNTS', 2000))
 
-# Initialize the driver
-qldb_driver = QldbDriver(ledger_name=LEDGER_NAME, retry_config=retry_config)
 
-return_object = {}
+def create_account(account_id, executor, buckets=1):
+    AccountRepository(executor, QLDB_TABLE_NAME).create(account_id, buckets=buckets)
 
+    return_message = {'accountId': account_id}
+    if buckets > 1:
+        return_message['buckets'] = buckets
+    return return_message
 
-def return_error(message, http_status_code=500):
-    global return_object
-    return_message = {'status': 'error', 'message': message}
-    return_object = {
-        "statusCode": http_status_code,
-        "body": json.dumps(return_message),
-        "isBase64Encoded": False
-    }
-    logger.error(return_message)
 
-    return return_object
+def shard_account(account_id, buckets, executor):
+    return AccountRepository(executor, QLDB_TABLE_NAME).enable_sharding(account_id, buckets)
 
 
-def create_account(account_id, executor):
-    global return_object
+def create_accounts(account_ids):
+    """
+    Creates the missing accounts among account_ids. Each chunk, sized to the QLDB transaction limits,
+    costs one existence read and one INSERT in its own transaction.
+    When a transaction fails, the ids of its chunk and of the following chunks, which are not attempted,
+    are returned as failed next to those of the chunks already committed.
+    """
+
+    created = []
+    existing = []
+    failed = []
     return_message = {}
+    new_docs = ({'accountId': account_id, 'balance': 0} for account_id in account_ids)
 
-    logger.info(f"Verifying account with id {account_id} does not exist")
-    cursor = executor.execute_statement(f"SELECT * FROM \"{QLDB_TABLE_NAME}\" WHERE accountId = ? ", account_id)
-    first_record = next(cursor, None)
+    for chunk in chunk_documents(new_docs):
+        chunk_ids = [doc['accountId'] for doc in chunk]
+        if failed:
+            failed.extend(chunk_ids)
+            continue
+        try:
+            chunk_created, chunk_existing = clients.qldb_driver().execute_lambda(
+                lambda executor: AccountRepository(executor, QLDB_TABLE_NAME).create_many(chunk_ids))
+        except Exception as e:
+            logger.error(f"Error creating {len(chunk_ids)} accounts: {e}")
+            return_message['message'] = e.message if isinstance(e, WalletError) else \
+                'Transaction failed, the failed accounts were not created'
+            failed.extend(chunk_ids)
+            continue
+        created.extend(chunk_created)
+        existing.extend(chunk_existing)
 
-    if first_record:
-        return_error(f"Account with user id {account_id} already exists", http_status_code=400)
-        return return_object
-    else:
-        doc = {
-            'accountId': account_id,
-            'balance': 0
-        }
-        logger.info(f"Creating account with id {account_id} and balance = {doc['balance']}")
-        executor.execute_statement(f"INSERT INTO \"{QLDB_TABLE_NAME}\" ?", doc)
+    logger.info(f"Created {len(created)} accounts, {len(existing)} already existed, {len(failed)} failed")
+    return dict(return_message, created=created, existing=existing, failed=failed)
 
-    http_status_code = 200
-    return_message['status'] = 'Ok'
-    return_message['accountId'] = account_id
 
-    return_object = {
-        "statusCode": http_status_code,
-        "body": json.dumps(return_message),
-        "isBase64Encoded": False
-    }
+def process_request(body):
+    if 'accountIds' in body:
+        account_ids = body['accountIds']
+        if not isinstance(account_ids, list) or not account_ids or \
+                not all(isinstance(account_id, str) and account_id for account_id in account_ids):
+            raise BadRequest('accountIds must be a non-empty list of account ids')
+        if len(account_ids) > MAX_BULK_ACCOUNTS:
+            raise BadRequest(f"At most {MAX_BULK_ACCOUNTS} accounts can be created in one request")
+        for account_id in account_ids:
+            validate_account_id(account_id)
 
+        # Ids repeated in the request are created once
+        return create_accounts(list(dict.fromkeys(account_ids)))
 
-def lambda_handler(event, context):
-    logger.debug(f"Event received: {json.dumps(event)}")
+    account_id = body.get('accountId')
+    if not account_id or not isinstance(account_id, str):
+        raise BadRequest('accountId not specified')
+    validate_account_id(account_id)
 
-    global return_object
-    return_object = {}
-    body = {}
+    # Hot accounts can opt in to sharding their balance across buckets
+    buckets = body.get('buckets', 1)
+    if isinstance(buckets, bool) or not isinstance(buckets, int) or not 0 < buckets <= MAX_BUCKETS:
+        raise BadRequest(f"buckets must be an integer between 1 and {MAX_BUCKETS}")
 
-    try:
-        body = json.loads(event['body'])
-    except Exception as e:
-        return_error(str(e), http_status_code=400)
-        return return_object
+    if body.get('shardExisting'):
+        return clients.qldb_driver().execute_lambda(lambda executor: shard_account(account_id, buckets, executor))
 
-    if body['accountId']:
-        try:
-            qldb_driver.execute_lambda(lambda executor: create_account(body['accountId'], executor))
-        except Exception as e:
-            return_error(str(e), http_status_code=500)
-            return return_object
-    else:
-        return_error('accountId not specified', http_status_code=400)
-        return return_object
+    return clients.qldb_driver().execute_lambda(lambda executor: create_account(account_id, executor, buckets=buckets))
 
-    return return_object
+
+def lambda_handler(event, context):
+    return handle_api_request(event, process_request, context, handler_name='createAccount')
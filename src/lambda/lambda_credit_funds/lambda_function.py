@@ -0,0 +1,71 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import os
+import logging
+from wallet_core import clients
+from wallet_core.accounts import validate_account_id
+from wallet_core.credits import (
+    DynamoDBCreditStatusStore,
+    InMemoryCreditStatusStore,
+    InProcessCreditQueue,
+    SqsCreditQueue,
+    accept_credit,
+    get_credit,
+    settle_in_process
+)
+from wallet_core.errors import BadRequest
+from wallet_core.responses import handle_api_request, require_positive_amount
+
+
+logger = logging.getLogger()
+logger.setLevel(os.getenv('LOG_LEVEL'))
+
+QLDB_TABLE_NAME = os.getenv('QLDB_TABLE_NAME')
+QLDB_CREDITS_TABLE_NAME = os.getenv('QLDB_CREDITS_TABLE_NAME')
+CREDIT_QUEUE_URL = os.getenv('CREDIT_QUEUE_URL')
+CREDITS_TABLE_NAME = os.getenv('CREDITS_TABLE_NAME')
+
+# Local stand-ins: credits queue in process and are settled in one batch when a credit status is polled
+LOCAL_MODE = not (CREDIT_QUEUE_URL and CREDITS_TABLE_NAME)
+local_credit_queue = InProcessCreditQueue()
+local_credit_status_store = InMemoryCreditStatusStore()
+
+
+def credit_queue():
+    if LOCAL_MODE:
+        return local_credit_queue
+    return SqsCreditQueue(CREDIT_QUEUE_URL, sqs=clients.client('sqs'))
+
+
+def credit_status_store():
+    if LOCAL_MODE:
+        return local_credit_status_store
+    return DynamoDBCreditStatusStore(clients.table(CREDITS_TABLE_NAME))
+
+
+def process_request(body):
+    credit_id = body.get('creditId')
+    if credit_id is not None and (not isinstance(credit_id, str) or not credit_id):
+        raise BadRequest('creditId must be a non-empty string')
+
+    if 'amount' not in body:
+        if not credit_id:
+            raise BadRequest('accountId and amount, or creditId, not specified')
+        if LOCAL_MODE:
+            settle_in_process(local_credit_queue, clients.qldb_driver(), QLDB_TABLE_NAME, QLDB_CREDITS_TABLE_NAME,
+                              local_credit_status_store)
+        return {'credit': get_credit(credit_status_store(), credit_id)}
+
+    message = 'accountId and amount not specified, or amount is less than zero'
+    account_id = body.get('accountId')
+    if not account_id or not isinstance(account_id, str):
+        raise BadRequest(message)
+    validate_account_id(account_id)
+    amount = require_positive_amount(body, message)
+
+    return {'credit': accept_credit(credit_queue(), credit_status_store(), account_id, amount, credit_id=credit_id)}
+
+
+def lambda_handler(event, context):
+    return handle_api_request(event, process_request, context, handler_name='creditFunds')
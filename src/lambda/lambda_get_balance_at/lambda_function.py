@@ -0,0 +1,67 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import os
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from wallet_core import clients
+from wallet_core.archive import archive_from_environment
+from wallet_core.balances import balance_at, history_time
+from wallet_core.errors import BadRequest, WalletError
+from wallet_core.responses import handle_api_request
+
+
+logger = logging.getLogger()
+logger.setLevel(os.getenv('LOG_LEVEL'))
+TABLE_NAME = os.getenv('DDB_TABLE_NAME')
+MAX_LOOKUPS = int(os.getenv('MAX_LOOKUPS', 100))
+LOOKUP_CONCURRENCY = int(os.getenv('LOOKUP_CONCURRENCY', 8))
+# Cold history archived before its TTL expiry, None when the history is not archived
+archive = archive_from_environment()
+
+
+def lookup_balance(account_id, at):
+    logger.info(f"Looking up balance of account with id {account_id} at {at}")
+    return balance_at(clients.table(TABLE_NAME), archive, account_id, at)
+
+
+def lookup_batch(lookups):
+    """
+    Looks up many (account, time) pairs concurrently. A pair without a balance gets an error entry
+    instead of failing the whole batch.
+    """
+
+    def lookup(pair):
+        try:
+            return lookup_balance(*pair)
+        except WalletError as e:
+            return {'accountId': pair[0], 'at': pair[1], 'error': e.message}
+
+    with ThreadPoolExecutor(max_workers=max(1, min(LOOKUP_CONCURRENCY, len(lookups)))) as pool:
+        return list(pool.map(lookup, lookups))
+
+
+def parse_lookup(body):
+    account_id = body.get('accountId')
+    if not account_id or not isinstance(account_id, str):
+        raise BadRequest('accountId not specified')
+    if 'at' not in body:
+        raise BadRequest('at not specified')
+    return account_id, history_time(body['at'])
+
+
+def process_request(body):
+    lookups = body.get('lookups')
+    if lookups is None:
+        return lookup_balance(*parse_lookup(body))
+
+    if not isinstance(lookups, list) or not lookups or not all(isinstance(pair, dict) for pair in lookups):
+        raise BadRequest('lookups must be a list of objects with accountId and at')
+    if len(lookups) > MAX_LOOKUPS:
+        raise BadRequest(f"At most {MAX_LOOKUPS} lookups are allowed per request")
+
+    return {'Balances': lookup_batch([parse_lookup(pair) for pair in lookups])}
+
+
+def lambda_handler(event, context):
+    return handle_api_request(event, process_request, context, handler_name='getBalanceAt')
@@ -1,83 +1,76 @@
 # Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
 # SPDX-License-Identifier: MIT-0
 
-from pyqldb.driver.qldb_driver import QldbDriver
-from pyqldb.config.retry_config import RetryConfig
 import os
 import logging
-import json
-from aws_xray_sdk.core import xray_recorder
-from aws_xray_sdk.core import patch_all
+from wallet_core import clients
+from wallet_core.accounts import AccountRepository
+from wallet_core.balances import read_balance_view, read_bucket_views, staleness_seconds
+from wallet_core.errors import BadRequest
+from wallet_core.responses import handle_api_request
 
 
-LEDGER_NAME = os.getenv('LEDGER_NAME')
+logger = logging.getLogger()
+logger.setLevel(os.getenv('LOG_LEVEL'))
+
 QLDB_TABLE_NAME = os.getenv('QLDB_TABLE_NAME')
-retry_config = RetryConfig(retry_limit=3)
-qldb_driver = QldbDriver(ledger_name=LEDGER_NAME, retry_config=retry_config)
+BALANCES_TABLE_NAME = os.getenv('BALANCES_TABLE_NAME')
 
-return_object = {}
+# Strong reads go to the ledger, eventual reads to the balance view projected from the QLDB stream
+STRONG_CONSISTENCY = 'strong'
+EVENTUAL_CONSISTENCY = 'eventual'
 
-logger = logging.getLogger()
-logger.setLevel(os.getenv('LOG_LEVEL'))
 
+def query_funds(account_id, executor):
+    logger.info(f"Looking up balance for account with id {account_id}")
+    return_message = AccountRepository(executor, QLDB_TABLE_NAME).get_balance(account_id)
+    return_message['consistency'] = STRONG_CONSISTENCY
+
+    return return_message
 
-def return_error(message, http_status_code=500):
-    global return_object
-    return_message = {'status': 'error', 'message': message}
-    return_object = {
-        "statusCode": http_status_code,
-        "body": json.dumps(return_message),
-        "isBase64Encoded": False
-    }
-    logger.error(return_message)
 
-    return return_object
+def query_projected_funds(account_id):
+    item = read_balance_view(clients.table(BALANCES_TABLE_NAME), account_id)
+    if not item:
+        return None
 
+    return_message = {'accountId': item['accountId'], 'balance': item['balance']}
+    buckets = int(item.get('buckets') or 1)
+    if buckets > 1:
+        bucket_items = read_bucket_views(clients.dynamodb(), BALANCES_TABLE_NAME, account_id, buckets)
+        if bucket_items is None:
+            return None
+        return_message['balance'] = sum(bucket_item['balance'] for bucket_item in bucket_items)
+        return_message['buckets'] = buckets
+        # The most recently projected bucket tells how current the view is
+        item = max(bucket_items, key=lambda bucket_item: bucket_item['timestamp'])
 
-def query_funds(account_id, executor):
-    global return_object
-    return_message = {}
+    return_message.update({
+        'consistency': EVENTUAL_CONSISTENCY,
+        'asOf': item['txTime'],
+        'stalenessSeconds': staleness_seconds(item)
+    })
+    return return_message
 
-    logger.info(f"Looking up balance for account with id {account_id}")
-    cursor = executor.execute_statement(f"SELECT accountId, balance FROM \"{QLDB_TABLE_NAME}\" WHERE accountId = ?", account_id)
-    first_doc = next(cursor, None)
 
-    if first_doc:
-        return_message['accountId'] = first_doc['accountId']
-        return_message['balance'] = first_doc['balance']
-    else:
-        return_error(f'Account {account_id} not found', http_status_code=400)
-        return return_object
+def process_request(body):
+    account_id = body.get('accountId')
+    if not account_id:
+        raise BadRequest('accountId not specified')
+
+    consistency = body.get('consistency', STRONG_CONSISTENCY)
+    if consistency not in (STRONG_CONSISTENCY, EVENTUAL_CONSISTENCY):
+        raise BadRequest(f"consistency must be {STRONG_CONSISTENCY} or {EVENTUAL_CONSISTENCY}")
+
+    if consistency == EVENTUAL_CONSISTENCY and BALANCES_TABLE_NAME:
+        return_message = query_projected_funds(account_id)
+        if return_message:
+            return return_message
+        # Accounts whose first revision is not projected yet are read from the ledger
+        logger.info(f"No projected balance for account {account_id}, reading from QLDB")
 
-    http_status_code = 200
-    return_message['status'] = 'Ok'
-    return_object = {
-        "statusCode": http_status_code,
-        "body": json.dumps(return_message),
-        "isBase64Encoded": False
-    }
+    return clients.qldb_driver().execute_lambda(lambda executor: query_funds(account_id, executor))
 
 
 def lambda_handler(event, context):
-    logger.debug(f"Event received: {json.dumps(event)}")
-
-    global return_object
-    return_object = {}
-    body = {}
-    try:
-        body = json.loads(event['body'])
-    except Exception as e:
-        return_error(str(e), http_status_code=400)
-        return return_object
-
-    if body['accountId']:
-        try:
-            qldb_driver.execute_lambda(lambda executor: query_funds(body['accountId'], executor))
-        except Exception as e:
-            return_error(str(e), http_status_code=500)
-            return return_object
-    else:
-        return_error('accountId not specified', http_status_code=400)
-        return return_object
-
-    return return_object
+    return handle_api_request(event, process_request, context, handler_name='getFunds')
@@ -0,0 +1,31 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import os
+import logging
+from wallet_core import clients
+from wallet_core.errors import BadRequest
+from wallet_core.responses import handle_api_request
+from wallet_core.rollups import query_rollups
+
+
+logger = logging.getLogger()
+logger.setLevel(os.getenv('LOG_LEVEL'))
+ROLLUPS_TABLE_NAME = os.getenv('ROLLUPS_TABLE_NAME')
+
+
+def process_request(body):
+    account_id = body.get('accountId')
+    if not account_id:
+        raise BadRequest('accountId not specified')
+
+    granularity = body.get('granularity', 'monthly')
+    logger.info(f"Querying {granularity} rollups for account with id {account_id}")
+    rollups = query_rollups(clients.table(ROLLUPS_TABLE_NAME), account_id, granularity,
+                            start=body.get('from'), end=body.get('to'))
+
+    return {'accountId': account_id, 'granularity': granularity, 'Rollups': rollups}
+
+
+def lambda_handler(event, context):
+    return handle_api_request(event, process_request, context, handler_name='getRollups')
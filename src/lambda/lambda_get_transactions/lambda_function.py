@@ -1,87 +1,142 @@
 # Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
 # SPDX-License-Identifier: MIT-0
 
-import boto3
-from boto3.dynamodb.conditions import Key
+import hashlib
+import json
 import os
 import logging
-import json
-import decimal
-from aws_xray_sdk.core import xray_recorder
-from aws_xray_sdk.core import patch_all
-
-
-# Helper class to convert a DynamoDB item to JSON.
-class DecimalEncoder(json.JSONEncoder):
-    def default(self, o):
-        if isinstance(o, decimal.Decimal):
-            if o % 1 > 0:
-                return float(o)
-            else:
-                return int(o)
-        return super(DecimalEncoder, self).default(o)
+from wallet_core import clients
+from wallet_core.archive import archive_from_environment, query_account_history
+from wallet_core.errors import BadRequest
+from wallet_core.export import export_history
+from wallet_core.history import decode_token, encode_token
+from wallet_core.responses import DecimalEncoder, handle_api_request
+from wallet_core.sinks import sink_from_environment
 
 
 logger = logging.getLogger()
 logger.setLevel(os.getenv('LOG_LEVEL'))
 TABLE_NAME = os.getenv('DDB_TABLE_NAME')
-
-dynamodb = boto3.resource('dynamodb')
-table = dynamodb.Table(TABLE_NAME)
-return_object = {}
+DEFAULT_PAGE_SIZE = int(os.getenv('DEFAULT_PAGE_SIZE', 100))
+MAX_PAGE_SIZE = int(os.getenv('MAX_PAGE_SIZE', 1000))
+SORT_ORDERS = ('asc', 'desc')
+# Cold history archived before its TTL expiry, None when the history is not archived
+archive = archive_from_environment()
 
 
-def return_error(message, http_status_code=500):
-    global return_object
-    return_message = {'status': 'error', 'message': message}
-    return_object = {
-        "statusCode": http_status_code,
-        "body": json.dumps(return_message),
-        "isBase64Encoded": False
+def query_transactions(account_id, start=None, end=None, limit=DEFAULT_PAGE_SIZE, ascending=True, attributes=None,
+                       next_token=None):
+    logger.info(f"Querying DynamoDB for account with id {account_id}")
+    start_key = decode_token(next_token, account_id) if next_token else None
+    items, last_key = query_account_history(clients.table(TABLE_NAME), archive, account_id, start=start, end=end,
+                                            limit=limit, ascending=ascending, attributes=attributes,
+                                            start_key=start_key)
+
+    return_message = {'Transactions': items}
+    if last_key:
+        return_message['nextToken'] = encode_token(last_key)
+
+    return return_message
+
+
+def export_transactions(account_id, start=None, end=None):
+    logger.info(f"Exporting history of account with id {account_id}")
+    export = export_history(clients.table(TABLE_NAME), sink_from_environment(), account_id, start=start, end=end,
+                            archive=archive)
+    return {'Export': export}
+
+
+def optional_string(body, name):
+    value = body.get(name)
+    if value is not None and not isinstance(value, str):
+        raise BadRequest(f"{name} must be a string")
+    return value
+
+
+def query_parameters(body):
+    account_id = body.get('accountId')
+    if not account_id:
+        raise BadRequest('accountId not specified')
+
+    limit = body.get('limit', DEFAULT_PAGE_SIZE)
+    if isinstance(limit, bool) or not isinstance(limit, int) or not 0 < limit <= MAX_PAGE_SIZE:
+        raise BadRequest(f"limit must be an integer between 1 and {MAX_PAGE_SIZE}")
+
+    order = body.get('order', 'asc')
+    if order not in SORT_ORDERS:
+        raise BadRequest(f"order must be one of {', '.join(SORT_ORDERS)}")
+
+    attributes = body.get('attributes')
+    if attributes is not None and (not isinstance(attributes, list) or
+                                   not all(isinstance(attribute, str) and attribute for attribute in attributes)):
+        raise BadRequest('attributes must be a list of attribute names')
+
+    return {
+        'account_id': account_id,
+        'start': optional_string(body, 'from'),
+        'end': optional_string(body, 'to'),
+        'limit': limit,
+        'ascending': order == 'asc',
+        'attributes': attributes,
+        'next_token': optional_string(body, 'nextToken')
     }
-    logger.error(return_message)
 
-    return return_object
 
+def process_request(body):
+    account_id = body.get('accountId')
+    if not account_id:
+        raise BadRequest('accountId not specified')
 
-def query_transactions(account_id):
-    return_message = {}
-    global return_object
+    if body.get('export'):
+        return export_transactions(account_id, start=optional_string(body, 'from'), end=optional_string(body, 'to'))
 
-    logger.info(f"Querying DynamoDB for account with id {account_id}")
-    response = table.query(TableName=TABLE_NAME,
-                           Select='ALL_ATTRIBUTES',
-                           KeyConditionExpression=Key('accountId').eq(account_id))
-
-    return_message['Transactions'] = response['Items']
-
-    http_status_code = 200
-    return_message['status'] = 'Ok'
-    return_object = {
-        "statusCode": http_status_code,
-        "body": json.dumps(return_message, cls=DecimalEncoder),
-        "isBase64Encoded": False
-    }
+    return query_transactions(**query_parameters(body))
 
 
-def lambda_handler(event, context):
-    logger.debug(f"Event received: {json.dumps(event)}")
-
-    global return_object
-    return_object = {}
-    body = {}
-
-    try:
-        body = json.loads(event['body'])
-    except Exception as e:
-        return_error(str(e), http_status_code=400)
-
-    if body['accountId']:
-        try:
-            query_transactions(body['accountId'])
-        except Exception as e:
-            return_error(str(e), http_status_code=500)
+def newest_transaction(account_id, start=None, end=None):
+    items, _ = query_account_history(clients.table(TABLE_NAME), archive, account_id, start=start, end=end, limit=1,
+                                     ascending=False, attributes=['txId'])
+    return items[0] if items else None
+
+
+def page_newest_transaction(parameters, return_message):
+    """
+    Returns the newest transaction of the requested range when the page holds it, i.e. the first page in descending
+    order or the last page in ascending order, or None when it must be queried
+    """
+
+    items = return_message['Transactions']
+    if not items:
+        return None
+    if not parameters['ascending'] and not parameters['next_token']:
+        newest = items[0]
+    elif parameters['ascending'] and 'nextToken' not in return_message:
+        newest = items[-1]
     else:
-        return_error('accountId not specified', http_status_code=400)
+        return None
+    return newest if 'txId' in newest else None
+
+
+def transactions_etag(body, return_message=None):
+    """
+    ETag of a page of transactions, derived from the request and the txTime and txId of the newest transaction
+    in the requested range. A new transaction changes it, so polling clients sending If-None-Match get a 304
+    after a single Limit=1 descending query, or one per bucket for a sharded account.
+    """
+
+    if body.get('export'):
+        return None
 
-    return return_object
+    parameters = query_parameters(body)
+    newest = page_newest_transaction(parameters, return_message) if return_message else None
+    if newest is None:
+        newest = newest_transaction(parameters['account_id'], start=parameters['start'], end=parameters['end'])
+
+    fingerprint = json.dumps([parameters, newest and [newest['txTime'], newest.get('txId')]], sort_keys=True,
+                             cls=DecimalEncoder)
+    return f'W/"{hashlib.sha256(fingerprint.encode("utf-8")).hexdigest()[:32]}"'
+
+
+def lambda_handler(event, context):
+    return handle_api_request(event, process_request, context, handler_name='getTransactions', compress=True,
+                              etag=transactions_etag)
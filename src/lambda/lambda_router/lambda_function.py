@@ -0,0 +1,89 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import time
+
+_init_started = time.perf_counter()
+
+import importlib
+import json
+import os
+import logging
+from wallet_core import clients
+from wallet_core.responses import error_response
+
+
+logger = logging.getLogger()
+logger.setLevel(os.getenv('LOG_LEVEL'))
+
+# The last segment of the request path selects the handler module. Modules are imported when their route is
+# first called, and share the clients of wallet_core.clients, so one container serves every route.
+ROUTES = {
+    'getFunds': 'lambda_get_funds.lambda_function',
+    'getTransactions': 'lambda_get_transactions.lambda_function',
+    'getRollups': 'lambda_get_rollups.lambda_function',
+    'getBalanceAt': 'lambda_get_balance_at.lambda_function',
+    'createAccount': 'lambda_create_account.lambda_function',
+    'withdrawFunds': 'lambda_withdraw_funds.lambda_function',
+    'addFunds': 'lambda_add_funds.lambda_function',
+    'bulkMutations': 'lambda_bulk_mutations.lambda_function',
+    'creditFunds': 'lambda_credit_funds.lambda_function'
+}
+ALLOWED_METHODS = ('POST',)
+
+handlers = {}
+startup_report = {'initMs': None, 'routes': {}}
+
+
+def elapsed_ms(started):
+    return round((time.perf_counter() - started) * 1000, 1)
+
+
+def route_of(event):
+    path = event.get('path') or event.get('rawPath') or ''
+    segments = [segment for segment in path.split('/') if segment]
+    return segments[-1] if segments else None
+
+
+def load_handler(route):
+    handler = handlers.get(route)
+    if handler is None:
+        started = time.perf_counter()
+        handler = importlib.import_module(ROUTES[route]).lambda_handler
+        handlers[route] = handler
+        startup_report['routes'][route] = {'importMs': elapsed_ms(started)}
+    return handler
+
+
+def log_startup_report(route, first_call_ms):
+    """
+    Logs, once per route and container, the time spent importing the route's module and serving its first call,
+    including the clients it created
+    """
+
+    startup_report['routes'][route]['firstCallMs'] = first_call_ms
+    report = dict(startup_report, route=route, clientsMs=dict(clients.init_timings))
+    logger.info(f"Startup report: {json.dumps(report)}")
+
+
+def lambda_handler(event, context):
+    route = route_of(event)
+    if route not in ROUTES:
+        return error_response(f"Unknown route {route}", http_status_code=404)
+
+    method = event.get('httpMethod') or event.get('requestContext', {}).get('http', {}).get('method')
+    if method and method not in ALLOWED_METHODS:
+        return error_response(f"Method {method} not allowed", http_status_code=405)
+
+    first_call = route not in handlers
+    handler = load_handler(route)
+    if not first_call:
+        return handler(event, context)
+
+    started = time.perf_counter()
+    response = handler(event, context)
+    log_startup_report(route, elapsed_ms(started))
+    return response
+
+
+startup_report['initMs'] = elapsed_ms(_init_started)
@@ -0,0 +1,53 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import boto3
+import os
+import logging
+from wallet_core.credits import DynamoDBCreditStatusStore, parse_credit_message, settle_credits
+from wallet_core.metrics import invocation_metrics
+from wallet_core.qldb import create_qldb_driver
+from wallet_core.retry import retry_policy
+
+
+logger = logging.getLogger()
+logger.setLevel(os.getenv('LOG_LEVEL'))
+
+QLDB_TABLE_NAME = os.getenv('QLDB_TABLE_NAME')
+# Ledger table holding one document per settled credit
+QLDB_CREDITS_TABLE_NAME = os.getenv('QLDB_CREDITS_TABLE_NAME')
+CREDITS_TABLE_NAME = os.getenv('CREDITS_TABLE_NAME')
+
+# Initialize the driver
+qldb_driver = create_qldb_driver()
+credit_status_store = DynamoDBCreditStatusStore(boto3.resource('dynamodb').Table(CREDITS_TABLE_NAME))
+
+
+def lambda_handler(event, context):
+    credits = []
+    failed_message_ids = []
+    message_ids = {}
+
+    for record in event['Records']:
+        try:
+            credit = parse_credit_message(record['body'])
+        except Exception as e:
+            logger.error(f"Error parsing credit message {record['messageId']}: {e}")
+            failed_message_ids.append(record['messageId'])
+            continue
+        credits.append(credit)
+        message_ids.setdefault(credit['creditId'], []).append(record['messageId'])
+
+    retry_policy.begin_invocation(context)
+    invocation_metrics.begin_invocation('settleCredits')
+    try:
+        for credit in settle_credits(qldb_driver, QLDB_TABLE_NAME, QLDB_CREDITS_TABLE_NAME, credit_status_store,
+                                     credits):
+            failed_message_ids.extend(message_ids[credit['creditId']])
+    finally:
+        invocation_metrics.end_invocation(retry_policy.end_invocation())
+
+    # Only the messages of failed transactions return to the queue
+    return {
+        'batchItemFailures': [{'itemIdentifier': message_id} for message_id in dict.fromkeys(failed_message_ids)]
+    }
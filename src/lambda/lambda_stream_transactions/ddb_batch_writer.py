@@ -0,0 +1,167 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import logging
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from botocore.exceptions import ClientError
+
+logger = logging.getLogger()
+
+# BatchWriteItem accepts at most 25 put or delete requests per call
+MAX_BATCH_SIZE = 25
+THROTTLING_ERROR_CODES = ('ProvisionedThroughputExceededException', 'ThrottlingException', 'RequestLimitExceeded')
+
+
+class UnprocessedItemsError(Exception):
+    def __init__(self, items):
+        super().__init__(f"{len(items)} items left unprocessed after retries")
+        self.items = items
+
+
+def count_requests(request_items):
+    return sum(len(requests) for requests in request_items.values())
+
+
+def revision_of(item):
+    return item['documentId'], item['version']
+
+
+class BatchWriter:
+    """
+    Buffers DynamoDB items and writes them with BatchWriteItem in chunks of up to 25 items.
+    Items sharing the same key collapse to the last one added, since BatchWriteItem rejects
+    duplicate keys in a single request. UnprocessedItems and throttled calls are resent with
+    capped exponential backoff and full jitter.
+    Writes are not conditional: use it for tables where every revision has its own key, such as the history, which
+    an older revision can never overwrite. Revisions already written by this container are dropped when added.
+    Parameters:
+       dynamodb: boto3 DynamoDB service resource
+       table_name (string): Name of the destination table
+       key_attributes (tuple): Partition and sort key attribute names of the table
+       recent_revisions (RecentRevisions): Revisions already written by this container, or None
+       max_attempts (int): Number of BatchWriteItem calls per chunk before giving up
+       base_delay (float): Backoff base in seconds
+       max_delay (float): Upper bound for a single backoff in seconds
+       max_workers (int): Number of chunks written concurrently
+    """
+
+    def __init__(self, dynamodb, table_name, key_attributes, recent_revisions=None, max_attempts=8, base_delay=0.05,
+                 max_delay=2.0, max_workers=1):
+        self.dynamodb = dynamodb
+        self.table_name = table_name
+        self.key_attributes = key_attributes
+        self.recent_revisions = recent_revisions
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_workers = max_workers
+        self.counters = {'written': 0, 'duplicates': 0, 'retried': 0, 'throttled': 0, 'failed': 0}
+        self._items = {}
+        self._lock = threading.Lock()
+
+    def item_key(self, item):
+        return tuple(item[attribute] for attribute in self.key_attributes)
+
+    def add(self, item, source_id=None):
+        """
+        Buffers an item
+        Parameters:
+           item (dict): The item to put
+           source_id: Identifier of the record the item was built from, reported back if the write fails
+        """
+
+        if self.recent_revisions is not None and revision_of(item) in self.recent_revisions:
+            self.counters['duplicates'] += 1
+            return
+
+        key = self.item_key(item)
+        # Re-insert so the surviving item keeps the position of the last revision
+        self._items.pop(key, None)
+        self._items[key] = (item, source_id)
+
+    def flush(self):
+        """
+        Writes all buffered items
+        Returns:
+           The source ids of the items that could not be written
+        """
+
+        entries = list(self._items.values())
+        self._items = {}
+        chunks = [entries[start:start + MAX_BATCH_SIZE] for start in range(0, len(entries), MAX_BATCH_SIZE)]
+
+        if self.max_workers <= 1 or len(chunks) <= 1:
+            results = [self._flush_chunk(chunk) for chunk in chunks]
+        else:
+            with ThreadPoolExecutor(max_workers=min(self.max_workers, len(chunks))) as pool:
+                results = list(pool.map(self._flush_chunk, chunks))
+
+        failed_source_ids = []
+        # The revisions cache is only updated from this thread
+        for written, failed in results:
+            if self.recent_revisions is not None:
+                for item in written:
+                    self.recent_revisions.add(revision_of(item))
+            failed_source_ids.extend(failed)
+
+        self.counters['failed'] += len(failed_source_ids)
+        return failed_source_ids
+
+    def _flush_chunk(self, chunk):
+        """
+        Returns:
+           (written, failed): the items written, and the source ids of the items that failed
+        """
+
+        try:
+            self._write_chunk([item for item, _ in chunk])
+        except UnprocessedItemsError as e:
+            failed_keys = {self.item_key(item) for item in e.items}
+            failed = [source_id for item, source_id in chunk if self.item_key(item) in failed_keys]
+            logger.error(f"Error writing {len(failed)} items to {self.table_name}: {e}")
+            return [item for item, _ in chunk if self.item_key(item) not in failed_keys], failed
+        except ClientError as e:
+            logger.error(f"Error writing {len(chunk)} items to {self.table_name}: {e}")
+            return [], [source_id for _, source_id in chunk]
+        return [item for item, _ in chunk], []
+
+    def _count(self, counter, value):
+        with self._lock:
+            self.counters[counter] += value
+
+    def _backoff(self, attempt):
+        return random.uniform(0, min(self.max_delay, self.base_delay * (2 ** attempt)))
+
+    def _write_chunk(self, items):
+        request_items = {self.table_name: [{'PutRequest': {'Item': item}} for item in items]}
+        attempt = 0
+
+        while True:
+            pending = count_requests(request_items)
+            try:
+                response = self.dynamodb.batch_write_item(RequestItems=request_items)
+                unprocessed = response.get('UnprocessedItems') or {}
+            except ClientError as e:
+                if e.response['Error']['Code'] not in THROTTLING_ERROR_CODES:
+                    raise e
+                self._count('throttled', pending)
+                unprocessed = request_items
+
+            self._count('written', pending - count_requests(unprocessed))
+            if not unprocessed:
+                return
+
+            attempt += 1
+            if attempt >= self.max_attempts:
+                raise UnprocessedItemsError([request['PutRequest']['Item']
+                                             for requests in unprocessed.values() for request in requests])
+
+            self._count('retried', count_requests(unprocessed))
+            delay = self._backoff(attempt)
+            logger.info(f"Retrying {count_requests(unprocessed)} unprocessed items in {delay:.3f}s "
+                        f"(attempt {attempt + 1}/{self.max_attempts})")
+            time.sleep(delay)
+            request_items = unprocessed
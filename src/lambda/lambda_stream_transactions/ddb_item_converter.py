@@ -0,0 +1,144 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import time
+import zlib
+from calendar import timegm
+from collections.abc import Mapping
+from datetime import datetime
+from decimal import Decimal
+from amazon.ion.core import IonType
+from amazon.ion.simple_types import IonPyNull
+
+MAX_FRACTIONAL_DIGITS = 6
+# Shards of the day index read by the history archive runs, DAY_SHARDS in wallet_core/archive.py
+DAY_SHARDS = 16
+
+
+def to_ddb_value(value):
+    """
+    Converts a value loaded by amazon.ion.simpleion to the types the boto3 DynamoDB resource serializes natively:
+    Decimal for numbers, str, bool, bytes, None and nested dicts and lists
+    Parameters:
+       value: Ion value from a QLDB revision
+    """
+
+    if value is None or isinstance(value, IonPyNull):
+        return None
+    # Ion booleans are loaded as ints tagged with IonType.BOOL
+    if isinstance(value, bool) or getattr(value, 'ion_type', None) is IonType.BOOL:
+        return bool(value)
+    # Recent amazon.ion versions load structs as a Mapping that is not a dict
+    if isinstance(value, Mapping):
+        return {str(key): to_ddb_value(field) for key, field in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [to_ddb_value(element) for element in value]
+    if isinstance(value, str):
+        return str(value)
+    if isinstance(value, Decimal):
+        return Decimal(value)
+    if isinstance(value, int):
+        return Decimal(int(value))
+    if isinstance(value, float):
+        return Decimal(repr(float(value)))
+    if isinstance(value, datetime):
+        return format_timestamp(value)
+    if isinstance(value, (bytes, bytearray)):
+        return bytes(value)
+
+    raise TypeError(f"Unsupported Ion value of type {type(value).__name__}")
+
+
+def to_utc(timestamp):
+    # Build a plain naive UTC datetime, so no Ion timestamp subclass or local timezone is involved
+    utc = datetime(timestamp.year, timestamp.month, timestamp.day, timestamp.hour, timestamp.minute,
+                   timestamp.second, timestamp.microsecond)
+    offset = timestamp.utcoffset()
+    return utc - offset if offset else utc
+
+
+def format_timestamp(timestamp):
+    """
+    Formats an Ion timestamp as ISO 8601 text in UTC, e.g. 2021-03-18T17:06:42.123Z.
+    The number of fractional digits follows the timestamp's own precision, as in the Ion text representation.
+    """
+
+    utc = to_utc(timestamp)
+    digits = getattr(timestamp, 'fractional_precision', None)
+    if digits is None:
+        digits = MAX_FRACTIONAL_DIGITS if utc.microsecond else 0
+
+    text = utc.strftime('%Y-%m-%dT%H:%M:%S')
+    if digits:
+        text += '.' + f"{utc.microsecond:06d}"[:min(digits, MAX_FRACTIONAL_DIGITS)]
+    return text + 'Z'
+
+
+def epoch_seconds(timestamp):
+    return timegm(to_utc(timestamp).timetuple())
+
+
+def revision_to_ddb_item(revision_data, revision_metadata):
+    """
+    Builds the transactions table item for a QLDB revision in a single pass over the Ion values
+    Parameters:
+       revision_data: The data block of the revision
+       revision_metadata: The metadata block of the revision
+    """
+
+    ddb_item = to_ddb_value(revision_data)
+    tx_time = revision_metadata['txTime']
+    ddb_item['txTime'] = format_timestamp(tx_time)
+    ddb_item['txId'] = str(revision_metadata['txId'])
+    ddb_item['timestamp'] = epoch_seconds(tx_time)
+    ddb_item['documentId'] = str(revision_metadata['id'])
+    ddb_item['version'] = int(revision_metadata['version'])
+
+    return ddb_item
+
+
+def days_to_seconds(days):
+    return int(days) * 24 * 60 * 60
+
+
+def day_shard(ddb_item, shards=DAY_SHARDS):
+    # Spreads the items of a day over several index partitions, stable across processes unlike hash()
+    shard = zlib.crc32(ddb_item['accountId'].encode('utf-8')) % shards
+    return f"{ddb_item['txTime'][:10]}#{shard:02d}"
+
+
+def revision_item(revision, ttl_attribute=None, expire_after_days=None, day_index_attribute=None):
+    """
+    Builds the transactions table item of a decoded revision, with its expiry time when TTL is enabled and its
+    day index key when the history is archived
+    Parameters:
+       revision (dict): Revision with its revision_data and revision_metadata, or None
+       day_index_attribute (string): Partition key of the day index, only set on items when the index exists
+    Returns:
+       The item, or None for no revision or a revision without data, i.e. a deleted document
+    """
+
+    if not revision or not revision['revision_data']:
+        return None
+
+    ddb_item = revision_to_ddb_item(revision['revision_data'], revision['revision_metadata'])
+    if ttl_attribute and expire_after_days:
+        ddb_item[ttl_attribute] = ddb_item['timestamp'] + days_to_seconds(expire_after_days)
+    if day_index_attribute:
+        ddb_item[day_index_attribute] = day_shard(ddb_item)
+    return ddb_item
+
+
+BALANCE_VIEW_ATTRIBUTES = ('accountId', 'balance', 'buckets', 'bucketOf', 'documentId', 'version', 'txId', 'txTime',
+                           'timestamp')
+
+
+def balance_view_item(ddb_item):
+    """
+    Builds the current balance item of an account from its projected history item
+    """
+
+    item = {attribute: ddb_item[attribute] for attribute in BALANCE_VIEW_ATTRIBUTES if attribute in ddb_item}
+    item['projectedAt'] = int(time.time())
+
+    return item
@@ -0,0 +1,254 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import logging
+import random
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal
+from botocore.exceptions import ClientError
+from ddb_batch_writer import THROTTLING_ERROR_CODES
+
+logger = logging.getLogger()
+
+# Sort key values of the rollups table: one item per account and day, one per account and month,
+# and the cursor holding the version and balance of the last revision folded into the rollups.
+# Each bucket of a sharded account has its own rollups, under the accountId of the bucket.
+DAILY_PREFIX = 'D#'
+MONTHLY_PREFIX = 'M#'
+CURSOR_PERIOD = 'CURSOR'
+# TransactWriteItems accepts at most 100 items, one of which is the cursor
+MAX_PERIODS_PER_TRANSACTION = 99
+RETRYABLE_CANCELLATION_CODES = ('TransactionConflict', 'ThrottlingError', 'ProvisionedThroughputExceeded')
+
+
+def periods_of(tx_time):
+    # txTime is an ISO 8601 UTC string, e.g. 2021-03-18T17:06:42.123Z
+    return f"{DAILY_PREFIX}{tx_time[:10]}", f"{MONTHLY_PREFIX}{tx_time[:7]}"
+
+
+def period_updates(revisions, previous_balance):
+    """
+    Folds revisions of one account, in version order, into the changes of each period they fall in
+    Parameters:
+       revisions (list): Items from ddb_item_converter.revision_to_ddb_item
+       previous_balance (Decimal): Balance before the first revision
+    Returns:
+       OrderedDict of period to {credits, debits, txCount, openingBalance, closingBalance, lastTxTime}
+    """
+
+    updates = OrderedDict()
+    balance = previous_balance
+    for revision in revisions:
+        delta = revision['balance'] - balance
+        for period in periods_of(revision['txTime']):
+            update = updates.get(period)
+            if update is None:
+                update = updates[period] = {'credits': Decimal(0), 'debits': Decimal(0), 'txCount': 0,
+                                            'openingBalance': balance}
+            if delta > 0:
+                update['credits'] += delta
+            elif delta < 0:
+                update['debits'] -= delta
+            if delta:
+                update['txCount'] += 1
+            update['closingBalance'] = revision['balance']
+            update['lastTxTime'] = revision['txTime']
+        balance = revision['balance']
+
+    return updates
+
+
+def revision_chunks(revisions, max_periods=MAX_PERIODS_PER_TRANSACTION):
+    """
+    Splits revisions, in order, into chunks touching at most max_periods rollup items each
+    """
+
+    chunk = []
+    periods = set()
+    for revision in revisions:
+        revision_periods = set(periods_of(revision['txTime']))
+        if chunk and len(periods | revision_periods) > max_periods:
+            yield chunk
+            chunk = []
+            periods = set()
+        chunk.append(revision)
+        periods |= revision_periods
+
+    if chunk:
+        yield chunk
+
+
+class CursorMoved(Exception):
+    pass
+
+
+class RollupWriter:
+    """
+    Maintains daily and monthly rollups of every account: credits, debits, number of balance changes,
+    opening and closing balance. The amount of a revision is the difference with the balance of the previous one.
+    The revisions of an account in a batch are folded into its rollups and its cursor with one TransactWriteItems
+    (one per 99 periods touched), conditional on the cursor version read before, so updates are atomic and a
+    replayed revision is never counted twice. The first revision seen for an account with no cursor only sets its
+    opening balance, unless it is the first revision of the document.
+    Parameters:
+       table: boto3 DynamoDB Table resource of the rollups table
+       max_workers (int): Number of accounts updated concurrently
+       max_attempts (int): Number of attempts per account before giving up
+    """
+
+    def __init__(self, table, max_workers=1, max_attempts=5, base_delay=0.05, max_delay=2.0):
+        self.table = table
+        self.client = table.meta.client
+        self.max_workers = max_workers
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.counters = {'revisions': 0, 'replayed': 0, 'transactions': 0, 'retried': 0, 'failed': 0}
+        self._accounts = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _count(self, counter, value=1):
+        with self._lock:
+            self.counters[counter] += value
+
+    def add(self, item, source_id=None):
+        if 'balance' not in item:
+            return
+        self._accounts.setdefault(item['accountId'], []).append((item, source_id))
+
+    def flush(self):
+        """
+        Updates the rollups of all buffered revisions
+        Returns:
+           The source ids of the revisions whose rollups could not be updated
+        """
+
+        accounts = list(self._accounts.items())
+        self._accounts = OrderedDict()
+
+        if self.max_workers <= 1 or len(accounts) <= 1:
+            results = [self._write_account(*account) for account in accounts]
+        else:
+            with ThreadPoolExecutor(max_workers=min(self.max_workers, len(accounts))) as pool:
+                results = list(pool.map(lambda account: self._write_account(*account), accounts))
+
+        return [source_id for failed in results for source_id in failed]
+
+    def _write_account(self, account_id, entries):
+        # A revision delivered twice in the batch is only folded once
+        entries = {entry[0]['version']: entry for entry in entries}
+        entries = [entries[version] for version in sorted(entries)]
+        attempt = 1
+
+        while True:
+            try:
+                self._apply(account_id, [item for item, _ in entries])
+                return []
+            except CursorMoved:
+                # Another invocation updated the cursor since it was read, the revisions are folded again
+                logger.info(f"Rollup cursor of {account_id} moved, retrying")
+            except ClientError as e:
+                if not self._is_retryable(e):
+                    logger.error(f"Error updating rollups of {account_id}: {e}")
+                    return self._failed(entries)
+            if attempt >= self.max_attempts:
+                logger.error(f"Giving up updating rollups of {account_id} after {attempt} attempts")
+                return self._failed(entries)
+
+            self._count('retried')
+            time.sleep(random.uniform(0, min(self.max_delay, self.base_delay * (2 ** attempt))))
+            attempt += 1
+
+    def _failed(self, entries):
+        self._count('failed', len(entries))
+        return [source_id for _, source_id in entries]
+
+    def _is_retryable(self, error):
+        code = error.response['Error']['Code']
+        if code in THROTTLING_ERROR_CODES:
+            return True
+        reasons = error.response.get('CancellationReasons') or []
+        return code == 'TransactionCanceledException' and \
+            any(reason.get('Code') in RETRYABLE_CANCELLATION_CODES for reason in reasons)
+
+    def _apply(self, account_id, revisions):
+        cursor = self.table.get_item(Key={'accountId': account_id, 'period': CURSOR_PERIOD},
+                                     ConsistentRead=True).get('Item')
+
+        if cursor is None:
+            first = revisions[0]
+            # Without a cursor, the balance before the first revision is only known for a new document
+            previous_balance = Decimal(0) if first['version'] == 0 else first['balance']
+            last_version = None
+        else:
+            previous_balance = cursor['balance']
+            last_version = int(cursor['lastVersion'])
+            new_revisions = [revision for revision in revisions if revision['version'] > last_version]
+            self._count('replayed', len(revisions) - len(new_revisions))
+            revisions = new_revisions
+            if not revisions:
+                return
+
+        balance = previous_balance
+        for chunk in revision_chunks(revisions):
+            self._transact(account_id, period_updates(chunk, balance).items(), last_version, chunk[-1])
+            last_version = chunk[-1]['version']
+            balance = chunk[-1]['balance']
+            self._count('revisions', len(chunk))
+
+    def _transact(self, account_id, updates, expected_version, last_revision):
+        table_name = self.table.name
+        cursor_values = {
+            ':version': last_revision['version'],
+            ':balance': last_revision['balance'],
+            ':txTime': last_revision['txTime']
+        }
+        cursor_expression = 'SET lastVersion = :version, balance = :balance, lastTxTime = :txTime'
+        if expected_version is not None:
+            cursor_values[':expected'] = expected_version
+        # The cursor of a sharded account holds its number of buckets, whose rollups are merged when read
+        if 'buckets' in last_revision:
+            cursor_values[':buckets'] = last_revision['buckets']
+            cursor_expression += ', buckets = :buckets'
+
+        items = [{
+            'Update': {
+                'TableName': table_name,
+                'Key': {'accountId': account_id, 'period': CURSOR_PERIOD},
+                'UpdateExpression': cursor_expression,
+                'ConditionExpression': 'attribute_not_exists(lastVersion)' if expected_version is None
+                else 'lastVersion = :expected',
+                'ExpressionAttributeValues': cursor_values
+            }
+        }]
+
+        for period, update in updates:
+            items.append({
+                'Update': {
+                    'TableName': table_name,
+                    'Key': {'accountId': account_id, 'period': period},
+                    'UpdateExpression': 'SET openingBalance = if_not_exists(openingBalance, :opening), '
+                                        'closingBalance = :closing, lastTxTime = :txTime '
+                                        'ADD credits :credits, debits :debits, txCount :count',
+                    'ExpressionAttributeValues': {
+                        ':opening': update['openingBalance'],
+                        ':closing': update['closingBalance'],
+                        ':txTime': update['lastTxTime'],
+                        ':credits': update['credits'],
+                        ':debits': update['debits'],
+                        ':count': update['txCount']
+                    }
+                }
+            })
+
+        try:
+            self.client.transact_write_items(TransactItems=items)
+        except ClientError as e:
+            reasons = e.response.get('CancellationReasons') or []
+            if reasons and reasons[0].get('Code') == 'ConditionalCheckFailed':
+                raise CursorMoved()
+            raise e
+        self._count('transactions')
@@ -0,0 +1,190 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import logging
+import random
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from botocore.exceptions import ClientError
+from ddb_batch_writer import THROTTLING_ERROR_CODES, revision_of
+
+logger = logging.getLogger()
+
+# Only write an item if it is new or its stored revision version is older
+VERSION_CONDITION = 'attribute_not_exists(#version) OR #version < :version'
+
+
+class RecentRevisions:
+    """
+    Bounded LRU set of recently applied (documentId, version) pairs.
+    It lives for the lifetime of the container, so replayed records are dropped before any call to DynamoDB.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._entries = OrderedDict()
+
+    def __contains__(self, revision):
+        if revision in self._entries:
+            self._entries.move_to_end(revision)
+            return True
+        return False
+
+    def add(self, revision):
+        self._entries[revision] = None
+        self._entries.move_to_end(revision)
+        if len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+
+class VersionedWriter:
+    """
+    Writes projection items with a conditional PutItem that skips items whose stored revision version is
+    the same or newer, so replays and out-of-order revisions never overwrite newer data.
+    Items sharing the same key within one flush collapse to the highest version, and throttled calls are resent
+    with capped exponential backoff and full jitter.
+    Partitions, i.e. items sharing the same partition key value, are written concurrently by up to max_workers
+    threads, each partition in the order its items were added. A throttled call pauses every worker for its backoff,
+    so the writer slows down as a whole instead of each thread retrying on its own.
+    Parameters:
+       table: boto3 DynamoDB Table resource. Its put_item calls go through the resource's client, which is
+          thread-safe; its connection pool should hold max_workers connections
+       key_attributes (tuple): Partition and sort key attribute names of the table
+       recent_revisions (RecentRevisions): Revisions already applied by this container
+       max_attempts (int): Number of PutItem calls per item before giving up
+       base_delay (float): Backoff base in seconds
+       max_delay (float): Upper bound for a single backoff in seconds
+       max_workers (int): Number of partitions written concurrently
+    """
+
+    def __init__(self, table, key_attributes, recent_revisions, max_attempts=8, base_delay=0.05, max_delay=2.0,
+                 max_workers=1):
+        self.table = table
+        self.key_attributes = key_attributes
+        self.recent_revisions = recent_revisions
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_workers = max_workers
+        self.counters = {'written': 0, 'skipped': 0, 'duplicates': 0, 'retried': 0, 'throttled': 0, 'failed': 0}
+        self._items = {}
+        self._lock = threading.Lock()
+        self._paused_until = 0.0
+
+    def item_key(self, item):
+        return tuple(item[attribute] for attribute in self.key_attributes)
+
+    def add(self, item, source_id=None):
+        """
+        Buffers an item unless its revision was already applied by this container
+        Parameters:
+           item (dict): The item to put, including documentId and version
+           source_id: Identifier of the record the item was built from, reported back if the write fails
+        """
+
+        if revision_of(item) in self.recent_revisions:
+            self.counters['duplicates'] += 1
+            return
+
+        key = self.item_key(item)
+        buffered = self._items.get(key)
+        if buffered and buffered[0]['version'] >= item['version']:
+            self.counters['duplicates'] += 1
+            return
+        self._items[key] = (item, source_id)
+
+    def partitions(self, entries):
+        partitions = OrderedDict()
+        for entry in entries:
+            partitions.setdefault(entry[0][self.key_attributes[0]], []).append(entry)
+        return list(partitions.values())
+
+    def flush(self):
+        """
+        Writes all buffered items
+        Returns:
+           The source ids of the items that could not be written
+        """
+
+        partitions = self.partitions(self._items.values())
+        self._items = {}
+        failed_source_ids = []
+
+        if self.max_workers <= 1 or len(partitions) <= 1:
+            results = [self._write_partition(entries) for entries in partitions]
+        else:
+            with ThreadPoolExecutor(max_workers=min(self.max_workers, len(partitions))) as pool:
+                results = list(pool.map(self._write_partition, partitions))
+
+        # The revisions cache is only updated from this thread
+        for written, failed in results:
+            for item in written:
+                self.recent_revisions.add(revision_of(item))
+            failed_source_ids.extend(failed)
+
+        self.counters['failed'] += len(failed_source_ids)
+        return failed_source_ids
+
+    def _write_partition(self, entries):
+        """
+        Writes the items of one partition in order
+        Returns:
+           (written, failed): the items written or skipped, and the source ids of the items that failed
+        """
+
+        written = []
+        failed = []
+        for item, source_id in entries:
+            try:
+                self._put(item)
+            except ClientError as e:
+                logger.error(f"Error writing item {self.item_key(item)} to {self.table.name}: {e}")
+                failed.append(source_id)
+                continue
+            written.append(item)
+        return written, failed
+
+    def _count(self, counter):
+        with self._lock:
+            self.counters[counter] += 1
+
+    def _backoff(self, attempt):
+        return random.uniform(0, min(self.max_delay, self.base_delay * (2 ** attempt)))
+
+    def _wait_if_paused(self):
+        delay = self._paused_until - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+
+    def _pause(self, delay):
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + delay)
+
+    def _put(self, item):
+        attempt = 1
+
+        while True:
+            self._wait_if_paused()
+            try:
+                self.table.put_item(Item=item,
+                                    ConditionExpression=VERSION_CONDITION,
+                                    ExpressionAttributeNames={'#version': 'version'},
+                                    ExpressionAttributeValues={':version': item['version']})
+                self._count('written')
+                return
+            except ClientError as e:
+                error_code = e.response['Error']['Code']
+                if error_code == 'ConditionalCheckFailedException':
+                    self._count('skipped')
+                    return
+                if error_code not in THROTTLING_ERROR_CODES:
+                    raise e
+                self._count('throttled')
+                if attempt >= self.max_attempts:
+                    raise e
+
+            self._count('retried')
+            self._pause(self._backoff(attempt))
+            attempt += 1
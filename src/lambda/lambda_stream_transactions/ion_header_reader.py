@@ -0,0 +1,83 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+from io import BytesIO
+from amazon.ion.core import IonEventType
+from amazon.ion.reader import blocking_reader, NEXT_EVENT, SKIP_EVENT
+from amazon.ion.reader_binary import binary_reader
+from amazon.ion.reader_managed import managed_reader
+from amazon.ion.reader_text import text_reader
+
+ION_BINARY_VERSION_MARKER = b'\xe0\x01\x00\xea'
+
+# Containers that are entered while looking for the header fields, keyed by their field path.
+# Every other container (e.g. payload.revision) is skipped without being parsed.
+HEADER_CONTAINER_PATHS = {('payload',), ('payload', 'tableInfo')}
+
+
+def new_event_reader(payload):
+    if payload[:len(ION_BINARY_VERSION_MARKER)] == ION_BINARY_VERSION_MARKER:
+        raw_reader = binary_reader()
+    else:
+        raw_reader = text_reader()
+    return blocking_reader(managed_reader(raw_reader), BytesIO(payload))
+
+
+def scalar_text(value):
+    # Symbols are returned as SymbolTokens, strings as str
+    return getattr(value, 'text', value)
+
+
+def read_record_header(payload, stop_unless_record_type=None):
+    """
+    Reads recordType and payload.tableInfo.tableName from a QLDB stream record with a streaming Ion reader,
+    without materializing the rest of the record
+    Parameters:
+       payload (bytes): The Ion (binary or text) record published by QLDB to the stream
+       stop_unless_record_type (string): If given, stop reading as soon as recordType is known to differ from it
+    Returns:
+       (record_type, table_name); either is None when the field is not present
+    """
+
+    reader = new_event_reader(payload)
+    record_type = None
+    table_name = None
+    # Field names of the containers entered so far, the top level record being None
+    path = []
+
+    event = reader.send(NEXT_EVENT)
+    while event.event_type is not IonEventType.STREAM_END:
+        field_name = event.field_name.text if event.field_name is not None else None
+
+        if event.event_type is IonEventType.CONTAINER_START:
+            if event.depth == 0:
+                path.append(None)
+            elif tuple(path[1:]) + (field_name,) in HEADER_CONTAINER_PATHS:
+                path.append(field_name)
+            else:
+                skipped_depth = event.depth
+                event = reader.send(SKIP_EVENT)
+                # Depending on the reader, skipping yields the skipped container's end or the following event
+                if not (event.event_type is IonEventType.CONTAINER_END and event.depth == skipped_depth):
+                    continue
+
+        elif event.event_type is IonEventType.CONTAINER_END:
+            path.pop()
+            if not path:
+                break
+
+        elif event.event_type is IonEventType.SCALAR:
+            if len(path) == 1 and field_name == 'recordType':
+                record_type = scalar_text(event.value)
+            elif tuple(path[1:]) == ('payload', 'tableInfo') and field_name == 'tableName':
+                table_name = scalar_text(event.value)
+
+            if record_type is not None:
+                if table_name is not None:
+                    break
+                if stop_unless_record_type and record_type != stop_unless_record_type:
+                    break
+
+        event = reader.send(NEXT_EVENT)
+
+    return record_type, table_name
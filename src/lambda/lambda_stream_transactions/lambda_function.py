@@ -2,47 +2,87 @@
 # SPDX-License-Identifier: MIT-0
 
 import boto3
-import time
 import amazon.ion.simpleion as ion
-from amazon.ion.json_encoder import IonToJSONEncoder
-import json
 import base64
+import json
 import logging
 import os
 from aws_kinesis_agg.deaggregator import deaggregate_records
-from decimal import Decimal
+from botocore.config import Config
+from ddb_batch_writer import BatchWriter
+from ddb_rollups import RollupWriter
+from ddb_versioned_writer import RecentRevisions, VersionedWriter
+from ddb_item_converter import balance_view_item, revision_item
+from ion_header_reader import read_record_header
 
 logger = logging.getLogger()
 logger.setLevel(os.getenv('LOG_LEVEL'))
 
 session = boto3.Session()
 QLDB_TABLE_NAME = os.getenv(key='QLDB_TABLE_NAME')
-dynamodb = boto3.resource('dynamodb')
+# Number of history chunks, and of accounts of the balance view, written concurrently
+WRITE_CONCURRENCY = int(os.getenv(key='WRITE_CONCURRENCY', default=8))
+# One client, shared by the writer threads, with a connection for each of them
+dynamodb = boto3.resource('dynamodb', config=Config(max_pool_connections=max(10, WRITE_CONCURRENCY)))
 DDB_TABLE_NAME = os.getenv(key='DDB_TABLE_NAME')
-table = dynamodb.Table(DDB_TABLE_NAME)
+BALANCES_TABLE_NAME = os.getenv(key='BALANCES_TABLE_NAME', default=None)
+balances_table = dynamodb.Table(BALANCES_TABLE_NAME) if BALANCES_TABLE_NAME else None
+ROLLUPS_TABLE_NAME = os.getenv(key='ROLLUPS_TABLE_NAME', default=None)
+rollups_table = dynamodb.Table(ROLLUPS_TABLE_NAME) if ROLLUPS_TABLE_NAME else None
 EXPIRE_AFTER_DAYS = os.getenv(key='EXPIRE_AFTER_DAYS', default=None)
 TTL_ATTRIBUTE = os.getenv(key='TTL_ATTRIBUTE', default=None)
+# Set when the history is archived, so only then do items carry the key of the day index
+DAY_INDEX_ATTRIBUTE = os.getenv(key='DAY_INDEX_ATTRIBUTE', default=None)
+DLQ_URL = os.getenv(key='DLQ_URL', default=None)
+RECENT_REVISIONS_CACHE_SIZE = int(os.getenv(key='RECENT_REVISIONS_CACHE_SIZE', default=10000))
+sqs = None
+
+# Revisions applied by this container, kept across invocations to drop replayed records early.
+# Each projection keeps its own cache, as a revision is applied to each of them independently.
+recent_revisions = RecentRevisions(RECENT_REVISIONS_CACHE_SIZE)
+recent_balance_revisions = RecentRevisions(RECENT_REVISIONS_CACHE_SIZE)
 
 REVISION_DETAILS_RECORD_TYPE = "REVISION_DETAILS"
 
 
-def filtered_records_generator(kinesis_deaggregate_records, table_names=None):
-    for record in kinesis_deaggregate_records:
-        # Kinesis data in Python Lambdas is base64 encoded
-        payload = base64.b64decode(record['kinesis']['data'])
-        # payload is the actual ion binary record published by QLDB to the stream
-        ion_record = ion.loads(payload)
-        logger.info(f"Ion record: {ion.dumps(ion_record, binary=False)}")
+def decode_revision_record(record, table_names=None):
+    """
+    Decodes a deaggregated Kinesis record and returns its revision if it belongs to one of table_names
+    Parameters:
+       record (dict): Deaggregated Kinesis record
+       table_names (list): Table names to keep, or None to keep revisions of every table
+    """
+
+    # Kinesis data in Python Lambdas is base64 encoded
+    payload = base64.b64decode(record['kinesis']['data'])
+    # payload is the actual ion binary record published by QLDB to the stream.
+    # Only its header is read before deciding whether the record is materialized.
+    record_type, table_name = read_record_header(payload, stop_unless_record_type=REVISION_DETAILS_RECORD_TYPE)
+
+    if record_type != REVISION_DETAILS_RECORD_TYPE:
+        logger.debug(f"Skipping {record_type} record")
+        return None
+    if table_names and table_name not in table_names:
+        logger.debug(f"Skipping revision for table {table_name}")
+        return None
+
+    ion_record = ion.loads(payload)
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(f"Ion record: {ion.dumps(ion_record, binary=False)}")
+
+    table_info = get_table_info_from_revision_record(ion_record)
+    revision_data, revision_metadata = get_data_metdata_from_revision_record(ion_record)
 
-        if ("recordType" in ion_record) and (ion_record["recordType"] == REVISION_DETAILS_RECORD_TYPE):
-            table_info = get_table_info_from_revision_record(ion_record)
+    return {"table_info": table_info,
+            "revision_data": revision_data,
+            "revision_metadata": revision_metadata}
 
-            if not table_names or (table_info and (table_info["tableName"] in table_names)):
-                revision_data, revision_metadata = get_data_metdata_from_revision_record(ion_record)
 
-                yield {"table_info": table_info,
-                       "revision_data": revision_data,
-                       "revision_metadata": revision_metadata}
+def filtered_records_generator(kinesis_deaggregate_records, table_names=None):
+    for record in kinesis_deaggregate_records:
+        revision = decode_revision_record(record, table_names=table_names)
+        if revision:
+            yield revision
 
 
 def get_data_metdata_from_revision_record(revision_record):
@@ -78,42 +118,102 @@ def get_table_info_from_revision_record(revision_record):
         return revision_record["payload"]["tableInfo"]
 
 
-def days_to_seconds (days):
-    return int(days) * 24 * 60 * 60
+def send_to_dead_letter_queue(record, error):
+    """
+    Sends a record that cannot be converted to the dead-letter queue, so it does not hold back the shard
+    Returns:
+       True if the record was sent
+    """
+
+    global sqs
+    if not DLQ_URL:
+        return False
+
+    kinesis = record['kinesis']
+    message = {
+        'sequenceNumber': kinesis['sequenceNumber'],
+        'subSequenceNumber': kinesis.get('subSequenceNumber'),
+        'partitionKey': kinesis.get('partitionKey'),
+        'approximateArrivalTimestamp': kinesis.get('approximateArrivalTimestamp'),
+        'eventSourceARN': record.get('eventSourceARN'),
+        'data': kinesis['data'],
+        'error': str(error)
+    }
+
+    try:
+        if sqs is None:
+            sqs = boto3.client('sqs')
+        sqs.send_message(QueueUrl=DLQ_URL, MessageBody=json.dumps(message, default=str))
+    except Exception as e:
+        logger.error(f"Error sending record {kinesis['sequenceNumber']} to the dead-letter queue: {e}")
+        return False
+
+    return True
+
+
+def batch_item_failures(failed_sequence_numbers):
+    # Lambda resumes the shard from the lowest reported sequence number, so only that one is returned.
+    # Records deaggregated from one aggregated Kinesis record share its sequence number, so the whole aggregated
+    # record is retried; the sub-records already written then rewrite the same history items, and are skipped by the
+    # version condition of the balance view.
+    if not failed_sequence_numbers:
+        return []
+    return [{'itemIdentifier': min(failed_sequence_numbers, key=int)}]
 
 
 def lambda_handler(event, context):
     raw_kinesis_records = event['Records']
 
-    # Deaggregate all records in one call
+    # Deaggregate all records in one call. Records that were not aggregated by QLDB are passed through,
+    # so the stream_aggregation setting can be changed while records of both kinds are in the stream.
     records = deaggregate_records(raw_kinesis_records)
 
-    # Iterate through deaggregated records
-    for record in filtered_records_generator(records,
-                                             table_names=[QLDB_TABLE_NAME]):
-        table_name = record["table_info"]["tableName"]
-        revision_data = record["revision_data"]
-        revision_metadata = record["revision_metadata"]
-
-        if revision_data:
-            if table_name == QLDB_TABLE_NAME:
-                ddb_item = json.loads(json.dumps(revision_data, cls=IonToJSONEncoder), parse_float=Decimal)
-                string_datetime = ion.dumps(revision_metadata['txTime'], binary=False).split()[1]
-                parsed_datetime = time.strptime(string_datetime, "%Y-%m-%dT%H:%M:%S.%fZ")
-                unix_time = int(time.strftime('%s', parsed_datetime))
-                ddb_item['txTime'] = string_datetime
-                ddb_item['txId'] = revision_metadata['txId']
-                ddb_item['timestamp'] = unix_time
-                if TTL_ATTRIBUTE and EXPIRE_AFTER_DAYS:
-                    ddb_item[TTL_ATTRIBUTE] = unix_time + days_to_seconds(EXPIRE_AFTER_DAYS)
-
-                try:
-                    table.put_item(Item=ddb_item)
-                except Exception as e:
-                    logger.error(f"Error processing record {ddb_item}")
-                    raise e
+    # Items are buffered and written with BatchWriteItem once the whole batch has been converted.
+    # Every revision has its own accountId/txTime key, so a replayed revision rewrites the same item and can never
+    # overwrite a newer one: history writes need no version condition.
+    writer = BatchWriter(dynamodb, DDB_TABLE_NAME, key_attributes=('accountId', 'txTime'),
+                         recent_revisions=recent_revisions, max_workers=WRITE_CONCURRENCY)
+    # The current balance view keeps one item per account, holding its latest revision. Its writes are conditional
+    # on the revision version, so replays never overwrite a newer balance; accounts are written concurrently.
+    balance_writer = None
+    if balances_table:
+        balance_writer = VersionedWriter(balances_table, key_attributes=('accountId',),
+                                         recent_revisions=recent_balance_revisions, max_workers=WRITE_CONCURRENCY)
+    # Daily and monthly rollups per account, folded from the balance changes of the revisions
+    rollup_writer = RollupWriter(rollups_table, max_workers=WRITE_CONCURRENCY) if rollups_table else None
+    failed_sequence_numbers = []
 
+    # Iterate through deaggregated records
+    for record in records:
+        sequence_number = record['kinesis']['sequenceNumber']
+
+        try:
+            revision = decode_revision_record(record, table_names=[QLDB_TABLE_NAME])
+            ddb_item = revision_item(revision, ttl_attribute=TTL_ATTRIBUTE, expire_after_days=EXPIRE_AFTER_DAYS,
+                                     day_index_attribute=DAY_INDEX_ATTRIBUTE)
+            if ddb_item is None:
+                continue
+        except Exception as e:
+            logger.error(f"Error converting record {sequence_number}: {e}")
+            if not send_to_dead_letter_queue(record, e):
+                failed_sequence_numbers.append(sequence_number)
+            continue
+
+        writer.add(ddb_item, sequence_number)
+        if balance_writer:
+            balance_writer.add(balance_view_item(ddb_item), sequence_number)
+        if rollup_writer:
+            rollup_writer.add(ddb_item, sequence_number)
+
+    failed_sequence_numbers.extend(writer.flush())
+    logger.info(f"Batch write counters: {writer.counters}")
+    if balance_writer:
+        failed_sequence_numbers.extend(balance_writer.flush())
+        logger.info(f"Balance view write counters: {balance_writer.counters}")
+    if rollup_writer:
+        failed_sequence_numbers.extend(rollup_writer.flush())
+        logger.info(f"Rollup counters: {rollup_writer.counters}")
 
     return {
-        'statusCode': 200
+        'batchItemFailures': batch_item_failures(failed_sequence_numbers)
     }
@@ -0,0 +1,388 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import logging
+import os
+import random
+import time
+from collections import OrderedDict
+from itertools import islice
+from wallet_core.errors import AccountAlreadyExists, AccountNotFound, BadRequest, DuplicateAccount, InsufficientFunds
+from wallet_core.qldb import MAX_DOCUMENTS_PER_TRANSACTION
+
+logger = logging.getLogger()
+
+# Sharded accounts spread their balance across bucket documents. Bucket 0 is the account document itself,
+# which holds the number of buckets; bucket k > 0 is stored under the accountId "<accountId>#<k>".
+BUCKET_SEPARATOR = '#'
+# Enabling sharding and draining every bucket must both fit in a single transaction
+MAX_BUCKETS = MAX_DOCUMENTS_PER_TRANSACTION
+
+# Seconds a container trusts the number of buckets of an account it has read, and number of accounts it remembers
+BUCKET_COUNTS_CACHE_SECONDS = int(os.getenv('BUCKET_COUNTS_CACHE_SECONDS', 60))
+BUCKET_COUNTS_CACHE_SIZE = int(os.getenv('BUCKET_COUNTS_CACHE_SIZE', 10000))
+
+
+class BucketCounts:
+    """
+    Bounded LRU of the number of buckets of the accounts seen by this container, each count expiring after
+    cache_seconds so a warm container sees an account sharded again.
+    """
+
+    def __init__(self, max_size=BUCKET_COUNTS_CACHE_SIZE, cache_seconds=BUCKET_COUNTS_CACHE_SECONDS):
+        self.max_size = max_size
+        self.cache_seconds = cache_seconds
+        self._entries = OrderedDict()
+
+    def get(self, account_id):
+        """
+        Returns the number of buckets of the account, or None if it is unknown or expired
+        """
+
+        entry = self._entries.get(account_id)
+        if entry is None:
+            return None
+        if time.monotonic() - entry[0] >= self.cache_seconds:
+            del self._entries[account_id]
+            return None
+        self._entries.move_to_end(account_id)
+        return entry[1]
+
+    def set(self, account_id, buckets):
+        self._entries[account_id] = (time.monotonic(), buckets)
+        self._entries.move_to_end(account_id)
+        if len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def forget(self, account_id):
+        self._entries.pop(account_id, None)
+
+
+# Knowing the number of buckets of an account lets a mutation read only the bucket it updates, instead of
+# the account document every other mutation of the account also touches
+bucket_counts = BucketCounts()
+
+
+def bucket_account_id(account_id, bucket):
+    return account_id if bucket == 0 else f"{account_id}{BUCKET_SEPARATOR}{bucket}"
+
+
+def bucket_account_ids(account_id, buckets):
+    return [bucket_account_id(account_id, bucket) for bucket in range(buckets)]
+
+
+def validate_account_id(account_id):
+    if BUCKET_SEPARATOR in account_id:
+        raise BadRequest(f"accountId must not contain '{BUCKET_SEPARATOR}'")
+
+
+def draw_from_buckets(balances, amount):
+    """
+    Picks the buckets a withdrawal is taken from: one random bucket holding the whole amount, otherwise the fullest
+    buckets first, so as few documents as possible are updated
+    Parameters:
+       balances (list): Balance of each bucket, whose total covers amount
+    Returns:
+       dict of bucket to the amount taken from it
+    """
+
+    eligible = [bucket for bucket, balance in enumerate(balances) if balance >= amount]
+    if eligible:
+        return {random.choice(eligible): amount}
+
+    remaining = amount
+    drawn = {}
+    for bucket in sorted(range(len(balances)), key=lambda b: balances[b], reverse=True):
+        taken = min(balances[bucket], remaining)
+        if taken <= 0:
+            continue
+        drawn[bucket] = taken
+        remaining -= taken
+        if remaining == 0:
+            break
+    return drawn
+
+
+class AccountRepository:
+    """
+    Reads and updates wallet account documents within a QLDB transaction.
+    Every mutation costs one SELECT, which also checks existence and uniqueness, and one UPDATE.
+    Accounts can opt in to sharding, where deposits go to a random bucket document to spread OCC conflicts.
+    Parameters:
+       executor: The pyqldb transaction executor
+       table_name (string): Name of the QLDB table holding the accounts
+    """
+
+    def __init__(self, executor, table_name):
+        self.executor = executor
+        self.table_name = table_name
+
+    def get(self, account_id):
+        """
+        Returns the account document with accountId, balance and, for sharded accounts, buckets
+        Raises AccountNotFound, or DuplicateAccount if more than one document has this accountId
+        """
+
+        logger.info(f"Retrieving account {account_id}")
+        cursor = self.executor.execute_statement(
+            f"SELECT accountId, balance, buckets FROM \"{self.table_name}\" WHERE accountId = ?", account_id)
+        # Reading a second document is enough to detect duplicates
+        docs = list(islice(cursor, 2))
+
+        if not docs:
+            raise AccountNotFound(account_id)
+        if len(docs) > 1:
+            raise DuplicateAccount(account_id)
+
+        return docs[0]
+
+    def get_many(self, account_ids):
+        """
+        Reads the documents of several accounts with a single statement
+        Returns:
+           (docs, duplicates): the documents keyed by accountId, and the set of accountIds with more than one document
+        """
+
+        docs = {}
+        duplicates = set()
+        if not account_ids:
+            return docs, duplicates
+
+        logger.info(f"Retrieving {len(account_ids)} accounts")
+        placeholders = ', '.join('?' for _ in account_ids)
+        cursor = self.executor.execute_statement(
+            f"SELECT accountId, balance, buckets, appliedCredits FROM \"{self.table_name}\" "
+            f"WHERE accountId IN ({placeholders})", *account_ids)
+
+        for doc in cursor:
+            if doc['accountId'] in docs:
+                duplicates.add(doc['accountId'])
+            docs[doc['accountId']] = doc
+
+        return docs, duplicates
+
+    def exists(self, account_id):
+        cursor = self.executor.execute_statement(
+            f"SELECT accountId FROM \"{self.table_name}\" WHERE accountId = ?", account_id)
+        return next(cursor, None) is not None
+
+    def create(self, account_id, balance=0, buckets=1):
+        logger.info(f"Verifying account with id {account_id} does not exist")
+        if self.exists(account_id):
+            raise AccountAlreadyExists(account_id)
+
+        doc = {
+            'accountId': account_id,
+            'balance': balance
+        }
+        if buckets > 1:
+            doc['buckets'] = buckets
+            docs = [doc] + self._new_buckets(account_id, 1, buckets)
+            logger.info(f"Creating account with id {account_id}, {buckets} buckets and balance = {doc['balance']}")
+            self._insert(docs)
+            return doc
+
+        logger.info(f"Creating account with id {account_id} and balance = {doc['balance']}")
+        self.executor.execute_statement(f"INSERT INTO \"{self.table_name}\" ?", doc)
+
+        return doc
+
+    def _new_buckets(self, account_id, first_bucket, buckets):
+        bucket_ids = [bucket_account_id(account_id, bucket) for bucket in range(first_bucket, buckets)]
+        existing, _ = self.get_many(bucket_ids)
+        if existing:
+            raise AccountAlreadyExists(next(iter(existing)))
+
+        return [{'accountId': bucket_id, 'balance': 0, 'bucketOf': account_id} for bucket_id in bucket_ids]
+
+    def _insert(self, docs):
+        placeholders = ', '.join('?' for _ in docs)
+        self.executor.execute_statement(f"INSERT INTO \"{self.table_name}\" << {placeholders} >>", *docs)
+
+    def enable_sharding(self, account_id, buckets):
+        """
+        Splits an existing account across buckets documents. New buckets start empty, so the current balance
+        stays in bucket 0. The number of buckets can only grow.
+        """
+
+        doc = self.get(account_id)
+        current_buckets = int(doc.get('buckets') or 1)
+        if buckets <= current_buckets:
+            raise BadRequest(f"Account {account_id} already has {current_buckets} buckets")
+
+        logger.info(f"Sharding account {account_id} from {current_buckets} to {buckets} buckets")
+        self._insert(self._new_buckets(account_id, current_buckets, buckets))
+        self.executor.execute_statement(f"UPDATE \"{self.table_name}\" SET buckets = ? WHERE accountId = ?",
+                                        buckets, account_id)
+
+        return {'accountId': account_id, 'buckets': buckets}
+
+    def create_many(self, account_ids, balance=0):
+        """
+        Creates the accounts that do not exist yet, with one existence read and one INSERT statement
+        The number of new documents must fit the transaction limits, see wallet_core.qldb.chunk_documents
+        Returns:
+           (created, existing): the ids of the accounts created and of those that already existed
+        """
+
+        docs, _ = self.get_many(account_ids)
+        existing = [account_id for account_id in account_ids if account_id in docs]
+        new_docs = [{'accountId': account_id, 'balance': balance}
+                    for account_id in account_ids if account_id not in docs]
+
+        if new_docs:
+            logger.info(f"Creating {len(new_docs)} accounts with balance = {balance}")
+            self._insert(new_docs)
+
+        return [doc['accountId'] for doc in new_docs], existing
+
+    def set_balance(self, account_id, balance, applied_credits=()):
+        """
+        Updates the balance of an account document. appliedCredits is rewritten by every update, so each revision
+        lists exactly the queued credits it settled and the stream projection keeps a per-deposit history.
+        """
+
+        self.executor.execute_statement(
+            f"UPDATE \"{self.table_name}\" SET balance = ?, appliedCredits = ? WHERE accountId = ?",
+            balance, list(applied_credits), account_id)
+
+    def get_balance(self, account_id):
+        """
+        Returns the balance of an account, summing all buckets of a sharded account
+        """
+
+        doc = self.get(account_id)
+        buckets = self.remember_buckets(account_id, doc)
+        if buckets == 1:
+            return {'accountId': doc['accountId'], 'balance': doc['balance']}
+
+        bucket_docs = self._get_buckets(account_id, buckets)
+        return {'accountId': doc['accountId'], 'balance': sum(bucket_doc['balance'] for bucket_doc in bucket_docs),
+                'buckets': buckets}
+
+    def remember_buckets(self, account_id, doc):
+        """
+        Returns the number of buckets of an account from its account document, and remembers it in this container
+        """
+
+        buckets = int(doc.get('buckets') or 1)
+        bucket_counts.set(account_id, buckets)
+        return buckets
+
+    def _get_buckets(self, account_id, buckets):
+        bucket_ids = bucket_account_ids(account_id, buckets)
+        docs, duplicates = self.get_many(bucket_ids)
+        for bucket_id in bucket_ids:
+            if bucket_id in duplicates:
+                raise DuplicateAccount(bucket_id)
+            if bucket_id not in docs:
+                raise AccountNotFound(bucket_id)
+
+        return [docs[bucket_id] for bucket_id in bucket_ids]
+
+    def get_bucket_docs(self, docs, buckets_of):
+        """
+        Reads buckets of several accounts with a single statement
+        Raises AccountNotFound, or DuplicateAccount, if a bucket is missing or has more than one document
+        Parameters:
+           docs (dict): Account documents keyed by accountId, as returned by get_many
+           buckets_of (dict): accountId to the buckets to read, bucket 0 being the account document itself
+        Returns:
+           dict of accountId to a dict of bucket to document
+        """
+
+        bucket_ids = [bucket_account_id(account_id, bucket)
+                      for account_id, buckets in buckets_of.items() for bucket in buckets if bucket]
+        bucket_docs, duplicates = self.get_many(bucket_ids)
+        for bucket_id in bucket_ids:
+            if bucket_id in duplicates:
+                raise DuplicateAccount(bucket_id)
+            if bucket_id not in bucket_docs:
+                raise AccountNotFound(bucket_id)
+
+        return {account_id: {bucket: bucket_docs[bucket_account_id(account_id, bucket)] if bucket else docs[account_id]
+                             for bucket in buckets}
+                for account_id, buckets in buckets_of.items()}
+
+    def _get_bucket(self, account_id):
+        """
+        Picks a random bucket of the account and returns (bucket, buckets, doc).
+        The account document is only read when the number of buckets is not known by this container, or when
+        bucket 0 is picked, which refreshes the number of buckets.
+        """
+
+        buckets = bucket_counts.get(account_id)
+        if buckets is None:
+            doc = self.get(account_id)
+            buckets = self.remember_buckets(account_id, doc)
+            bucket = random.randrange(buckets)
+            if bucket != 0:
+                doc = self.get(bucket_account_id(account_id, bucket))
+            return bucket, buckets, doc
+
+        bucket = random.randrange(buckets)
+        doc = self.get(bucket_account_id(account_id, bucket))
+        if bucket == 0:
+            buckets = self.remember_buckets(account_id, doc)
+        return bucket, buckets, doc
+
+    def _update_bucket(self, doc, bucket, buckets, amount):
+        old_balance = doc['balance']
+        new_balance = old_balance + amount
+        logger.info(f"Updating balance with {amount} for {doc['accountId']}")
+        self.set_balance(doc['accountId'], new_balance)
+
+        result = {'old_balance': old_balance, 'new_balance': new_balance}
+        if buckets > 1:
+            result['bucket'] = bucket
+        return result
+
+    def deposit(self, account_id, amount):
+        """
+        Adds amount to the balance of the account, or of one random bucket of a sharded account
+        Returns:
+           old_balance and new_balance, of the bucket for sharded accounts
+        """
+
+        bucket, buckets, doc = self._get_bucket(account_id)
+        return self._update_bucket(doc, bucket, buckets, amount)
+
+    def withdraw(self, account_id, amount):
+        """
+        Deducts amount from the balance of the account. Sharded accounts first try one random bucket,
+        then any bucket with enough funds, then draw from several buckets in the same transaction.
+        Raises InsufficientFunds if the balance would become negative
+        Returns:
+           old_balance and new_balance, of the bucket when a single bucket of a sharded account is used
+        """
+
+        bucket, buckets, doc = self._get_bucket(account_id)
+        if doc['balance'] >= amount:
+            return self._update_bucket(doc, bucket, buckets, -amount)
+        if buckets == 1:
+            raise InsufficientFunds(account_id, amount)
+
+        return self._withdraw_from_buckets(account_id, amount, buckets)
+
+    def _withdraw_from_buckets(self, account_id, amount, buckets):
+        bucket_docs = self._get_buckets(account_id, buckets)
+        # The count may come from the cache: the account document read with the buckets tells the current one
+        current_buckets = self.remember_buckets(account_id, bucket_docs[0])
+        if current_buckets > buckets:
+            return self._withdraw_from_buckets(account_id, amount, current_buckets)
+
+        balances = [doc['balance'] for doc in bucket_docs]
+        total = sum(balances)
+        if total < amount:
+            raise InsufficientFunds(account_id, amount)
+
+        drawn = draw_from_buckets(balances, amount)
+        if len(drawn) == 1:
+            bucket = next(iter(drawn))
+            return self._update_bucket(bucket_docs[bucket], bucket, buckets, -amount)
+
+        for bucket, taken in drawn.items():
+            self.set_balance(bucket_docs[bucket]['accountId'], balances[bucket] - taken)
+
+        logger.info(f"Withdrew {amount} from buckets {list(drawn)} of {account_id}")
+        return {'old_balance': total, 'new_balance': total - amount, 'buckets': list(drawn)}
@@ -0,0 +1,537 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import decimal
+import gzip
+import json
+import logging
+import os
+import time
+import uuid
+import zlib
+from datetime import date, timedelta
+from boto3.dynamodb.conditions import Attr, Key
+from wallet_core import clients
+from wallet_core.accounts import bucket_account_ids, bucket_counts
+from wallet_core.errors import BadRequest
+from wallet_core.history import KEY_ATTRIBUTES, MAX_PAGE_BYTES, item_key, query_history
+from wallet_core.responses import DecimalEncoder
+from wallet_core.sinks import LocalFileSink, S3Sink, write_chunks
+
+logger = logging.getLogger()
+
+ARCHIVE_BUCKET = os.getenv('ARCHIVE_BUCKET')
+ARCHIVE_INDEX_TABLE_NAME = os.getenv('ARCHIVE_INDEX_TABLE_NAME')
+ARCHIVE_DIR = os.getenv('ARCHIVE_DIR')
+ARCHIVE_PARTITIONS = int(os.getenv('ARCHIVE_PARTITIONS', 16))
+# The archive state is reread at most once per period by a warm container
+ARCHIVE_CACHE_SECONDS = int(os.getenv('ARCHIVE_CACHE_SECONDS', 60))
+# Items buffered by an archive run before they are written, bounding its memory use
+MAX_BUFFERED_ITEMS = 50000
+# Keys per BatchGetItem request, the DynamoDB limit, and attempts to read the keys it leaves unprocessed
+BATCH_GET_KEYS = 100
+BATCH_GET_ATTEMPTS = 8
+
+STATE_KEY = 'archive/state.json'
+# Keys of the history items by day, in shards of accounts, written by lambda_stream_transactions when the history
+# is archived (see ddb_item_converter.py): the items of a day are found without scanning the table
+DAY_INDEX_NAME = 'tx-day-index'
+DAY_SHARD_ATTRIBUTE = 'txDayShard'
+DAY_SHARDS = 16
+
+
+def local_index_key(account_id):
+    return f"archive/index/{account_partition(account_id):03d}/{account_id}.json"
+
+
+def file_key(partition, month, run_id, part):
+    return f"archive/{partition:03d}/{month}/{run_id}-{part:04d}.json.gz"
+
+
+def account_partition(account_id, partitions=ARCHIVE_PARTITIONS):
+    # Stable across processes, unlike hash()
+    return zlib.crc32(account_id.encode('utf-8')) % partitions
+
+
+def encode_columns(items):
+    """
+    Encodes items as a gzip-compressed JSON object holding one list of values per attribute, rows sorted by
+    accountId and txTime. Values of the same attribute compress well together, and a reader can select rows
+    from the key columns before materializing any other attribute.
+    """
+
+    items = sorted(items, key=lambda item: (item['accountId'], item['txTime']))
+    names = list(dict.fromkeys(name for item in items for name in item))
+    document = {'count': len(items), 'columns': {name: [item.get(name) for item in items] for name in names}}
+    return gzip.compress(json.dumps(document, cls=DecimalEncoder, separators=(',', ':')).encode('utf-8'))
+
+
+def decode_columns(data):
+    # Numbers are read back as Decimal, like the items returned by DynamoDB
+    return json.loads(gzip.decompress(data), parse_float=decimal.Decimal, parse_int=decimal.Decimal)
+
+
+def select_rows(document, account_id, start=None, end=None, attributes=None):
+    """
+    Materializes the rows of one account within inclusive txTime bounds; missing attributes are null in the columns
+    """
+
+    columns = document['columns']
+    account_ids = columns['accountId']
+    tx_times = columns['txTime']
+    rows = [position for position in range(len(account_ids))
+            if account_ids[position] == account_id and (not start or tx_times[position] >= start) and
+            (not end or tx_times[position] <= end)]
+
+    names = list(columns) if not attributes else [name for name in dict.fromkeys(list(KEY_ATTRIBUTES) + attributes)
+                                                  if name in columns]
+    return [{name: columns[name][position] for name in names if columns[name][position] is not None}
+            for position in rows]
+
+
+def overlapping_groups(entries):
+    """
+    Groups index entries, sorted by first txTime, into runs of overlapping ranges, whose rows must be sorted together
+    """
+
+    group = []
+    group_last = None
+    for entry in entries:
+        if group and entry['first'] > group_last:
+            yield group
+            group = []
+        group_last = entry['last'] if not group else max(group_last, entry['last'])
+        group.append(entry)
+
+    if group:
+        yield group
+
+
+class DynamoDBArchiveIndex:
+    """
+    Index of the archive in a DynamoDB table, with one item per account and archive file holding its items:
+    the file key, the run that wrote it, and the first and last txTime and number of the account's items in it.
+    Reading an account's entries is one query, whatever the number of archived accounts.
+    Parameters:
+       table_name (string): Name of the table, partition key accountId and sort key file
+    """
+
+    def __init__(self, table_name):
+        self.table_name = table_name
+
+    def entries(self, account_id):
+        query_arguments = {'KeyConditionExpression': Key('accountId').eq(account_id)}
+        entries = []
+        while True:
+            response = clients.table(self.table_name).query(**query_arguments)
+            entries.extend(response['Items'])
+            if 'LastEvaluatedKey' not in response:
+                return entries
+            query_arguments['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+    def add(self, entries):
+        with clients.table(self.table_name).batch_writer() as batch:
+            for entry in entries:
+                batch.put_item(Item=entry)
+
+
+class SinkArchiveIndex:
+    """
+    Index of the archive stored through its sink, with one small object per account, e.g. for local runs
+    """
+
+    def __init__(self, sink):
+        self.sink = sink
+
+    def entries(self, account_id):
+        data = self.sink.read(local_index_key(account_id))
+        return json.loads(data) if data else []
+
+    def add(self, entries):
+        by_account = {}
+        for entry in entries:
+            by_account.setdefault(entry['accountId'], []).append(entry)
+        for account_id, account_entries in by_account.items():
+            write_chunks(self.sink, local_index_key(account_id),
+                         [json.dumps(self.entries(account_id) + account_entries).encode('utf-8')])
+
+
+class HistoryArchive:
+    """
+    Cold history of the transactions table, stored through a sink as compressed columnar files partitioned by
+    account partition and month. Every history item with txTime before archivedUntil is in the archive, so a
+    reader takes those items from the archive and the later ones from DynamoDB.
+    The state object holds archivedUntil and the ids of the completed runs, and the index lists, for each account,
+    the files holding its items. Index entries of a run that did not complete are ignored.
+    Parameters:
+       sink: LocalFileSink or S3Sink holding the archive
+       index: DynamoDBArchiveIndex or SinkArchiveIndex
+       partitions (int): Number of account partitions, fixed for the life of the archive
+    """
+
+    def __init__(self, sink, index, partitions=ARCHIVE_PARTITIONS, cache_seconds=ARCHIVE_CACHE_SECONDS):
+        self.sink = sink
+        self.index = index
+        self.partitions = partitions
+        self.cache_seconds = cache_seconds
+        self._cache = None
+
+    def state(self):
+        if self._cache and time.monotonic() - self._cache[0] < self.cache_seconds:
+            return self._cache[1]
+
+        data = self.sink.read(STATE_KEY)
+        state = json.loads(data) if data else {}
+        self._cache = (time.monotonic(), state)
+        return state
+
+    def write_state(self, state):
+        write_chunks(self.sink, STATE_KEY, [json.dumps(state, separators=(',', ':')).encode('utf-8')])
+        self._cache = None
+
+    def archived_until(self):
+        return self.state().get('archivedUntil')
+
+    def entries(self, account_id, start=None, end=None):
+        """
+        Returns the index entries of the files holding an account's items within inclusive txTime bounds,
+        sorted by first txTime
+        """
+
+        state = self.state()
+        archived_until = state.get('archivedUntil')
+        if not archived_until:
+            return []
+
+        runs = set(state.get('runs', []))
+        return sorted((entry for entry in self.index.entries(account_id)
+                       if entry['runId'] in runs and entry['first'] < archived_until and
+                       (not start or entry['last'] >= start) and (not end or entry['first'] <= end)),
+                      key=lambda entry: entry['first'])
+
+    def read(self, account_id, start=None, end=None, ascending=True, attributes=None):
+        """
+        Yields an account's archived items before archivedUntil, within inclusive txTime bounds, in txTime order.
+        Files are read lazily, so a reader stopping after one page only reads the files of that page.
+        """
+
+        archived_until = self.archived_until()
+        entries = self.entries(account_id, start, end)
+        groups = list(overlapping_groups(entries))
+        if not ascending:
+            groups.reverse()
+
+        for group in groups:
+            items = []
+            for entry in group:
+                data = self.sink.read(entry['file'])
+                if data is None:
+                    raise FileNotFoundError(f"Archive file {entry['file']} is missing")
+                items.extend(item for item in select_rows(decode_columns(data), account_id, start, end, attributes)
+                             if item['txTime'] < archived_until)
+            items.sort(key=lambda item: item['txTime'], reverse=not ascending)
+            yield from items
+
+
+def archive_from_environment():
+    """
+    Returns the HistoryArchive in ARCHIVE_BUCKET, indexed in ARCHIVE_INDEX_TABLE_NAME, under ARCHIVE_DIR when no
+    bucket is configured, or None when the history is not archived
+    """
+
+    if ARCHIVE_BUCKET:
+        return HistoryArchive(S3Sink(ARCHIVE_BUCKET), DynamoDBArchiveIndex(ARCHIVE_INDEX_TABLE_NAME))
+    if ARCHIVE_DIR:
+        sink = LocalFileSink(ARCHIVE_DIR)
+        return HistoryArchive(sink, SinkArchiveIndex(sink))
+    return None
+
+
+def scan_history(table, until):
+    """
+    Yields the items of the transactions table with txTime < until, reading the whole table
+    """
+
+    scan_arguments = {'FilterExpression': Attr('txTime').lt(until)}
+    while True:
+        response = table.scan(**scan_arguments)
+        yield from response['Items']
+        if 'LastEvaluatedKey' not in response:
+            return
+        scan_arguments['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+
+def days_between(since, until):
+    day = date.fromisoformat(since[:10])
+    last = date.fromisoformat(until[:10])
+    while day <= last:
+        yield day.isoformat()
+        day += timedelta(days=1)
+
+
+def get_items(dynamodb, table_name, keys, max_attempts=BATCH_GET_ATTEMPTS):
+    """
+    Reads items by key with BatchGetItem, retrying the keys it leaves unprocessed with a growing delay.
+    Items deleted in the meantime are skipped.
+    Raises RuntimeError if some keys are still unprocessed after max_attempts
+    """
+
+    for position in range(0, len(keys), BATCH_GET_KEYS):
+        request_items = {table_name: {'Keys': keys[position:position + BATCH_GET_KEYS]}}
+        for attempt in range(max_attempts):
+            if attempt:
+                time.sleep(min(0.05 * 2 ** attempt, 2))
+            response = dynamodb.batch_get_item(RequestItems=request_items)
+            yield from response['Responses'].get(table_name, [])
+            request_items = response.get('UnprocessedKeys')
+            if not request_items:
+                break
+        else:
+            raise RuntimeError(f"{len(request_items[table_name]['Keys'])} items of {table_name} left unprocessed")
+
+
+def indexed_history(dynamodb, table, since, until, shards=DAY_SHARDS):
+    """
+    Yields the items of the transactions table with since <= txTime < until, one day index query per day and
+    shard, so a run only reads the days it archives. The index only holds the keys: the items are read from the
+    table by key.
+    """
+
+    for day in days_between(since, until):
+        for shard in range(shards):
+            query_arguments = {
+                'IndexName': DAY_INDEX_NAME,
+                'KeyConditionExpression': Key(DAY_SHARD_ATTRIBUTE).eq(f"{day}#{shard:02d}") &
+                Key('txTime').between(since, until)
+            }
+            while True:
+                response = table.query(**query_arguments)
+                keys = [{attribute: item[attribute] for attribute in KEY_ATTRIBUTES}
+                        for item in response['Items'] if item['txTime'] < until]
+                yield from get_items(dynamodb, table.name, keys)
+                if 'LastEvaluatedKey' not in response:
+                    break
+                query_arguments['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+
+def archive_history(table, archive, until, max_buffered_items=MAX_BUFFERED_ITEMS, dynamodb=None):
+    """
+    Copies the history items with txTime between the previous archivedUntil and until into the archive,
+    then moves archivedUntil to until. Items stay in DynamoDB until their TTL deletes them, so until must be
+    earlier than the expiry of the newest item to archive. The first run scans the table, the next ones read
+    the day index.
+    Files are written first, then the index entries, and the state last: a run that fails leaves archivedUntil
+    unchanged and its run id out of the completed runs, so readers ignore its entries and the next run archives
+    the same items again.
+    Returns:
+       The counts of archived items and written files
+    """
+
+    state = archive.state()
+    since = state.get('archivedUntil')
+    if since and until <= since:
+        logger.info(f"History is already archived until {since}")
+        return {'items': 0, 'files': 0, 'archivedUntil': since}
+
+    run_id = f"{time.strftime('%Y%m%dT%H%M%SZ', time.gmtime())}-{uuid.uuid4().hex[:8]}"
+    buffer = {}
+    counters = {'items': 0, 'files': 0, 'bytes': 0, 'entries': 0}
+
+    def flush():
+        for (partition, month), items in buffer.items():
+            key = file_key(partition, month, run_id, counters['files'])
+            _, bytes_written = write_chunks(archive.sink, key, [encode_columns(items)])
+            counters['files'] += 1
+            counters['bytes'] += bytes_written
+
+            accounts = {}
+            for item in items:
+                first, last, count = accounts.get(item['accountId'], (item['txTime'], item['txTime'], 0))
+                accounts[item['accountId']] = (min(first, item['txTime']), max(last, item['txTime']), count + 1)
+            archive.index.add({'accountId': account_id, 'file': key, 'runId': run_id, 'first': first, 'last': last,
+                               'count': count} for account_id, (first, last, count) in accounts.items())
+            counters['entries'] += len(accounts)
+        buffer.clear()
+
+    if since:
+        items = indexed_history(dynamodb or clients.dynamodb(), table, since, until)
+    else:
+        items = scan_history(table, until)
+    buffered = 0
+    for item in items:
+        partition = account_partition(item['accountId'], archive.partitions)
+        buffer.setdefault((partition, item['txTime'][:7]), []).append(item)
+        counters['items'] += 1
+        buffered += 1
+        if buffered >= max_buffered_items:
+            flush()
+            buffered = 0
+    flush()
+
+    archive.write_state({'archivedUntil': until, 'runId': run_id, 'runs': state.get('runs', []) + [run_id]})
+    logger.info(f"Archived {counters['items']} items in {counters['files']} files ({counters['bytes']} bytes, "
+                f"{counters['entries']} index entries) until {until}")
+
+    return dict(counters, archivedUntil=until)
+
+
+def query_merged_history(table, archive, account_id, start=None, end=None, limit=100, ascending=True,
+                         attributes=None, start_key=None, max_bytes=MAX_PAGE_BYTES):
+    """
+    Reads one page of an account's history like query_history, taking the items before archivedUntil from
+    the archive and the later ones from DynamoDB. The archive is only read when the requested range reaches
+    before archivedUntil, and the continuation key tells which of the two sources the next page starts in.
+    Returns:
+       (items, last_key): last_key is None once there are no more items
+    """
+
+    archived_until = archive.archived_until() if archive else None
+    if not archived_until or (start and start >= archived_until):
+        return query_history(table, account_id, start=start, end=end, limit=limit, ascending=ascending,
+                             attributes=attributes, start_key=start_key, max_bytes=max_bytes)
+
+    live_start = max(start, archived_until) if start else archived_until
+    live_range = not end or end >= live_start
+    in_archive = start_key is not None and start_key['txTime'] < archived_until
+    items = []
+    page_bytes = 0
+
+    def query_live(page_limit):
+        return query_history(table, account_id, start=live_start, end=end, limit=page_limit, ascending=ascending,
+                             attributes=attributes, start_key=None if in_archive else start_key,
+                             max_bytes=max_bytes - page_bytes)
+
+    if ascending and start_key and not in_archive:
+        return query_live(limit) if live_range else ([], None)
+
+    # Descending pages read DynamoDB first, ascending pages the archive
+    if not ascending and not in_archive and live_range:
+        items, last_key = query_live(limit)
+        if last_key:
+            return items, last_key
+        page_bytes = sum(len(json.dumps(item, cls=DecimalEncoder)) for item in items)
+
+    for item in archive.read(account_id, start=start, end=end, ascending=ascending, attributes=attributes):
+        if in_archive and (item['txTime'] <= start_key['txTime'] if ascending
+                           else item['txTime'] >= start_key['txTime']):
+            continue
+        item_bytes = len(json.dumps(item, cls=DecimalEncoder))
+        if len(items) >= limit or (items and page_bytes + item_bytes > max_bytes):
+            return items, item_key(items[-1])
+        items.append(item)
+        page_bytes += item_bytes
+
+    if ascending and live_range:
+        if len(items) >= limit:
+            return items, item_key(items[-1])
+        live_items, last_key = query_live(limit - len(items))
+        return items + live_items, last_key
+
+    return items, None
+
+
+def account_buckets(table, archive, account_id, refresh=False):
+    """
+    Returns the number of buckets of an account, as remembered by this container or read from its latest revision.
+    The number of buckets only grows, so it covers every bucket the account ever had.
+    """
+
+    buckets = None if refresh else bucket_counts.get(account_id)
+    if buckets is None:
+        items, _ = query_merged_history(table, archive, account_id, limit=1, ascending=False, attributes=['buckets'])
+        buckets = int(items[0].get('buckets') or 1) if items else 1
+        bucket_counts.set(account_id, buckets)
+    return buckets
+
+
+def unsharded_page(items):
+    """
+    Tells whether a page of an account document's own history is the page of the whole account. The revision that
+    shards an account sets its buckets attribute, which every later revision keeps, and the buckets only have items
+    from that revision on: a non-empty page without the attribute cannot have bucket items between its own.
+    """
+
+    return bool(items) and all(int(item.get('buckets') or 1) == 1 for item in items)
+
+
+def bucket_bounds(bucket, bucket_id, start, end, ascending, start_key, position):
+    """
+    Returns the (start, end, start_key) of one bucket's query resuming after the item of bucket position at
+    start_key, in the order of txTime then bucket, or its reverse for descending pages
+    """
+
+    if start_key is None:
+        return start, end, None
+    tx_time = start_key['txTime']
+    # Buckets up to the last item's bucket in page order resume after its txTime, the others at its txTime
+    if bucket <= position if ascending else bucket >= position:
+        return start, end, {'accountId': bucket_id, 'txTime': tx_time}
+    if ascending:
+        return max(start, tx_time) if start else tx_time, end, None
+    return start, min(end, tx_time) if end else tx_time, None
+
+
+def query_account_history(table, archive, account_id, start=None, end=None, limit=100, ascending=True,
+                          attributes=None, start_key=None, max_bytes=MAX_PAGE_BYTES):
+    """
+    Reads one page of an account's history like query_merged_history. For a sharded account, the histories of
+    all its buckets are merged in the order of txTime then bucket, each bucket item keeping the accountId of
+    its bucket, its bucketOf attribute and the balance of its bucket. A page of a sharded account costs one
+    query per bucket, and the continuation key holds the accountId of the bucket of the last item.
+    The number of buckets is only read when this container does not know it and the account document's own page
+    does not tell, so a page of an account that is not sharded costs the queries of that page alone.
+    Returns:
+       (items, last_key): last_key is None once there are no more items
+    """
+
+    buckets = bucket_counts.get(account_id)
+    on_bucket = start_key is not None and start_key['accountId'] != account_id
+    if buckets is None and not on_bucket:
+        page_attributes = attributes + ['buckets'] if attributes and 'buckets' not in attributes else attributes
+        items, last_key = query_merged_history(table, archive, account_id, start=start, end=end, limit=limit,
+                                               ascending=ascending, attributes=page_attributes, start_key=start_key,
+                                               max_bytes=max_bytes)
+        if unsharded_page(items) or account_buckets(table, archive, account_id) == 1:
+            if page_attributes is not attributes:
+                for item in items:
+                    item.pop('buckets', None)
+            return items, last_key
+        buckets = bucket_counts.get(account_id)
+    elif buckets is None:
+        buckets = account_buckets(table, archive, account_id)
+
+    if buckets == 1 and not on_bucket:
+        return query_merged_history(table, archive, account_id, start=start, end=end, limit=limit,
+                                    ascending=ascending, attributes=attributes, start_key=start_key,
+                                    max_bytes=max_bytes)
+
+    bucket_ids = bucket_account_ids(account_id, buckets)
+    if on_bucket and start_key['accountId'] not in bucket_ids:
+        # The account may have been sharded again since this container read its number of buckets
+        bucket_ids = bucket_account_ids(account_id, account_buckets(table, archive, account_id, refresh=True))
+    if start_key is not None and start_key['accountId'] not in bucket_ids:
+        raise BadRequest('Invalid nextToken')
+    position = bucket_ids.index(start_key['accountId']) if start_key else None
+
+    candidates = []
+    more = False
+    for bucket, bucket_id in enumerate(bucket_ids):
+        bucket_start, bucket_end, bucket_key = bucket_bounds(bucket, bucket_id, start, end, ascending, start_key,
+                                                             position)
+        bucket_items, last_key = query_merged_history(table, archive, bucket_id, start=bucket_start, end=bucket_end,
+                                                      limit=limit, ascending=ascending, attributes=attributes,
+                                                      start_key=bucket_key, max_bytes=max_bytes)
+        candidates.extend(((item['txTime'], bucket), item) for item in bucket_items)
+        more = more or last_key is not None
+
+    candidates.sort(key=lambda candidate: candidate[0], reverse=not ascending)
+    items = []
+    page_bytes = 0
+    for _, item in candidates:
+        item_bytes = len(json.dumps(item, cls=DecimalEncoder))
+        if len(items) >= limit or (items and page_bytes + item_bytes > max_bytes):
+            return items, item_key(items[-1])
+        items.append(item)
+        page_bytes += item_bytes
+
+    return items, item_key(items[-1]) if more and items else None
@@ -0,0 +1,118 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import datetime
+import logging
+import time
+from wallet_core.accounts import bucket_account_ids
+from wallet_core.archive import query_merged_history
+from wallet_core.errors import BadRequest, WalletError
+
+logger = logging.getLogger()
+
+
+class BalanceNotFound(WalletError):
+    http_status_code = 400
+
+    def __init__(self, account_id, at):
+        super().__init__(f"No balance of account {account_id} at or before {at}")
+
+
+def read_balance_view(table, account_id):
+    """
+    Reads the current balance item maintained by lambda_stream_transactions for an account
+    Returns:
+       The item, or None if no revision of the account has been projected yet
+    """
+
+    logger.info(f"Reading balance view for account with id {account_id}")
+    return table.get_item(Key={'accountId': account_id}).get('Item')
+
+
+def read_bucket_views(dynamodb, table_name, account_id, buckets, max_attempts=3):
+    """
+    Reads the balance items of every bucket of a sharded account with BatchGetItem
+    Returns:
+       The items in bucket order, or None if some bucket is not projected yet or could not be read
+    """
+
+    bucket_ids = bucket_account_ids(account_id, buckets)
+    request_items = {table_name: {'Keys': [{'accountId': bucket_id} for bucket_id in bucket_ids]}}
+    items = {}
+
+    for _ in range(max_attempts):
+        response = dynamodb.batch_get_item(RequestItems=request_items)
+        for item in response['Responses'].get(table_name, []):
+            items[item['accountId']] = item
+        request_items = response.get('UnprocessedKeys')
+        if not request_items:
+            break
+
+    if len(items) < buckets:
+        logger.info(f"Only {len(items)} of {buckets} buckets of account {account_id} are projected")
+        return None
+
+    return [items[bucket_id] for bucket_id in bucket_ids]
+
+
+def staleness_seconds(item, now=None):
+    # Time since the projected revision was committed, an upper bound on how far the balance may lag the ledger
+    now = time.time() if now is None else now
+    return max(0, int(now) - int(item['timestamp']))
+
+
+def history_time(value, name='at'):
+    """
+    Converts an ISO 8601 time to the text of the txTime sort key: UTC with millisecond precision,
+    e.g. 2021-03-18T17:06:42.123Z. Times without an offset are taken as UTC.
+    """
+
+    if not isinstance(value, str):
+        raise BadRequest(f"{name} must be an ISO 8601 time")
+    try:
+        parsed = datetime.datetime.fromisoformat(value[:-1] + '+00:00' if value.endswith('Z') else value)
+    except ValueError:
+        raise BadRequest(f"{name} must be an ISO 8601 time")
+
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(datetime.timezone.utc)
+    return parsed.strftime('%Y-%m-%dT%H:%M:%S.') + f"{parsed.microsecond // 1000:03d}Z"
+
+
+def revision_at(table, archive, account_id, at):
+    # The latest revision at or before the time, with one Limit=1 descending query on the history
+    items, _ = query_merged_history(table, archive, account_id, end=at, limit=1, ascending=False,
+                                    attributes=['balance', 'buckets', 'txId'])
+    return items[0] if items else None
+
+
+def balance_at(table, archive, account_id, at):
+    """
+    Reads the balance of an account at a point in time from the history projected by lambda_stream_transactions,
+    where every item holds the balance after its revision. Sharded accounts add the balance of each bucket at
+    that time, buckets without a revision yet counting for zero.
+    Parameters:
+       table: boto3 DynamoDB Table resource of the transactions table
+       archive: HistoryArchive holding the history removed by the TTL, or None
+       account_id (string): The account
+       at (string): Time in the format of history_time
+    Returns:
+       The balance with the txTime and txId of the latest revision it includes
+    """
+
+    item = revision_at(table, archive, account_id, at)
+    if item is None or 'balance' not in item:
+        raise BalanceNotFound(account_id, at)
+
+    return_message = {'accountId': account_id, 'at': at, 'balance': item['balance']}
+    buckets = int(item.get('buckets') or 1)
+    if buckets > 1:
+        bucket_items = [bucket_item for bucket_item in (revision_at(table, archive, bucket_id, at)
+                                                        for bucket_id in bucket_account_ids(account_id, buckets)[1:])
+                        if bucket_item and 'balance' in bucket_item]
+        return_message['balance'] += sum(bucket_item['balance'] for bucket_item in bucket_items)
+        return_message['buckets'] = buckets
+        item = max([item] + bucket_items, key=lambda bucket_item: bucket_item['txTime'])
+
+    return_message.update({'txTime': item['txTime'], 'txId': item.get('txId')})
+    return return_message
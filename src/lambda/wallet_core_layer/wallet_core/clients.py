@@ -0,0 +1,47 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import logging
+import time
+
+logger = logging.getLogger()
+
+# Clients are created on first use and shared by every handler running in the container,
+# so a cold start only pays for the clients the first request needs
+_clients = {}
+# Milliseconds spent creating each client, reported by the router
+init_timings = {}
+
+
+def _get_or_create(name, factory):
+    client = _clients.get(name)
+    if client is None:
+        started = time.perf_counter()
+        client = factory()
+        init_timings[name] = round((time.perf_counter() - started) * 1000, 1)
+        logger.info(f"Created {name} in {init_timings[name]} ms")
+        _clients[name] = client
+    return client
+
+
+def qldb_driver():
+    from wallet_core.qldb import create_qldb_driver
+    return _get_or_create('qldb_driver', create_qldb_driver)
+
+
+def client(service_name):
+    def factory():
+        import boto3
+        return boto3.client(service_name)
+    return _get_or_create(f"client:{service_name}", factory)
+
+
+def dynamodb():
+    def factory():
+        import boto3
+        return boto3.resource('dynamodb')
+    return _get_or_create('dynamodb', factory)
+
+
+def table(table_name):
+    return _get_or_create(f"table:{table_name}", lambda: dynamodb().Table(table_name))
@@ -0,0 +1,313 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import decimal
+import json
+import logging
+import random
+import time
+import uuid
+from collections import OrderedDict, deque
+from wallet_core.accounts import AccountRepository, bucket_account_id
+from wallet_core.errors import AccountNotFound, DuplicateAccount, WalletError
+from wallet_core.qldb import MAX_DOCUMENTS_PER_TRANSACTION
+
+logger = logging.getLogger()
+
+PENDING = 'pending'
+SETTLED = 'settled'
+REJECTED = 'rejected'
+
+
+class CreditNotFound(WalletError):
+    http_status_code = 400
+
+    def __init__(self, credit_id):
+        super().__init__(f"Credit {credit_id} not found")
+
+
+def credit_message(credit):
+    # Amounts travel as strings so they are not rounded through float
+    return json.dumps({'creditId': credit['creditId'], 'accountId': credit['accountId'],
+                       'amount': str(credit['amount'])})
+
+
+def parse_credit_message(body):
+    credit = json.loads(body)
+    credit['amount'] = decimal.Decimal(credit['amount'])
+    return credit
+
+
+class InProcessCreditQueue:
+    """
+    In-process stand-in for the SQS credit queue
+    """
+
+    def __init__(self):
+        self._messages = deque()
+
+    def send(self, credit):
+        self._messages.append({'messageId': uuid.uuid4().hex, 'body': credit_message(credit)})
+
+    def receive(self, max_messages=100):
+        messages = []
+        while self._messages and len(messages) < max_messages:
+            messages.append(self._messages.popleft())
+        return messages
+
+
+class SqsCreditQueue:
+    def __init__(self, queue_url, sqs=None):
+        self.queue_url = queue_url
+        if sqs is None:
+            import boto3
+            sqs = boto3.client('sqs')
+        self.sqs = sqs
+
+    def send(self, credit):
+        self.sqs.send_message(QueueUrl=self.queue_url, MessageBody=credit_message(credit))
+
+
+class InMemoryCreditStatusStore:
+    """
+    In-process stand-in for the DynamoDB credit status table
+    """
+
+    def __init__(self):
+        self._credits = {}
+
+    def put_pending(self, credit):
+        if credit['creditId'] in self._credits:
+            return False
+        self._credits[credit['creditId']] = dict(credit)
+        return True
+
+    def get(self, credit_id):
+        return self._credits.get(credit_id)
+
+    def update_status(self, credit_ids, status, **fields):
+        for credit_id in credit_ids:
+            self._credits.setdefault(credit_id, {'creditId': credit_id}).update(status=status, **fields)
+
+
+class DynamoDBCreditStatusStore:
+    def __init__(self, table):
+        self.table = table
+
+    def put_pending(self, credit):
+        """
+        Records a new pending credit
+        Returns:
+           False if a credit with the same id was already accepted
+        """
+
+        try:
+            self.table.put_item(Item=credit, ConditionExpression='attribute_not_exists(creditId)')
+        except self.table.meta.client.exceptions.ConditionalCheckFailedException:
+            return False
+        return True
+
+    def get(self, credit_id):
+        return self.table.get_item(Key={'creditId': credit_id}).get('Item')
+
+    def update_status(self, credit_ids, status, **fields):
+        updates = dict(fields, status=status)
+        names = {f"#f{position}": name for position, name in enumerate(updates)}
+        values = {f":v{position}": value for position, value in enumerate(updates.values())}
+        expression = 'SET ' + ', '.join(f"{name} = :v{position}" for position, name in enumerate(names))
+
+        for credit_id in credit_ids:
+            self.table.update_item(Key={'creditId': credit_id}, UpdateExpression=expression,
+                                   ExpressionAttributeNames=names, ExpressionAttributeValues=values)
+
+
+def accept_credit(queue, status_store, account_id, amount, credit_id=None):
+    """
+    Accepts a credit for asynchronous settlement. Client-provided credit ids make retries idempotent.
+    A retry of a credit that is still pending queues it again, in case the first attempt failed after recording
+    it; settlement applies a credit at most once, so the credit is never applied twice.
+    Returns:
+       The pending credit, or the current state of a credit that was already accepted
+    """
+
+    credit = {
+        'creditId': credit_id or uuid.uuid4().hex,
+        'accountId': account_id,
+        'amount': amount,
+        'status': PENDING,
+        'acceptedAt': int(time.time())
+    }
+
+    if not status_store.put_pending(credit):
+        logger.info(f"Credit {credit['creditId']} was already accepted")
+        credit = status_store.get(credit['creditId'])
+        if credit and credit.get('status') == PENDING:
+            queue.send(credit)
+        return credit
+
+    queue.send(credit)
+    return credit
+
+
+def get_credit(status_store, credit_id):
+    credit = status_store.get(credit_id)
+    if not credit:
+        raise CreditNotFound(credit_id)
+    return credit
+
+
+def group_by_account(credits):
+    groups = OrderedDict()
+    for credit in credits:
+        groups.setdefault(credit['accountId'], []).append(credit)
+    return groups
+
+
+def chunk_groups(groups, max_documents=MAX_DOCUMENTS_PER_TRANSACTION):
+    """
+    Splits the credits grouped by account into transactions writing at most max_documents documents: one per
+    account and one per settled credit. The credits of an account that do not fit one transaction are split
+    across several.
+    """
+
+    credits_per_transaction = max_documents - 1
+    chunk = OrderedDict()
+    documents = 0
+    for account_id, credits in groups.items():
+        for start in range(0, len(credits), credits_per_transaction):
+            part = credits[start:start + credits_per_transaction]
+            if chunk and (account_id in chunk or documents + 1 + len(part) > max_documents):
+                yield chunk
+                chunk = OrderedDict()
+                documents = 0
+            chunk[account_id] = part
+            documents += 1 + len(part)
+
+    if chunk:
+        yield chunk
+
+
+def settled_credit_ids(executor, credits_table_name, credit_ids):
+    """
+    Returns the ids, among credit_ids, of the credits already settled, read within the current transaction.
+    The read goes through the creditId index, so a concurrent settlement of the same credit fails with an
+    OCC conflict.
+    """
+
+    placeholders = ', '.join('?' for _ in credit_ids)
+    cursor = executor.execute_statement(
+        f"SELECT creditId FROM \"{credits_table_name}\" WHERE creditId IN ({placeholders})", *credit_ids)
+    return {doc['creditId'] for doc in cursor}
+
+
+def record_settled_credits(executor, credits_table_name, credits):
+    docs = [{'creditId': credit['creditId'], 'accountId': credit['accountId'], 'amount': credit['amount']}
+            for credit in credits]
+    placeholders = ', '.join('?' for _ in docs)
+    executor.execute_statement(f"INSERT INTO \"{credits_table_name}\" << {placeholders} >>", *docs)
+
+
+def apply_credit_groups(repository, credits_table_name, groups):
+    """
+    Applies the sum of each account's credits with one UPDATE per account, within the current transaction.
+    Every settled credit is recorded with its own document in the credits table of the ledger, in the same
+    transaction, and credits already recorded there, i.e. redelivered after their settlement, are skipped.
+    The applied credits are also listed in the updated document, so every deposit shows in its projected revision.
+    The credits of a sharded account go to one random bucket, read with the buckets of the other accounts in a
+    single statement.
+    Returns:
+       (settled, rejected): lists of (credit, message) tuples, message being None for settled credits
+    """
+
+    executor = repository.executor
+    docs, duplicates = repository.get_many(list(groups))
+    picked = {account_id: random.randrange(repository.remember_buckets(account_id, doc))
+              for account_id, doc in docs.items() if account_id not in duplicates}
+    bucket_docs = repository.get_bucket_docs(docs, {account_id: [bucket] for account_id, bucket in picked.items()})
+    applied_ids = settled_credit_ids(executor, credits_table_name,
+                                     [credit['creditId'] for credits in groups.values() for credit in credits])
+    settled = []
+    rejected = []
+    new_credits = []
+
+    for account_id, credits in groups.items():
+        if account_id in duplicates or account_id not in docs:
+            error = DuplicateAccount(account_id) if account_id in duplicates else AccountNotFound(account_id)
+            rejected.extend((credit, error.message) for credit in credits)
+            continue
+
+        settled.extend((credit, None) for credit in credits if credit['creditId'] in applied_ids)
+        account_credits = [credit for credit in credits if credit['creditId'] not in applied_ids]
+        if not account_credits:
+            continue
+
+        bucket = picked[account_id]
+        balance = bucket_docs[account_id][bucket]['balance'] + sum(credit['amount'] for credit in account_credits)
+        repository.set_balance(bucket_account_id(account_id, bucket), balance,
+                               applied_credits=[{'creditId': credit['creditId'], 'amount': credit['amount']}
+                                                for credit in account_credits])
+        settled.extend((credit, None) for credit in account_credits)
+        new_credits.extend(account_credits)
+
+    if new_credits:
+        record_settled_credits(executor, credits_table_name, new_credits)
+
+    return settled, rejected
+
+
+def settle_credits(qldb_driver, table_name, credits_table_name, status_store, credits):
+    """
+    Settles credits, grouped by account, in transactions of up to MAX_DOCUMENTS_PER_TRANSACTION documents.
+    A credit delivered more than once in the batch is settled once.
+    Returns:
+       The credits of the transactions that failed, to be retried
+    """
+
+    failed = []
+    pending = OrderedDict()
+    for credit in credits:
+        if credit['creditId'] in pending:
+            logger.info(f"Credit {credit['creditId']} is delivered more than once")
+            continue
+        state = status_store.get(credit['creditId'])
+        if state and state.get('status') in (SETTLED, REJECTED):
+            logger.info(f"Credit {credit['creditId']} is already {state['status']}")
+            continue
+        pending[credit['creditId']] = credit
+
+    for groups in chunk_groups(group_by_account(pending.values())):
+        try:
+            settled, rejected = qldb_driver.execute_lambda(
+                lambda executor: apply_credit_groups(AccountRepository(executor, table_name), credits_table_name,
+                                                     groups))
+        except Exception as e:
+            logger.error(f"Error settling credits of {len(groups)} accounts: {e}")
+            failed.extend(credit for credits in groups.values() for credit in credits)
+            continue
+
+        settled_at = int(time.time())
+        status_store.update_status([credit['creditId'] for credit, _ in settled], SETTLED, settledAt=settled_at)
+        for credit, message in rejected:
+            logger.error(f"Credit {credit['creditId']} rejected: {message}")
+            status_store.update_status([credit['creditId']], REJECTED, message=message)
+
+        logger.info(f"Settled {len(settled)} credits for {len(groups)} accounts, rejected {len(rejected)}")
+
+    return failed
+
+
+def settle_in_process(queue, qldb_driver, table_name, credits_table_name, status_store, max_messages=100):
+    """
+    Drains an InProcessCreditQueue, the local stand-in for the SQS-triggered settlement function
+    """
+
+    while True:
+        messages = queue.receive(max_messages)
+        if not messages:
+            return
+        failed = settle_credits(qldb_driver, table_name, credits_table_name, status_store,
+                                [parse_credit_message(message['body']) for message in messages])
+        for credit in failed:
+            queue.send(credit)
+        if failed:
+            return
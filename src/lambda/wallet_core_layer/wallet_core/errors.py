@@ -0,0 +1,58 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+
+class WalletError(Exception):
+    """
+    Error returned to the API caller with its message and HTTP status code
+    """
+
+    http_status_code = 500
+
+    def __init__(self, message, http_status_code=None, details=None):
+        super().__init__(message)
+        self.message = message
+        # Additional fields returned in the error response body
+        self.details = details or {}
+        if http_status_code:
+            self.http_status_code = http_status_code
+
+
+class BadRequest(WalletError):
+    http_status_code = 400
+
+
+class AccountNotFound(WalletError):
+    http_status_code = 400
+
+    def __init__(self, account_id):
+        super().__init__(f"Account {account_id} not found")
+
+
+class AccountAlreadyExists(WalletError):
+    http_status_code = 400
+
+    def __init__(self, account_id):
+        super().__init__(f"Account with user id {account_id} already exists")
+
+
+class DuplicateAccount(WalletError):
+    http_status_code = 500
+
+    def __init__(self, account_id):
+        super().__init__(f"More than one account with user id {account_id}")
+
+
+class InsufficientFunds(WalletError):
+    http_status_code = 400
+
+    def __init__(self, account_id, amount):
+        super().__init__(f"Funds too low. Cannot deduct {amount} from account {account_id}")
+
+
+class RetryBudgetExhausted(WalletError):
+    http_status_code = 503
+
+    def __init__(self, attempts, conflicts):
+        super().__init__(f"Transaction failed after {attempts} attempts ({conflicts} OCC conflicts), "
+                         f"no time left to retry", details={'attempts': attempts, 'conflicts': conflicts})
@@ -0,0 +1,81 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import json
+import logging
+import time
+import uuid
+from wallet_core.archive import query_account_history
+from wallet_core.responses import DecimalEncoder
+from wallet_core.sinks import write_chunks
+
+logger = logging.getLogger()
+
+EXPORT_PAGE_SIZE = 1000
+EXPORT_CHUNK_BYTES = 1024 * 1024
+
+
+def iter_history(table, account_id, start=None, end=None, page_size=EXPORT_PAGE_SIZE, archive=None):
+    """
+    Yields every history item of an account, archived items and buckets included, one page of page_size items
+    in memory at a time
+    """
+
+    start_key = None
+    while True:
+        items, start_key = query_account_history(table, archive, account_id, start=start, end=end, limit=page_size,
+                                                 start_key=start_key)
+        yield from items
+        if not start_key:
+            return
+
+
+def ndjson_lines(items):
+    for item in items:
+        yield (json.dumps(item, cls=DecimalEncoder) + '\n').encode('utf-8')
+
+
+def buffered(lines, chunk_bytes=EXPORT_CHUNK_BYTES):
+    """
+    Joins lines into chunks of about chunk_bytes, so the sink is written in few, bounded calls
+    """
+
+    chunk = []
+    size = 0
+    for line in lines:
+        chunk.append(line)
+        size += len(line)
+        if size >= chunk_bytes:
+            yield b''.join(chunk)
+            chunk = []
+            size = 0
+
+    if chunk:
+        yield b''.join(chunk)
+
+
+def export_key(account_id):
+    return f"exports/{account_id}/{time.strftime('%Y%m%dT%H%M%SZ', time.gmtime())}-{uuid.uuid4().hex}.ndjson"
+
+
+def export_history(table, sink, account_id, start=None, end=None, archive=None):
+    """
+    Streams an account's history to the sink as NDJSON, one item per line, with memory use bounded by one
+    query page and one output chunk regardless of the history size
+    Returns:
+       The location of the export and the number of items and bytes written
+    """
+
+    counter = {'items': 0}
+
+    def counted(items):
+        for item in items:
+            counter['items'] += 1
+            yield item
+
+    key = export_key(account_id)
+    items = counted(iter_history(table, account_id, start=start, end=end, archive=archive))
+    location, bytes_written = write_chunks(sink, key, buffered(ndjson_lines(items)))
+    logger.info(f"Exported {counter['items']} items ({bytes_written} bytes) for {account_id} to {location}")
+
+    return {'location': location, 'url': sink.url(key), 'items': counter['items'], 'bytes': bytes_written}
@@ -0,0 +1,111 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import base64
+import binascii
+import json
+import logging
+from boto3.dynamodb.conditions import Key
+from wallet_core.accounts import BUCKET_SEPARATOR
+from wallet_core.errors import BadRequest
+from wallet_core.responses import DecimalEncoder
+
+logger = logging.getLogger()
+
+KEY_ATTRIBUTES = ('accountId', 'txTime')
+# Leaves headroom below the 6 MB Lambda response payload limit
+MAX_PAGE_BYTES = 5 * 1024 * 1024
+
+
+def encode_token(key):
+    return base64.urlsafe_b64encode(json.dumps(key, cls=DecimalEncoder).encode('utf-8')).decode('ascii')
+
+
+def decode_token(token, account_id):
+    """
+    Decodes a continuation token and checks it was issued for the same account, or one of its buckets
+    """
+
+    try:
+        key = json.loads(base64.urlsafe_b64decode(token.encode('ascii')))
+    except (AttributeError, binascii.Error, UnicodeError, ValueError):
+        raise BadRequest('Invalid nextToken')
+
+    if not isinstance(key, dict) or set(key) != set(KEY_ATTRIBUTES) or not isinstance(key['accountId'], str) or \
+            key['accountId'].split(BUCKET_SEPARATOR)[0] != account_id:
+        raise BadRequest('Invalid nextToken')
+
+    return key
+
+
+def key_condition(account_id, start=None, end=None):
+    """
+    Builds the key condition for an account's history, optionally bounded by inclusive txTime values
+    """
+
+    condition = Key('accountId').eq(account_id)
+    if start and end:
+        return condition & Key('txTime').between(start, end)
+    if start:
+        return condition & Key('txTime').gte(start)
+    if end:
+        return condition & Key('txTime').lte(end)
+    return condition
+
+
+def projection_arguments(attributes):
+    # Key attributes are always returned, so a continuation key can be built from the last item
+    attributes = list(dict.fromkeys(list(KEY_ATTRIBUTES) + list(attributes)))
+    names = {f"#a{position}": attribute for position, attribute in enumerate(attributes)}
+
+    return {'ProjectionExpression': ', '.join(names), 'ExpressionAttributeNames': names}
+
+
+def item_key(item):
+    return {attribute: item[attribute] for attribute in KEY_ATTRIBUTES}
+
+
+def query_history(table, account_id, start=None, end=None, limit=100, ascending=True, attributes=None,
+                  start_key=None, max_bytes=MAX_PAGE_BYTES):
+    """
+    Reads one page of an account's history. Queries are repeated until the page holds limit items,
+    the partition or range is exhausted, or the serialized page would exceed max_bytes.
+    Parameters:
+       table: boto3 DynamoDB Table resource of the transactions table
+       account_id (string): The account
+       start, end (string): Optional inclusive txTime bounds
+       limit (int): Maximum number of items in the page
+       ascending (bool): Sort order on txTime
+       attributes (list): Attributes to return, or None for all attributes
+       start_key (dict): Key of the last item of the previous page
+       max_bytes (int): Maximum size of the serialized items
+    Returns:
+       (items, last_key): last_key is None once there are no more items
+    """
+
+    query_arguments = {
+        'KeyConditionExpression': key_condition(account_id, start, end),
+        'ScanIndexForward': ascending
+    }
+    if attributes:
+        query_arguments.update(projection_arguments(attributes))
+
+    items = []
+    page_bytes = 0
+
+    while True:
+        query_arguments['Limit'] = limit - len(items)
+        if start_key:
+            query_arguments['ExclusiveStartKey'] = start_key
+
+        response = table.query(**query_arguments)
+        for item in response['Items']:
+            item_bytes = len(json.dumps(item, cls=DecimalEncoder))
+            if items and page_bytes + item_bytes > max_bytes:
+                return items, item_key(items[-1])
+            items.append(item)
+            page_bytes += item_bytes
+
+        start_key = response.get('LastEvaluatedKey')
+        if not start_key or len(items) >= limit:
+            return items, start_key
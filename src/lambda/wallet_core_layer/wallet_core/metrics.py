@@ -0,0 +1,172 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import json
+import logging
+import os
+import re
+import time
+
+logger = logging.getLogger()
+
+METRICS_NAMESPACE = os.getenv('METRICS_NAMESPACE', 'ServerlessWallet')
+# CloudWatch accepts at most 100 values per metric in one embedded metric format document
+MAX_VALUES_PER_DOCUMENT = 100
+
+PLACEHOLDER_LIST = re.compile(r'\?(\s*,\s*\?)+')
+WHITESPACE = re.compile(r'\s+')
+
+
+def statement_label(statement):
+    """
+    Label of a PartiQL statement used as metric dimension: lists of placeholders are collapsed,
+    so the same query with a different number of parameters has one label
+    """
+
+    return WHITESPACE.sub(' ', PLACEHOLDER_LIST.sub('?...', statement)).strip()
+
+
+class StdoutSink:
+    """
+    Prints embedded metric format documents on stdout, where Lambda forwards them to CloudWatch Logs
+    """
+
+    def emit(self, document):
+        print(json.dumps(document), flush=True)
+
+
+class LocalCollector:
+    """
+    Keeps embedded metric format documents in memory, for tests and local runs
+    """
+
+    def __init__(self):
+        self.documents = []
+
+    def emit(self, document):
+        self.documents.append(document)
+
+
+def emf_document(namespace, dimensions, metrics, timestamp_ms=None):
+    """
+    Builds an embedded metric format document
+    Parameters:
+       namespace (string): CloudWatch namespace
+       dimensions (dict): Dimension names and values
+       metrics (dict): Metric name to (unit, value or list of values)
+    """
+
+    document = {
+        '_aws': {
+            'Timestamp': timestamp_ms or int(time.time() * 1000),
+            'CloudWatchMetrics': [{
+                'Namespace': namespace,
+                'Dimensions': [list(dimensions)],
+                'Metrics': [{'Name': name, 'Unit': unit} for name, (unit, _) in metrics.items()]
+            }]
+        }
+    }
+    document.update(dimensions)
+    document.update({name: values for name, (_, values) in metrics.items()})
+    return document
+
+
+def cursor_read_ios(cursor):
+    # Consumed IOs and timing information are only available with pyqldb 3.1 and later
+    consumed_ios = getattr(cursor, 'get_consumed_ios', lambda: None)() or {}
+    return consumed_ios.get('ReadIOs')
+
+
+def cursor_processing_time_ms(cursor):
+    timing_information = getattr(cursor, 'get_timing_information', lambda: None)() or {}
+    return timing_information.get('ProcessingTimeMilliseconds')
+
+
+class InvocationMetrics:
+    """
+    Collects the QLDB statements of one invocation and emits them as embedded metric format documents,
+    one per statement label with the Handler and Statement dimensions:
+       StatementTime: Wall time of execute_statement, including the first page of results
+       ReadIOs: Read IOs consumed by the statement, all pages included
+       ProcessingTime: Server-side processing time reported by QLDB
+    The invocation's transaction, retry and OCC conflict counts are emitted with the Handler dimension.
+    """
+
+    def __init__(self, sink=None, namespace=METRICS_NAMESPACE):
+        self.sink = sink or StdoutSink()
+        self.namespace = namespace
+        self.begin_invocation('unknown')
+
+    def begin_invocation(self, handler):
+        self.handler = handler
+        self._statements = []
+
+    def record_statement(self, statement, wall_time_ms, cursor):
+        # The cursor is kept until the end of the invocation, as its consumed IOs grow while it is read
+        self._statements.append((statement_label(statement), wall_time_ms, cursor))
+
+    def statement_values(self):
+        """
+        Returns the values of every metric, keyed by statement label
+        """
+
+        values = {}
+        for label, wall_time_ms, cursor in self._statements:
+            metrics = values.setdefault(label, {'StatementTime': [], 'ReadIOs': [], 'ProcessingTime': []})
+            metrics['StatementTime'].append(round(wall_time_ms, 3))
+            read_ios = cursor_read_ios(cursor)
+            if read_ios is not None:
+                metrics['ReadIOs'].append(read_ios)
+            processing_time_ms = cursor_processing_time_ms(cursor)
+            if processing_time_ms is not None:
+                metrics['ProcessingTime'].append(processing_time_ms)
+        return values
+
+    def end_invocation(self, counters=None):
+        """
+        Emits the metrics of the invocation
+        Parameters:
+           counters (dict): Invocation counts, e.g. the transactions, retries and conflicts of the retry policy
+        """
+
+        try:
+            units = {'StatementTime': 'Milliseconds', 'ReadIOs': 'Count', 'ProcessingTime': 'Milliseconds'}
+            for label, metrics in self.statement_values().items():
+                for start in range(0, len(metrics['StatementTime']), MAX_VALUES_PER_DOCUMENT):
+                    chunk = {name: (units[name], values[start:start + MAX_VALUES_PER_DOCUMENT])
+                             for name, values in metrics.items() if values[start:start + MAX_VALUES_PER_DOCUMENT]}
+                    self.sink.emit(emf_document(self.namespace, {'Handler': self.handler, 'Statement': label},
+                                                chunk))
+
+            if counters and counters.get('transactions'):
+                self.sink.emit(emf_document(self.namespace, {'Handler': self.handler},
+                                            {name.capitalize(): ('Count', value) for name, value in counters.items()
+                                             if isinstance(value, int)}))
+        except Exception as e:
+            # Metrics never fail a request
+            logger.error(f"Error emitting metrics for {self.handler}: {e}")
+        finally:
+            self._statements = []
+
+
+class InstrumentedExecutor:
+    """
+    Transaction executor wrapper timing every execute_statement call
+    """
+
+    def __init__(self, executor, metrics):
+        self.executor = executor
+        self.metrics = metrics
+
+    def execute_statement(self, statement, *parameters):
+        started = time.perf_counter()
+        cursor = self.executor.execute_statement(statement, *parameters)
+        self.metrics.record_statement(statement, (time.perf_counter() - started) * 1000, cursor)
+        return cursor
+
+    def __getattr__(self, name):
+        return getattr(self.executor, name)
+
+
+# Shared by the handlers of the container; replace its sink with a LocalCollector to inspect the documents
+invocation_metrics = InvocationMetrics()
@@ -0,0 +1,151 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import decimal
+import logging
+import random
+from wallet_core.accounts import bucket_account_id, draw_from_buckets, validate_account_id
+from wallet_core.errors import AccountNotFound, BadRequest, DuplicateAccount, InsufficientFunds, WalletError
+from wallet_core.qldb import MAX_DOCUMENTS_PER_TRANSACTION
+
+logger = logging.getLogger()
+
+DEPOSIT = 'deposit'
+WITHDRAW = 'withdraw'
+MUTATION_OPS = (DEPOSIT, WITHDRAW)
+
+
+class MutationsRejected(WalletError):
+    http_status_code = 400
+
+    def __init__(self, results):
+        rejected = sum(1 for result in results if result['status'] == 'error')
+        super().__init__(f"{rejected} of {len(results)} mutations rejected, no mutation was applied",
+                         details={'results': results})
+        self.results = results
+
+
+def validate_mutations(items, max_items):
+    """
+    Validates a list of {accountId, amount, op} items and returns them with their position in the request
+    """
+
+    if not isinstance(items, list) or not items:
+        raise BadRequest('items must be a non-empty list of {accountId, amount, op} objects')
+    if len(items) > max_items:
+        raise BadRequest(f"At most {max_items} items can be applied in one request")
+
+    mutations = []
+    for index, item in enumerate(items):
+        if not isinstance(item, dict):
+            raise BadRequest(f"Item {index} must be an object")
+        account_id = item.get('accountId')
+        amount = item.get('amount')
+        op = item.get('op')
+        if not account_id or not isinstance(account_id, str):
+            raise BadRequest(f"Item {index}: accountId not specified")
+        validate_account_id(account_id)
+        if isinstance(amount, bool) or not isinstance(amount, (int, decimal.Decimal)) or amount <= 0:
+            raise BadRequest(f"Item {index}: amount not specified or not greater than zero")
+        if op not in MUTATION_OPS:
+            raise BadRequest(f"Item {index}: op must be one of {', '.join(MUTATION_OPS)}")
+        mutations.append({'index': index, 'accountId': account_id, 'amount': amount, 'op': op})
+
+    return mutations
+
+
+def distinct_accounts(mutations):
+    return list(dict.fromkeys(mutation['accountId'] for mutation in mutations))
+
+
+def chunk_by_accounts(mutations, max_accounts=MAX_DOCUMENTS_PER_TRANSACTION):
+    """
+    Splits mutations, in order, into chunks touching at most max_accounts distinct accounts each
+    """
+
+    chunk = []
+    accounts = set()
+    for mutation in mutations:
+        if mutation['accountId'] not in accounts and len(accounts) == max_accounts:
+            yield chunk
+            chunk = []
+            accounts = set()
+        chunk.append(mutation)
+        accounts.add(mutation['accountId'])
+
+    if chunk:
+        yield chunk
+
+
+def apply_mutations(repository, mutations):
+    """
+    Applies mutations within the current transaction. All balances are read with one statement, plus one for the
+    other buckets of sharded accounts, and every affected document is updated once with its final balance.
+    Mutations on the same account apply in order. Deposits to a sharded account go to a bucket the transaction
+    already updates, or to a random one, and withdrawals draw from its buckets like single withdrawals do.
+    Raises MutationsRejected, so the transaction is aborted, if any mutation fails.
+    Parameters:
+       repository (AccountRepository): Repository bound to the transaction executor
+       mutations (list): Validated mutations
+    Returns:
+       The result of each mutation, with the total balance and the updated buckets for sharded accounts
+    """
+
+    docs, duplicates = repository.get_many(distinct_accounts(mutations))
+    buckets_of = {account_id: range(repository.remember_buckets(account_id, doc)) for account_id, doc in docs.items()
+                  if account_id not in duplicates}
+    bucket_docs = repository.get_bucket_docs(docs, buckets_of)
+    balances = {account_id: [doc['balance'] for doc in account_docs.values()]
+                for account_id, account_docs in bucket_docs.items()}
+    updated = {account_id: {} for account_id in balances}
+    results = []
+
+    for mutation in mutations:
+        account_id = mutation['accountId']
+        result = dict(mutation)
+
+        if account_id in duplicates:
+            error = DuplicateAccount(account_id)
+        elif account_id not in balances:
+            error = AccountNotFound(account_id)
+        else:
+            bucket_balances = balances[account_id]
+            old_balance = sum(bucket_balances)
+            changes = None
+            if mutation['op'] == DEPOSIT:
+                bucket = next(iter(updated[account_id]), random.randrange(len(bucket_balances)))
+                changes = {bucket: mutation['amount']}
+            elif old_balance >= mutation['amount']:
+                changes = {bucket: -taken
+                           for bucket, taken in draw_from_buckets(bucket_balances, mutation['amount']).items()}
+            error = InsufficientFunds(account_id, mutation['amount']) if changes is None else None
+
+        if error:
+            result.update({'status': 'error', 'message': error.message})
+        else:
+            for bucket, change in changes.items():
+                bucket_balances[bucket] += change
+                updated[account_id][bucket] = True
+            result.update({'status': 'Ok', 'old_balance': old_balance, 'new_balance': sum(bucket_balances)})
+            if len(bucket_balances) > 1:
+                result['buckets'] = list(changes)
+        results.append(result)
+
+    if any(result['status'] == 'error' for result in results):
+        for result in results:
+            if result['status'] == 'Ok':
+                result['status'] = 'rolled_back'
+                del result['old_balance'], result['new_balance']
+                result.pop('buckets', None)
+        raise MutationsRejected(results)
+
+    documents = sum(len(buckets) for buckets in updated.values())
+    if documents > MAX_DOCUMENTS_PER_TRANSACTION:
+        raise BadRequest(f"The mutations update {documents} documents of sharded accounts, more than the "
+                         f"{MAX_DOCUMENTS_PER_TRANSACTION} a transaction can update; send fewer accounts per request")
+
+    for account_id in distinct_accounts(mutations):
+        for bucket in updated[account_id]:
+            repository.set_balance(bucket_account_id(account_id, bucket), balances[account_id][bucket])
+
+    return results
@@ -0,0 +1,65 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import json
+import os
+from wallet_core.metrics import InstrumentedExecutor, invocation_metrics
+from wallet_core.retry import retry_policy
+
+LEDGER_NAME = os.getenv('LEDGER_NAME')
+
+# QLDB quotas, see https://docs.aws.amazon.com/qldb/latest/developerguide/limits.html
+MAX_DOCUMENTS_PER_TRANSACTION = 40
+MAX_TRANSACTION_BYTES = 4 * 1024 * 1024
+# Share of the transaction size used for new documents, leaving room for statements, reads and revision overhead
+TRANSACTION_BYTES_BUDGET = MAX_TRANSACTION_BYTES // 2
+
+
+class WalletDriver:
+    """
+    QldbDriver wrapper counting the transactions of the current invocation for the retry policy,
+    and recording the latency and IOs of every statement
+    """
+
+    def __init__(self, driver, policy=retry_policy, metrics=invocation_metrics):
+        self.driver = driver
+        self.policy = policy
+        self.metrics = metrics
+
+    def execute_lambda(self, query_lambda):
+        self.policy.begin_transaction()
+        return self.driver.execute_lambda(lambda executor: query_lambda(InstrumentedExecutor(executor, self.metrics)))
+
+
+def create_qldb_driver(ledger_name=LEDGER_NAME, policy=retry_policy):
+    # pyqldb is imported on first use, so modules that only need the QLDB limits do not load it
+    from pyqldb.config.retry_config import RetryConfig
+    from pyqldb.driver.qldb_driver import QldbDriver
+
+    retry_config = RetryConfig(retry_limit=policy.retry_limit, custom_backoff=policy.backoff)
+    return WalletDriver(QldbDriver(ledger_name=ledger_name, retry_config=retry_config), policy)
+
+
+def estimated_document_size(document):
+    # The JSON text is larger than the Ion binary QLDB stores, which keeps the estimate on the safe side
+    return len(json.dumps(document, default=str).encode('utf-8'))
+
+
+def chunk_documents(documents, max_documents=MAX_DOCUMENTS_PER_TRANSACTION, max_bytes=TRANSACTION_BYTES_BUDGET):
+    """
+    Splits documents, in order, into chunks that fit the per-transaction document count and size limits
+    """
+
+    chunk = []
+    chunk_bytes = 0
+    for document in documents:
+        size = estimated_document_size(document)
+        if chunk and (len(chunk) == max_documents or chunk_bytes + size > max_bytes):
+            yield chunk
+            chunk = []
+            chunk_bytes = 0
+        chunk.append(document)
+        chunk_bytes += size
+
+    if chunk:
+        yield chunk
@@ -0,0 +1,197 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import base64
+import decimal
+import gzip
+import json
+import logging
+from wallet_core.errors import BadRequest, WalletError
+from wallet_core.metrics import invocation_metrics
+from wallet_core.retry import retry_policy
+
+logger = logging.getLogger()
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Smaller bodies are returned uncompressed, compression would hardly save any bytes on the wire
+MIN_COMPRESSED_BYTES = 1024
+
+
+# Helper class to convert DynamoDB items and QLDB documents to JSON.
+class DecimalEncoder(json.JSONEncoder):
+    def default(self, o):
+        if isinstance(o, decimal.Decimal):
+            if o % 1 > 0:
+                return float(o)
+            else:
+                return int(o)
+        return super(DecimalEncoder, self).default(o)
+
+
+def request_headers(event):
+    # Header names are case-insensitive
+    return {name.lower(): value for name, value in (event.get('headers') or {}).items()}
+
+
+def accepted_encoding(accept_encoding):
+    """
+    Picks the preferred of br (when the brotli package is available) and gzip in an Accept-Encoding header
+    Returns:
+       The content coding, or None when the response must not be compressed
+    """
+
+    weights = {}
+    for part in (accept_encoding or '').split(','):
+        coding, _, parameters = part.partition(';')
+        weight = 1.0
+        parameters = parameters.strip().replace(' ', '')
+        if parameters.startswith('q='):
+            try:
+                weight = float(parameters[2:])
+            except ValueError:
+                weight = 0.0
+        if coding.strip():
+            weights[coding.strip().lower()] = weight
+
+    best = None
+    for coding in (['br'] if brotli else []) + ['gzip']:
+        weight = weights.get(coding, weights.get('*', 0.0))
+        if weight > 0 and (best is None or weight > best[1]):
+            best = (coding, weight)
+
+    return best[0] if best else None
+
+
+def compress_body(data, encoding):
+    if encoding == 'br':
+        return brotli.compress(data, quality=5)
+    return gzip.compress(data, compresslevel=6)
+
+
+def api_response(body, http_status_code=200, headers=None, encoding=None):
+    """
+    Builds an API Gateway proxy response with a JSON body, compressed and base64 encoded when an encoding is given
+    """
+
+    response = {
+        "statusCode": http_status_code,
+        "body": json.dumps(body, cls=DecimalEncoder),
+        "isBase64Encoded": False
+    }
+    if headers:
+        response['headers'] = dict(headers)
+
+    if encoding and len(response['body']) >= MIN_COMPRESSED_BYTES:
+        compressed = compress_body(response['body'].encode('utf-8'), encoding)
+        response['body'] = base64.b64encode(compressed).decode('ascii')
+        response['isBase64Encoded'] = True
+        response.setdefault('headers', {}).update({'Content-Type': 'application/json', 'Content-Encoding': encoding})
+
+    return response
+
+
+def not_modified_response(headers):
+    return {
+        "statusCode": 304,
+        "headers": dict(headers),
+        "body": "",
+        "isBase64Encoded": False
+    }
+
+
+def matches_etag(if_none_match, etag):
+    """
+    Weak comparison of an ETag with the entity tags of an If-None-Match header
+    """
+
+    def opaque(tag):
+        tag = tag.strip()
+        return tag[2:] if tag.startswith('W/') else tag
+
+    tags = [tag for tag in (if_none_match or '').split(',') if tag.strip()]
+    return any(tag.strip() == '*' or opaque(tag) == opaque(etag) for tag in tags)
+
+
+def error_response(message, http_status_code=500, details=None):
+    return_message = {'status': 'error', 'message': message}
+    return_message.update(details or {})
+    logger.error(return_message)
+
+    return api_response(return_message, http_status_code=http_status_code)
+
+
+def parse_body(event):
+    """
+    Parses the JSON body of an API Gateway proxy event. Numbers with a fraction are parsed as Decimal,
+    so amounts can be added to ledger balances without float rounding.
+    """
+
+    try:
+        body = event['body']
+        # APIs with binary media types pass request bodies base64 encoded
+        if event.get('isBase64Encoded'):
+            body = base64.b64decode(body).decode('utf-8')
+        body = json.loads(body, parse_float=decimal.Decimal)
+    except Exception as e:
+        raise BadRequest(str(e))
+
+    if not isinstance(body, dict):
+        raise BadRequest('Request body must be a JSON object')
+
+    return body
+
+
+def require_positive_amount(body, message):
+    amount = body.get('amount')
+    if isinstance(amount, bool) or not isinstance(amount, (int, decimal.Decimal)) or amount <= 0:
+        raise BadRequest(message)
+
+    return amount
+
+
+def handle_api_request(event, process_body, context=None, handler_name='api', compress=False, etag=None):
+    """
+    Runs process_body on the parsed request body and builds the API Gateway response
+    Parameters:
+       event (dict): API Gateway proxy event
+       process_body (function): Takes the body and returns the fields of a successful response
+       context: Lambda context, bounding QLDB transaction retries to the invocation's remaining time
+       handler_name (string): Handler dimension of the QLDB statement metrics
+       compress (bool): Compress successful responses with brotli or gzip when the request accepts it.
+          The API must declare binary media types, so API Gateway decodes the base64 encoded body.
+       etag (function): Takes the body and, when processed, the fields of the response, and returns the ETag
+          of the response or None. A request with a matching If-None-Match gets an empty 304 response without
+          being processed.
+    """
+
+    logger.debug(f"Event received: {json.dumps(event)}")
+
+    headers = request_headers(event)
+    response_headers = {'Vary': 'Accept-Encoding'} if compress else {}
+    retry_policy.begin_invocation(context)
+    invocation_metrics.begin_invocation(handler_name)
+    try:
+        body = parse_body(event)
+        if etag and headers.get('if-none-match'):
+            current_etag = etag(body, None)
+            if current_etag and matches_etag(headers['if-none-match'], current_etag):
+                return not_modified_response(dict(response_headers, ETag=current_etag))
+
+        return_message = process_body(body)
+        response_etag = etag(body, return_message) if etag else None
+        if response_etag:
+            response_headers['ETag'] = response_etag
+    except WalletError as e:
+        return error_response(e.message, http_status_code=e.http_status_code, details=e.details)
+    except Exception as e:
+        return error_response(str(e), http_status_code=500)
+    finally:
+        invocation_metrics.end_invocation(retry_policy.end_invocation())
+
+    return_message['status'] = 'Ok'
+    return api_response(return_message, headers=response_headers,
+                        encoding=accepted_encoding(headers.get('accept-encoding')) if compress else None)
@@ -0,0 +1,114 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import json
+import logging
+import os
+import random
+from wallet_core.errors import RetryBudgetExhausted
+
+logger = logging.getLogger()
+
+OCC_CONFLICT_ERROR_CODE = 'OccConflictException'
+
+
+def error_code(error):
+    response = getattr(error, 'response', None) or {}
+    return response.get('Error', {}).get('Code')
+
+
+class RetryPolicy:
+    """
+    Backoff for QLDB transaction retries, passed to the driver as RetryConfig.custom_backoff.
+    Delays use decorrelated jitter, each one drawn between the base delay and three times the previous one.
+    The base delay grows with the OCC conflict rate observed by the container, so retries spread out while
+    transactions contend for the same documents. No retry is attempted once its delay would leave less than
+    deadline_margin_ms of the invocation's remaining time.
+    Parameters:
+       retry_limit (int): Maximum number of retries per transaction
+       base_ms (int): Smallest delay in milliseconds, when no conflicts are observed
+       max_ms (int): Largest delay in milliseconds
+       deadline_margin_ms (int): Time kept to run the last attempt and return a response
+       conflict_scale (float): Factor applied to the base delay at a conflict rate of 1
+       smoothing (float): Weight of the latest invocation in the conflict rate moving average
+    """
+
+    def __init__(self, retry_limit=4, base_ms=10, max_ms=2000, deadline_margin_ms=1000, conflict_scale=4.0,
+                 smoothing=0.2):
+        self.retry_limit = retry_limit
+        self.base_ms = base_ms
+        self.max_ms = max_ms
+        self.deadline_margin_ms = deadline_margin_ms
+        self.conflict_scale = conflict_scale
+        self.smoothing = smoothing
+        # Share of attempts that ended in an OCC conflict, averaged over recent invocations
+        self.conflict_rate = 0.0
+        self.begin_invocation(None)
+
+    @classmethod
+    def from_environment(cls):
+        return cls(retry_limit=int(os.getenv('QLDB_RETRY_LIMIT', 4)),
+                   base_ms=int(os.getenv('QLDB_RETRY_BASE_MS', 10)),
+                   max_ms=int(os.getenv('QLDB_RETRY_MAX_MS', 2000)),
+                   deadline_margin_ms=int(os.getenv('QLDB_RETRY_DEADLINE_MARGIN_MS', 1000)))
+
+    def begin_invocation(self, context):
+        """
+        Resets the per-invocation counters. context is the Lambda context, or None when there is no deadline.
+        """
+
+        self.context = context
+        self.counters = {'transactions': 0, 'retries': 0, 'conflicts': 0}
+        self._last_delay_ms = None
+
+    def begin_transaction(self):
+        self.counters['transactions'] += 1
+        self._last_delay_ms = None
+
+    def scaled_base_ms(self):
+        return self.base_ms * (1 + self.conflict_scale * self.conflict_rate)
+
+    def backoff(self, retry_attempt, error, transaction_id):
+        """
+        Returns the delay in milliseconds before retry number retry_attempt, or raises RetryBudgetExhausted
+        when there is no time left for it
+        """
+
+        self.counters['retries'] += 1
+        if error_code(error) == OCC_CONFLICT_ERROR_CODE:
+            self.counters['conflicts'] += 1
+
+        base_ms = self.scaled_base_ms()
+        previous_ms = self._last_delay_ms or base_ms
+        delay_ms = min(self.max_ms, random.uniform(base_ms, previous_ms * 3))
+        self._last_delay_ms = delay_ms
+
+        if self.context is not None:
+            remaining_ms = self.context.get_remaining_time_in_millis()
+            if remaining_ms - delay_ms < self.deadline_margin_ms:
+                logger.warning(f"Not retrying transaction {transaction_id}: {remaining_ms} ms left, "
+                               f"next delay {delay_ms:.0f} ms")
+                raise RetryBudgetExhausted(retry_attempt, self.counters['conflicts']) from error
+
+        logger.info(f"Retrying transaction {transaction_id} (retry {retry_attempt}) in {delay_ms:.0f} ms "
+                    f"after {error_code(error) or type(error).__name__}")
+        return int(delay_ms)
+
+    def end_invocation(self):
+        """
+        Folds the invocation's conflicts into the conflict rate and logs the retry and conflict counts
+        """
+
+        attempts = self.counters['transactions'] + self.counters['retries']
+        if attempts:
+            invocation_rate = self.counters['conflicts'] / attempts
+            self.conflict_rate += self.smoothing * (invocation_rate - self.conflict_rate)
+
+        report = dict(self.counters, conflictRate=round(self.conflict_rate, 4))
+        if self.counters['transactions']:
+            logger.info(f"QLDB retries: {json.dumps(report)}")
+        return report
+
+
+# Shared by every driver of the container, so the conflict rate accumulates across invocations and routes
+retry_policy = RetryPolicy.from_environment()
@@ -0,0 +1,130 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import logging
+import re
+from decimal import Decimal
+from boto3.dynamodb.conditions import Key
+from wallet_core.accounts import bucket_account_ids
+from wallet_core.errors import BadRequest
+
+logger = logging.getLogger()
+
+# Sort key prefixes of the rollup items written by lambda_stream_transactions (see ddb_rollups.py)
+GRANULARITIES = {
+    'daily': ('D#', re.compile(r'^\d{4}-\d{2}-\d{2}$'), 'YYYY-MM-DD'),
+    'monthly': ('M#', re.compile(r'^\d{4}-\d{2}$'), 'YYYY-MM')
+}
+ROLLUP_ATTRIBUTES = ('credits', 'debits', 'txCount', 'openingBalance', 'closingBalance', 'lastTxTime')
+CURSOR_PERIOD = 'CURSOR'
+
+
+def validate_period(value, granularity, name):
+    _, pattern, period_format = GRANULARITIES[granularity]
+    if value is not None and (not isinstance(value, str) or not pattern.match(value)):
+        raise BadRequest(f"{name} must be a {period_format} string for {granularity} rollups")
+    return value
+
+
+def rollup_key_condition(account_id, granularity, start=None, end=None):
+    prefix = GRANULARITIES[granularity][0]
+    condition = Key('accountId').eq(account_id)
+    if start or end:
+        # The prefix sorts before any period and '~' after any, so open bounds stay within the granularity
+        return condition & Key('period').between(prefix + (start or ''), prefix + (end or '~'))
+    return condition & Key('period').begins_with(prefix)
+
+
+def query_account_rollups(table, account_id, granularity, start=None, end=None):
+    prefix = GRANULARITIES[granularity][0]
+    query_arguments = {'KeyConditionExpression': rollup_key_condition(account_id, granularity, start, end)}
+    rollups = []
+
+    while True:
+        response = table.query(**query_arguments)
+        for item in response['Items']:
+            rollup = {'period': item['period'][len(prefix):]}
+            rollup.update({attribute: item[attribute] for attribute in ROLLUP_ATTRIBUTES if attribute in item})
+            rollups.append(rollup)
+
+        if 'LastEvaluatedKey' not in response:
+            return rollups
+        query_arguments['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+
+def closing_balance_before(table, account_id, granularity, start):
+    """
+    Returns the closing balance of an account's last rollup of the granularity before the start period, or 0
+    """
+
+    if not start:
+        return Decimal(0)
+    prefix = GRANULARITIES[granularity][0]
+    response = table.query(KeyConditionExpression=Key('accountId').eq(account_id) & Key('period').lt(prefix + start),
+                           ScanIndexForward=False, Limit=1)
+    # Periods of the other granularity and the cursor sort before, so only an item with the prefix is a rollup
+    items = [item for item in response['Items'] if item['period'].startswith(prefix)]
+    return items[0].get('closingBalance', Decimal(0)) if items else Decimal(0)
+
+
+def merge_bucket_rollups(bucket_rollups, opening_balances):
+    """
+    Adds up the rollups of the buckets of a sharded account, period by period. A bucket without a rollup for a
+    period counts with its balance at the end of its previous period, as both opening and closing balance.
+    Parameters:
+       bucket_rollups (list): The rollups of each bucket in period order
+       opening_balances (list): The balance of each bucket before the first period
+    """
+
+    by_period = [{rollup['period']: rollup for rollup in rollups} for rollups in bucket_rollups]
+    balances = list(opening_balances)
+    merged = []
+
+    for period in sorted(set(period for rollups in by_period for period in rollups)):
+        merged_rollup = {'period': period, 'credits': Decimal(0), 'debits': Decimal(0), 'txCount': 0,
+                         'openingBalance': Decimal(0), 'closingBalance': Decimal(0)}
+        for bucket, rollups in enumerate(by_period):
+            rollup = rollups.get(period)
+            if rollup is None:
+                merged_rollup['openingBalance'] += balances[bucket]
+                merged_rollup['closingBalance'] += balances[bucket]
+                continue
+            for attribute in ('credits', 'debits', 'txCount'):
+                merged_rollup[attribute] += rollup.get(attribute, 0)
+            merged_rollup['openingBalance'] += rollup.get('openingBalance', balances[bucket])
+            balances[bucket] = rollup.get('closingBalance', balances[bucket])
+            merged_rollup['closingBalance'] += balances[bucket]
+            if 'lastTxTime' in rollup:
+                merged_rollup['lastTxTime'] = max(merged_rollup.get('lastTxTime', ''), rollup['lastTxTime'])
+        merged.append(merged_rollup)
+
+    return merged
+
+
+def query_rollups(table, account_id, granularity, start=None, end=None):
+    """
+    Reads an account's rollups of one granularity, optionally bounded by inclusive periods.
+    The rollups of the buckets of a sharded account are merged, at the cost of one more query per bucket.
+    Parameters:
+       table: boto3 DynamoDB Table resource of the rollups table
+       account_id (string): The account
+       granularity (string): daily or monthly
+       start, end (string): Optional inclusive periods, YYYY-MM-DD for daily and YYYY-MM for monthly rollups
+    Returns:
+       The rollups in period order, each with its period and the amounts of the period
+    """
+
+    if granularity not in GRANULARITIES:
+        raise BadRequest(f"granularity must be one of {', '.join(GRANULARITIES)}")
+    validate_period(start, granularity, 'from')
+    validate_period(end, granularity, 'to')
+
+    cursor = table.get_item(Key={'accountId': account_id, 'period': CURSOR_PERIOD}).get('Item') or {}
+    buckets = int(cursor.get('buckets') or 1)
+    if buckets == 1:
+        return query_account_rollups(table, account_id, granularity, start, end)
+
+    bucket_ids = bucket_account_ids(account_id, buckets)
+    return merge_bucket_rollups(
+        [query_account_rollups(table, bucket_id, granularity, start, end) for bucket_id in bucket_ids],
+        [closing_balance_before(table, bucket_id, granularity, start) for bucket_id in bucket_ids])
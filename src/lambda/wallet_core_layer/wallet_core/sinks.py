@@ -0,0 +1,146 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import logging
+import os
+
+logger = logging.getLogger()
+
+EXPORT_BUCKET = os.getenv('EXPORT_BUCKET')
+EXPORT_DIR = os.getenv('EXPORT_DIR', '/tmp/exports')
+# S3 multipart parts must be at least 5 MB, except the last one
+S3_PART_SIZE = 8 * 1024 * 1024
+
+
+class LocalFileWriter:
+    def __init__(self, path):
+        self.path = path
+        self.location = f"file://{path}"
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._file = open(path, 'wb')
+
+    def write(self, data):
+        self._file.write(data)
+
+    def close(self):
+        self._file.close()
+
+    def abort(self):
+        self._file.close()
+        os.remove(self.path)
+
+
+class LocalFileSink:
+    """
+    Local filesystem stand-in for S3, storing objects as files under a directory
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def path(self, key):
+        return os.path.join(self.directory, *key.split('/'))
+
+    def open_writer(self, key):
+        return LocalFileWriter(self.path(key))
+
+    def url(self, key):
+        return f"file://{self.path(key)}"
+
+    def read(self, key):
+        try:
+            with open(self.path(key), 'rb') as file:
+                return file.read()
+        except FileNotFoundError:
+            return None
+
+
+class S3MultipartWriter:
+    """
+    Uploads an object with S3 multipart upload, holding at most one part in memory
+    """
+
+    def __init__(self, s3, bucket, key, part_size=S3_PART_SIZE):
+        self.s3 = s3
+        self.bucket = bucket
+        self.key = key
+        self.part_size = part_size
+        self.location = f"s3://{bucket}/{key}"
+        self._buffer = bytearray()
+        self._parts = []
+        self._upload_id = s3.create_multipart_upload(Bucket=bucket, Key=key)['UploadId']
+
+    def _upload_part(self):
+        part_number = len(self._parts) + 1
+        response = self.s3.upload_part(Bucket=self.bucket, Key=self.key, UploadId=self._upload_id,
+                                       PartNumber=part_number, Body=bytes(self._buffer))
+        self._parts.append({'ETag': response['ETag'], 'PartNumber': part_number})
+        self._buffer = bytearray()
+
+    def write(self, data):
+        self._buffer.extend(data)
+        if len(self._buffer) >= self.part_size:
+            self._upload_part()
+
+    def close(self):
+        if self._buffer or not self._parts:
+            self._upload_part()
+        self.s3.complete_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self._upload_id,
+                                          MultipartUpload={'Parts': self._parts})
+
+    def abort(self):
+        self.s3.abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self._upload_id)
+
+
+class S3Sink:
+    def __init__(self, bucket, s3=None):
+        self.bucket = bucket
+        if s3 is None:
+            import boto3
+            s3 = boto3.client('s3')
+        self.s3 = s3
+
+    def open_writer(self, key):
+        return S3MultipartWriter(self.s3, self.bucket, key)
+
+    def url(self, key, expires_in=3600):
+        return self.s3.generate_presigned_url('get_object', Params={'Bucket': self.bucket, 'Key': key},
+                                              ExpiresIn=expires_in)
+
+    def read(self, key):
+        try:
+            return self.s3.get_object(Bucket=self.bucket, Key=key)['Body'].read()
+        except self.s3.exceptions.NoSuchKey:
+            return None
+
+
+def sink_from_environment():
+    """
+    Returns an S3Sink for EXPORT_BUCKET, or a LocalFileSink under EXPORT_DIR when no bucket is configured
+    """
+
+    if EXPORT_BUCKET:
+        return S3Sink(EXPORT_BUCKET)
+    return LocalFileSink(EXPORT_DIR)
+
+
+def write_chunks(sink, key, chunks):
+    """
+    Writes an iterable of byte chunks to key, aborting the object if the iterable raises
+    Returns:
+       (location, bytes_written)
+    """
+
+    writer = sink.open_writer(key)
+    bytes_written = 0
+    try:
+        for chunk in chunks:
+            writer.write(chunk)
+            bytes_written += len(chunk)
+    except Exception as e:
+        logger.error(f"Error writing {writer.location}: {e}")
+        writer.abort()
+        raise e
+
+    writer.close()
+    return writer.location, bytes_written
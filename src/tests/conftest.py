@@ -0,0 +1,12 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import os
+import sys
+
+SRC_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# The stack, the tools and the stream consumer modules are imported like their entry points do
+for path in (SRC_DIR, os.path.join(SRC_DIR, 'tools'), os.path.join(SRC_DIR, 'lambda', 'lambda_stream_transactions')):
+    if path not in sys.path:
+        sys.path.insert(0, path)
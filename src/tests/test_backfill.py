@@ -0,0 +1,170 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+"""
+Tests of tools/backfill.py on a small journal export written in Ion text, without DynamoDB
+"""
+
+import os
+import types
+from datetime import datetime, timezone
+from decimal import Decimal
+import pytest
+
+ion = pytest.importorskip('amazon.ion.simpleion')
+pytest.importorskip('botocore')
+backfill = pytest.importorskip('backfill')
+
+TABLE_NAME = 'Wallet'
+PARTITIONS = 4
+
+
+def revision(document_id, version, account_id, balance, day):
+    return {
+        'blockAddress': {'strandId': 'strand', 'sequenceNo': version},
+        'hash': b'revision-hash',
+        'data': {'accountId': account_id, 'balance': Decimal(balance)},
+        'metadata': {'id': document_id, 'version': version, 'txId': f"tx-{document_id}-{version}",
+                     'txTime': datetime(2021, 3, day, 12, tzinfo=timezone.utc)}
+    }
+
+
+def block(revisions, tables):
+    # A block also holds system revisions, which only have a hash
+    return {
+        'transactionInfo': {'documents': {document_id: {'tableName': table_name, 'tableId': f"{table_name}-id"}
+                                          for document_id, table_name in tables.items()}},
+        'revisions': [{'hash': b'system-hash'}] + revisions
+    }
+
+
+def write_ion(path, values):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as file:
+        file.write(ion.dumps(values, binary=False, sequence_as_stream=True))
+
+
+@pytest.fixture
+def export_dir(tmp_path):
+    """
+    Export of two files, listed in the completed manifest in the reverse order of their names.
+    Account a1 has three revisions across both files, a2 one, and a document of another table one.
+    """
+
+    export = tmp_path / 'export'
+    write_ion(str(export / 'strand' / 'b.ion'), [
+        block([revision('d1', 0, 'a1', '10', 1), revision('d1', 1, 'a1', '25', 1)], {'d1': TABLE_NAME}),
+        block([revision('d9', 0, 'other', '1', 2)], {'d9': 'Other'})
+    ])
+    write_ion(str(export / 'strand' / 'a.ion'), [
+        block([revision('d1', 2, 'a1', '5', 2), revision('d2', 0, 'a2', '7', 2)],
+              {'d1': TABLE_NAME, 'd2': TABLE_NAME})
+    ])
+    write_ion(str(export / 'job.completed.manifest'), [{'keys': ['exports/strand/b.ion', 'exports/strand/a.ion']}])
+    return export
+
+
+def shuffle(export_dir, work_dir, **settings):
+    for path in backfill.export_files(str(export_dir)):
+        backfill.shuffle_file(path, str(work_dir), PARTITIONS, TABLE_NAME, settings.get('ttl_attribute'),
+                              settings.get('expire_after_days'))
+
+
+def write_partitions(work_dir, **settings):
+    return [backfill.write_partition(partition, str(work_dir), None, 'balances', 0, True, **settings)
+            for partition in range(PARTITIONS)]
+
+
+def test_journal_revisions():
+    journal_block = block([revision('d1', 0, 'a1', '10', 1), revision('d9', 0, 'other', '1', 1)],
+                          {'d1': TABLE_NAME, 'd9': 'Other'})
+    revisions = list(backfill.journal_revisions(journal_block, [TABLE_NAME]))
+
+    assert len(revisions) == 1
+    assert revisions[0]['table_info']['tableName'] == TABLE_NAME
+    assert revisions[0]['revision_data']['accountId'] == 'a1'
+    assert revisions[0]['revision_metadata']['version'] == 0
+
+
+def test_journal_revisions_without_transaction_info():
+    assert list(backfill.journal_revisions({'revisions': [{'hash': b'system-hash'}]}, [TABLE_NAME])) == []
+
+
+def test_export_files_in_manifest_order(export_dir):
+    files = backfill.export_files(str(export_dir))
+
+    assert [os.path.basename(path) for path in files] == ['b.ion', 'a.ion']
+
+
+def test_export_files_without_manifest(export_dir):
+    os.remove(export_dir / 'job.completed.manifest')
+
+    assert [os.path.basename(path) for path in backfill.export_files(str(export_dir))] == ['a.ion', 'b.ion']
+
+
+def test_export_files_missing_from_manifest(export_dir):
+    os.remove(export_dir / 'strand' / 'a.ion')
+
+    with pytest.raises(FileNotFoundError):
+        backfill.export_files(str(export_dir))
+
+
+def test_write_partition_dry_run(export_dir, tmp_path):
+    shuffle(export_dir, tmp_path / 'work')
+    counters = write_partitions(tmp_path / 'work', rollups_table='rollups')
+
+    assert sum(partition['items'] for partition in counters) == 4
+    assert sum(partition['balances'] for partition in counters) == 2
+    assert sum(partition['rollups'] for partition in counters) == 4
+    assert sum(partition['failed'] for partition in counters) == 0
+    assert all(partition['writeUnits'] > 0 for partition in counters if partition['items'])
+
+
+def test_write_partition_skips_expired_history(export_dir, tmp_path):
+    # Revisions of March 2021 expired long ago, but still give the balances and the rollups
+    shuffle(export_dir, tmp_path / 'work', ttl_attribute='expire_timestamp', expire_after_days=30)
+    counters = write_partitions(tmp_path / 'work', rollups_table='rollups', ttl_attribute='expire_timestamp')
+
+    assert sum(partition['items'] for partition in counters) == 0
+    assert sum(partition['expired'] for partition in counters) == 4
+    assert sum(partition['balances'] for partition in counters) == 2
+    assert sum(partition['rollups'] for partition in counters) == 4
+
+
+class RecordingWriter:
+    """
+    Stand-in for the stream handler's writers, recording the items added
+    """
+
+    instances = []
+
+    def __init__(self, *args, **kwargs):
+        self.added = []
+        self.instances.append(self)
+
+    def add(self, item, source_id=None):
+        self.added.append(item)
+
+    def flush(self):
+        return []
+
+
+def test_write_partition_folds_rollups_in_version_order(export_dir, tmp_path, monkeypatch):
+    monkeypatch.setattr(RecordingWriter, 'instances', [])
+    monkeypatch.setattr(backfill, 'BatchWriter', RecordingWriter)
+    monkeypatch.setattr(backfill, 'RollupWriter', RecordingWriter)
+    monkeypatch.setattr(backfill, 'dynamodb_resource', lambda: types.SimpleNamespace(Table=lambda name: name))
+    shuffle(export_dir, tmp_path / 'work')
+
+    # The revisions of a1 are spooled from both export files, in no particular order
+    partition = backfill.account_partition('a1', PARTITIONS)
+    counters = backfill.write_partition(partition, str(tmp_path / 'work'), 'transactions', None, 0, False,
+                                        rollups_table='rollups')
+
+    history_writer, rollup_writer = RecordingWriter.instances
+    rollups = [(item['accountId'], item['version'], item['balance']) for item in rollup_writer.added]
+    assert [rollup for rollup in rollups if rollup[0] == 'a1'] == [('a1', 0, 10), ('a1', 1, 25), ('a1', 2, 5)]
+    assert all(set(item) <= set(backfill.ROLLUP_ATTRIBUTES) for item in rollup_writer.added)
+    assert counters['rollups'] == len(rollups)
+    assert len(history_writer.added) == counters['items']
+    assert counters['failed'] == 0
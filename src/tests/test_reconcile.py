@@ -0,0 +1,106 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+"""
+Tests of tools/reconcile.py with its in-memory stand-ins of the balances table and the ledger
+"""
+
+import decimal
+import json
+import pytest
+from reconcile import Checkpoint, DriftReport, InMemoryLedger, InMemoryProjection, Reconciler, local_stores
+
+ACCOUNTS = 500
+DRIFT = 5
+SEGMENTS = 4
+
+
+def reconciler(projection, ledger, tmp_path):
+    checkpoint = Checkpoint(str(tmp_path / 'checkpoint.json'), SEGMENTS)
+    report = DriftReport(str(tmp_path / 'drift.ndjson'), resume=checkpoint.resumed)
+    return Reconciler(projection, ledger, checkpoint, report, workers=2, page_size=50, ledger_chunk=20)
+
+
+def read_report(tmp_path):
+    with open(tmp_path / 'drift.ndjson') as file:
+        return [json.loads(line) for line in file]
+
+
+def behind_stores():
+    # Projections one version behind, still behind when read again
+    documents = [{'accountId': f"account-{position:03d}", 'balance': decimal.Decimal(position), 'version': 2}
+                 for position in range(20)]
+    items = [dict(document, version=1 if position < 3 else 2) for position, document in enumerate(documents)]
+    return InMemoryProjection(items), InMemoryLedger(documents)
+
+
+def test_local_drift(tmp_path):
+    projection, ledger = local_stores(ACCOUNTS, DRIFT, seed=7)
+    counters = reconciler(projection, ledger, tmp_path).run()
+
+    assert counters['scanned'] == ACCOUNTS
+    assert counters['drifted'] == 3 * DRIFT
+    drifts = read_report(tmp_path)
+    kinds = [drift['drift'] for drift in drifts]
+    assert sorted(set(kinds)) == ['ahead', 'balance', 'missing']
+    assert all(kinds.count(kind) == DRIFT for kind in set(kinds))
+    assert len({drift['accountId'] for drift in drifts}) == 3 * DRIFT
+
+
+def test_resume_after_crash_before_checkpoint(tmp_path, monkeypatch):
+    projection, ledger = local_stores(ACCOUNTS, DRIFT, seed=7)
+    save_page = Checkpoint.save_page
+    calls = []
+
+    def crashing_save_page(self, *args):
+        # The page is already reported when its progress fails to be saved
+        calls.append(args)
+        if len(calls) == 5:
+            raise RuntimeError('interrupted')
+        save_page(self, *args)
+
+    monkeypatch.setattr(Checkpoint, 'save_page', crashing_save_page)
+    with pytest.raises(RuntimeError):
+        reconciler(projection, ledger, tmp_path).run()
+    monkeypatch.setattr(Checkpoint, 'save_page', save_page)
+
+    resumed = reconciler(projection, ledger, tmp_path)
+    assert resumed.checkpoint.resumed
+    counters = resumed.run()
+
+    assert counters['scanned'] == ACCOUNTS
+    assert counters['drifted'] == 3 * DRIFT
+    drifts = read_report(tmp_path)
+    assert len(drifts) == 3 * DRIFT
+    assert len({drift['accountId'] for drift in drifts}) == 3 * DRIFT
+
+
+def test_resume_after_crash_in_recheck(tmp_path, monkeypatch):
+    projection, ledger = behind_stores()
+    save = Checkpoint.save
+
+    def crashing_save(self):
+        if self.state.get('done'):
+            raise RuntimeError('interrupted')
+        save(self)
+
+    monkeypatch.setattr(Checkpoint, 'save', crashing_save)
+    with pytest.raises(RuntimeError):
+        reconciler(projection, ledger, tmp_path).run()
+    assert len(read_report(tmp_path)) == 3
+    monkeypatch.setattr(Checkpoint, 'save', save)
+
+    counters = reconciler(projection, ledger, tmp_path).run()
+
+    assert counters == {'scanned': 20, 'drifted': 3, 'behind': 3}
+    assert [drift['drift'] for drift in read_report(tmp_path)] == ['behind'] * 3
+
+
+def test_new_run_replaces_report(tmp_path):
+    projection, ledger = local_stores(ACCOUNTS, DRIFT, seed=7)
+    reconciler(projection, ledger, tmp_path).run()
+    (tmp_path / 'checkpoint.json').unlink()
+
+    reconciler(projection, ledger, tmp_path).run()
+
+    assert len(read_report(tmp_path)) == 3 * DRIFT
@@ -0,0 +1,133 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+"""
+Synth-level tests of the stream consumer settings of the CloudFormation template.
+Lambda bundling is skipped, so the stack synthesizes without Docker.
+"""
+
+import importlib
+import sys
+import types
+import pytest
+from conftest import SRC_DIR
+
+cdk = pytest.importorskip('aws_cdk.core')
+aws_logs = pytest.importorskip('aws_cdk.aws_logs')
+
+BASE_CONFIG = {
+    'log_retention': aws_logs.RetentionDays.ONE_MONTH,
+    'ledger_name': 'wallet',
+    'account': '123456789012',
+    'region': 'us-east-1',
+    'log_level': 'INFO',
+    'qldb_table_name': 'Wallet',
+    'shard_count': 1,
+    'ttl_attribute': 'expire_timestamp',
+    'expire_after_days': 30
+}
+STREAM_SETTINGS = {
+    'stream_aggregation': True,
+    'stream_batch_size': 500,
+    'stream_batching_window_seconds': 5,
+    'stream_parallelization_factor': 4,
+    'stream_enhanced_fan_out': True
+}
+
+
+def synth_template(monkeypatch, **settings):
+    monkeypatch.setitem(sys.modules, 'config_file', types.SimpleNamespace(config=dict(BASE_CONFIG, **settings)))
+    monkeypatch.chdir(SRC_DIR)
+    # The settings are read when wallet.py is imported
+    monkeypatch.delitem(sys.modules, 'wallet', raising=False)
+    wallet = importlib.import_module('wallet')
+
+    app = cdk.App(context={'aws:cdk:bundling-stacks': []})
+    stack = wallet.ServerlessWallet(app, 'serverless-wallet-test',
+                                    env={'account': BASE_CONFIG['account'], 'region': BASE_CONFIG['region']})
+    return app.synth().get_stack_by_name(stack.stack_name).template
+
+
+def resources(template, resource_type):
+    return {logical_id: resource for logical_id, resource in template['Resources'].items()
+            if resource['Type'] == resource_type}
+
+
+def stream_event_source_mapping(template):
+    # The SQS event source of the credits has no starting position
+    mappings = [resource['Properties'] for resource in resources(template, 'AWS::Lambda::EventSourceMapping').values()
+                if 'StartingPosition' in resource['Properties']]
+    assert len(mappings) == 1
+    return mappings[0]
+
+
+def policy_statements(template):
+    return [statement for policy in resources(template, 'AWS::IAM::Policy').values()
+            for statement in policy['Properties']['PolicyDocument']['Statement']]
+
+
+def statement_actions(statement):
+    actions = statement['Action']
+    return actions if isinstance(actions, list) else [actions]
+
+
+def test_default_stream_settings(monkeypatch):
+    template = synth_template(monkeypatch)
+
+    qldb_stream = next(iter(resources(template, 'AWS::QLDB::Stream').values()))
+    assert qldb_stream['Properties']['KinesisConfiguration']['AggregationEnabled'] is False
+
+    mapping = stream_event_source_mapping(template)
+    assert mapping['BatchSize'] == 100
+    assert mapping.get('MaximumBatchingWindowInSeconds', 0) == 0
+    assert mapping.get('ParallelizationFactor', 1) == 1
+    assert mapping['FunctionResponseTypes'] == ['ReportBatchItemFailures']
+    kinesis_stream_id = next(iter(resources(template, 'AWS::Kinesis::Stream')))
+    assert mapping['EventSourceArn'] == {'Fn::GetAtt': [kinesis_stream_id, 'Arn']}
+
+    # Reading the stream itself also grants SubscribeToShard, but on the stream rather than on a consumer
+    assert not resources(template, 'AWS::Kinesis::StreamConsumer')
+    assert not any('kinesis:DescribeStreamConsumer' in statement_actions(statement)
+                   for statement in policy_statements(template))
+
+
+def test_configured_stream_settings(monkeypatch):
+    template = synth_template(monkeypatch, **STREAM_SETTINGS)
+
+    qldb_stream = next(iter(resources(template, 'AWS::QLDB::Stream').values()))
+    assert qldb_stream['Properties']['KinesisConfiguration']['AggregationEnabled'] is True
+
+    consumers = resources(template, 'AWS::Kinesis::StreamConsumer')
+    assert len(consumers) == 1
+    consumer_arn = {'Fn::GetAtt': [next(iter(consumers)), 'ConsumerARN']}
+
+    mapping = stream_event_source_mapping(template)
+    assert mapping['BatchSize'] == 500
+    assert mapping['MaximumBatchingWindowInSeconds'] == 5
+    assert mapping['ParallelizationFactor'] == 4
+    assert mapping['FunctionResponseTypes'] == ['ReportBatchItemFailures']
+    assert mapping['EventSourceArn'] == consumer_arn
+
+    consumer_statements = [statement for statement in policy_statements(template)
+                           if statement['Resource'] == consumer_arn]
+    assert any({'kinesis:SubscribeToShard', 'kinesis:DescribeStreamConsumer'} <= set(statement_actions(statement))
+               for statement in consumer_statements)
+
+
+def day_index_settings(template):
+    indexes = [index for table in resources(template, 'AWS::DynamoDB::Table').values()
+               for index in table['Properties'].get('GlobalSecondaryIndexes', [])
+               if index['IndexName'] == 'tx-day-index']
+    environments = [function['Properties'].get('Environment', {}).get('Variables', {})
+                    for function in resources(template, 'AWS::Lambda::Function').values()]
+    attributes = [variables['DAY_INDEX_ATTRIBUTE'] for variables in environments if 'DAY_INDEX_ATTRIBUTE' in variables]
+    return indexes, attributes
+
+
+def test_day_index_only_for_archived_history(monkeypatch):
+    assert day_index_settings(synth_template(monkeypatch)) == ([], [])
+
+    indexes, attributes = day_index_settings(synth_template(monkeypatch, archive_history=True))
+    assert len(indexes) == 1
+    assert indexes[0]['Projection'] == {'ProjectionType': 'KEYS_ONLY'}
+    assert attributes == ['txDayShard']
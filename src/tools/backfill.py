@@ -0,0 +1,400 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+"""
+Backfill of the DynamoDB projection from a QLDB journal export, to rebuild the transactions and balances tables
+without replaying the Kinesis stream. The export files (Ion text or binary journal blocks, as written by
+ExportJournalToS3) are read from a local directory, and revisions go through the stream handler's filter and
+conversion, so the items are the same as the ones lambda_stream_transactions writes.
+
+The backfill runs in two stages, each on a pool of processes:
+   1. shuffle: every export file is read by one process, which keeps the revisions of --table with data and spools
+      their items into --partitions files by account hash
+   2. write: every partition is written by one process, the history items with BatchWriteItem and, for the balances
+      table, only the latest revision of each account with the stream handler's version-conditional put, so a
+      backfill running next to the stream never overwrites a newer balance. With --rollups-table, the revisions of
+      each account are folded into its daily and monthly rollups by the stream handler's RollupWriter, in version
+      order, including the revisions whose history items have expired.
+Writes are rate limited to --max-write-units write capacity units per second across the processes.
+
+Rollups start from the first revision exported for an account, and the rollup cursor skips revisions already
+folded, so rollups are only complete when the export starts at the creation of the documents and the stream has not
+folded later revisions of an account before the backfill: backfill the rollups into an empty table, before the
+stream consumer is given the rollups table.
+
+Progress is saved in <work-dir>/progress.json after every export file and partition; an interrupted backfill resumes
+with the files and partitions not done yet. With --dry-run nothing is written to DynamoDB, and the report gives the
+throughput of each stage and the time the writes would take at --max-write-units.
+
+Usage (from the src/ directory, with the stream Lambda requirements installed):
+   python tools/backfill.py --export-dir ./export --work-dir ./backfill --table Wallet
+                            --transactions-table wallet-transactions-wallet
+                            [--balances-table wallet-balances-wallet] [--rollups-table wallet-rollups-wallet]
+                            [--processes 8] [--partitions 256]
+                            [--max-write-units 20000] [--ttl-attribute expire_timestamp --expire-after-days 30]
+                            [--include-expired] [--dry-run]
+"""
+
+import argparse
+import glob
+import hashlib
+import json
+import logging
+import math
+import os
+import pickle
+import sys
+import time
+import zlib
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lambda',
+                                'lambda_stream_transactions'))
+
+import amazon.ion.simpleion as ion  # noqa: E402
+from ddb_batch_writer import BatchWriter  # noqa: E402
+from ddb_item_converter import balance_view_item, revision_item  # noqa: E402
+from ddb_rollups import RollupWriter, periods_of, revision_chunks  # noqa: E402
+from ddb_versioned_writer import RecentRevisions, VersionedWriter  # noqa: E402
+
+logger = logging.getLogger()
+
+# Items written between two rate limiter checks, a multiple of the 25 items of a BatchWriteItem call
+WRITE_CHUNK = 500
+# Balance items written concurrently by each process
+BALANCE_WRITE_CONCURRENCY = 8
+PROGRESS_FILE = 'progress.json'
+# Attributes of a revision kept in memory to fold it into the rollups
+ROLLUP_ATTRIBUTES = ('accountId', 'balance', 'buckets', 'version', 'txTime')
+
+# One DynamoDB resource per worker process, created on first use
+_dynamodb = None
+
+
+def dynamodb_resource():
+    global _dynamodb
+    if _dynamodb is None:
+        import boto3
+        from botocore.config import Config
+        _dynamodb = boto3.resource('dynamodb', config=Config(max_pool_connections=BALANCE_WRITE_CONCURRENCY + 2))
+    return _dynamodb
+
+
+def account_partition(account_id, partitions):
+    # Stable across processes, unlike hash()
+    return zlib.crc32(account_id.encode('utf-8')) % partitions
+
+
+def export_files(export_dir):
+    """
+    Lists the data files of a journal export in order: the keys of its completed manifest when present,
+    otherwise every .ion file under the directory
+    """
+
+    manifests = glob.glob(os.path.join(export_dir, '**', '*.completed.manifest'), recursive=True)
+    if manifests:
+        with open(manifests[0], 'rb') as file:
+            keys = ion.load(file)['keys']
+        files = {os.path.basename(path): path
+                 for path in glob.glob(os.path.join(export_dir, '**', '*.ion'), recursive=True)}
+        missing = [key for key in keys if os.path.basename(key) not in files]
+        if missing:
+            raise FileNotFoundError(f"{len(missing)} files of the manifest are missing, e.g. {missing[0]}")
+        return [files[os.path.basename(key)] for key in keys]
+
+    return sorted(path for path in glob.glob(os.path.join(export_dir, '**', '*.ion'), recursive=True)
+                  if not path.endswith('.manifest'))
+
+
+def journal_revisions(block, table_names):
+    """
+    Yields the revisions of a journal block that belong to one of table_names, in the format of the stream handler's
+    decoded REVISION_DETAILS records. The table of a revision is found in the block's transactionInfo.
+    """
+
+    documents = (block.get('transactionInfo') or {}).get('documents') or {}
+    for revision in block.get('revisions') or []:
+        metadata = revision.get('metadata')
+        # Revisions of system tables and redacted revisions only hold a hash
+        if not metadata:
+            continue
+        table_info = documents.get(str(metadata['id'])) or {}
+        if table_info.get('tableName') not in table_names:
+            continue
+        yield {'table_info': table_info, 'revision_data': revision.get('data'), 'revision_metadata': metadata}
+
+
+def spool_path(work_dir, partition, file_id):
+    return os.path.join(work_dir, 'spool', f"{partition:04d}", f"{file_id}.pickle")
+
+
+def write_spool(path, items):
+    # Written under a temporary name, so a spool file is either complete or absent
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temporary_path = f"{path}.tmp"
+    with open(temporary_path, 'wb') as file:
+        pickle.dump(items, file, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(temporary_path, path)
+
+
+def shuffle_file(path, work_dir, partitions, table_name, ttl_attribute, expire_after_days, day_index_attribute=None):
+    """
+    Converts the revisions of one export file and spools their items by account partition. Expired items are
+    spooled too: the latest balance and the rollups of an account are computed from all its revisions.
+    Returns:
+       The counters of the file
+    """
+
+    started = time.perf_counter()
+    counters = {'blocks': 0, 'revisions': 0, 'items': 0, 'spoolBytes': 0}
+    spooled = {}
+
+    with open(path, 'rb') as file:
+        blocks = ion.load(file, single_value=False)
+
+    for block in blocks:
+        counters['blocks'] += 1
+        for revision in journal_revisions(block, [table_name]):
+            counters['revisions'] += 1
+            item = revision_item(revision, ttl_attribute=ttl_attribute, expire_after_days=expire_after_days,
+                                 day_index_attribute=day_index_attribute)
+            if item is None:
+                continue
+            spooled.setdefault(account_partition(item['accountId'], partitions), []).append(item)
+            counters['items'] += 1
+
+    file_id = hashlib.sha1(os.path.abspath(path).encode('utf-8')).hexdigest()[:16]
+    for partition, items in spooled.items():
+        spool = spool_path(work_dir, partition, file_id)
+        write_spool(spool, items)
+        counters['spoolBytes'] += os.path.getsize(spool)
+
+    counters['seconds'] = time.perf_counter() - started
+    return counters
+
+
+class RateLimiter:
+    """
+    Token bucket of write capacity units, refilled at rate units per second with a burst of one second
+    """
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.tokens = rate
+        self.updated = time.monotonic()
+
+    def acquire(self, units):
+        if not self.rate:
+            return
+        now = time.monotonic()
+        self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= units
+        if self.tokens < 0:
+            time.sleep(-self.tokens / self.rate)
+
+
+def write_units(item):
+    # A put consumes one write capacity unit per KB of item
+    return max(1, math.ceil(len(json.dumps(item, default=str)) / 1024))
+
+
+def rollup_units(revisions):
+    # Each transaction updates the cursor and every period it touches, at two write units per item
+    return sum(2 * (len({period for revision in chunk for period in periods_of(revision['txTime'])}) + 1)
+               for chunk in revision_chunks(revisions))
+
+
+def write_partition(partition, work_dir, transactions_table, balances_table, write_rate, dry_run,
+                    rollups_table=None, ttl_attribute=None, include_expired=False):
+    """
+    Writes the spooled items of one partition, one spool file in memory at a time. History items whose TTL has
+    passed are not written, unless include_expired, as the TTL would delete them right away.
+    Returns:
+       The counters of the partition; failed counts items, and revisions not folded into the rollups,
+       left unwritten after retries
+    """
+
+    started = time.perf_counter()
+    counters = {'items': 0, 'expired': 0, 'balances': 0, 'rollups': 0, 'writeUnits': 0, 'failed': 0}
+    limiter = RateLimiter(write_rate)
+    history_writer = None if dry_run else BatchWriter(dynamodb_resource(), transactions_table,
+                                                      key_attributes=('accountId', 'txTime'))
+    now = int(time.time())
+    latest = {}
+    revisions = {}
+
+    def write(writer, items):
+        units = sum(write_units(item) for item in items)
+        counters['writeUnits'] += units
+        if dry_run:
+            return
+        limiter.acquire(units)
+        for item in items:
+            writer.add(item)
+        counters['failed'] += len(writer.flush())
+
+    for spool in sorted(glob.glob(os.path.join(work_dir, 'spool', f"{partition:04d}", '*.pickle'))):
+        with open(spool, 'rb') as file:
+            items = pickle.load(file)
+        history_items = [item for item in items if include_expired or not ttl_attribute or
+                         item.get(ttl_attribute, now + 1) > now]
+        for start in range(0, len(history_items), WRITE_CHUNK):
+            write(history_writer, history_items[start:start + WRITE_CHUNK])
+        counters['items'] += len(history_items)
+        counters['expired'] += len(items) - len(history_items)
+        for item in items:
+            if item['accountId'] not in latest or latest[item['accountId']]['version'] < item['version']:
+                latest[item['accountId']] = item
+            if rollups_table:
+                revisions.setdefault(item['accountId'], []).append(
+                    {attribute: item[attribute] for attribute in ROLLUP_ATTRIBUTES if attribute in item})
+
+    if balances_table:
+        balance_writer = None if dry_run else VersionedWriter(dynamodb_resource().Table(balances_table),
+                                                              key_attributes=('accountId',),
+                                                              recent_revisions=RecentRevisions(0),
+                                                              max_workers=BALANCE_WRITE_CONCURRENCY)
+        balance_items = [balance_view_item(item) for item in latest.values()]
+        for start in range(0, len(balance_items), WRITE_CHUNK):
+            write(balance_writer, balance_items[start:start + WRITE_CHUNK])
+        counters['balances'] = len(balance_items)
+
+    if rollups_table:
+        # The spool files of a partition are in no particular order, so every revision of an account is read
+        # before its rollups are folded, in version order, by one writer call
+        rollup_writer = None if dry_run else RollupWriter(dynamodb_resource().Table(rollups_table),
+                                                          max_workers=BALANCE_WRITE_CONCURRENCY)
+        account_ids = list(revisions)
+        for start in range(0, len(account_ids), WRITE_CHUNK):
+            units = 0
+            for account_id in account_ids[start:start + WRITE_CHUNK]:
+                account_revisions = sorted(revisions.pop(account_id), key=lambda revision: revision['version'])
+                units += rollup_units(account_revisions)
+                counters['rollups'] += len(account_revisions)
+                if rollup_writer:
+                    for revision in account_revisions:
+                        rollup_writer.add(revision)
+            counters['writeUnits'] += units
+            if rollup_writer:
+                limiter.acquire(units)
+                counters['failed'] += len(rollup_writer.flush())
+
+    counters['seconds'] = time.perf_counter() - started
+    return counters
+
+
+class Progress:
+    """
+    Export files shuffled and partitions written, with their counters, saved as JSON after every change
+    """
+
+    def __init__(self, work_dir, partitions):
+        self.path = os.path.join(work_dir, PROGRESS_FILE)
+        self.state = {'partitions': partitions, 'files': {}, 'written': {}}
+        if os.path.exists(self.path):
+            with open(self.path) as file:
+                self.state = json.load(file)
+            if self.state['partitions'] != partitions:
+                raise ValueError(f"{self.path} was written with {self.state['partitions']} partitions")
+
+    def record(self, section, name, counters):
+        self.state[section][str(name)] = counters
+        temporary_path = f"{self.path}.tmp"
+        with open(temporary_path, 'w') as file:
+            json.dump(self.state, file, indent=1)
+        os.replace(temporary_path, self.path)
+
+
+def total(counters_list, name):
+    return sum(counters.get(name, 0) for counters in counters_list)
+
+
+def run_stage(pool, function, tasks, on_done):
+    """
+    Runs function on every (name, arguments) task in the pool, calling on_done as each one completes
+    Returns:
+       The wall time of the stage in seconds
+    """
+
+    started = time.perf_counter()
+    futures = {pool.submit(function, *arguments): name for name, arguments in tasks}
+    for future in as_completed(futures):
+        on_done(futures[future], future.result())
+    return time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--export-dir', required=True, help='Directory holding the journal export files')
+    parser.add_argument('--work-dir', required=True, help='Directory of the spool files and progress')
+    parser.add_argument('--table', default='Wallet', help='QLDB table name')
+    parser.add_argument('--transactions-table', help='DynamoDB transactions table name')
+    parser.add_argument('--balances-table', default=None, help='DynamoDB balances table name')
+    parser.add_argument('--rollups-table', default=None, help='DynamoDB rollups table name')
+    parser.add_argument('--processes', type=int, default=os.cpu_count())
+    parser.add_argument('--partitions', type=int, default=256, help='Account partitions, fixed for a backfill')
+    parser.add_argument('--max-write-units', type=float, default=10000,
+                        help='Write capacity units per second across all processes, 0 for no limit')
+    parser.add_argument('--ttl-attribute', default=None)
+    parser.add_argument('--expire-after-days', type=int, default=None)
+    parser.add_argument('--day-index-attribute', default=None,
+                        help='txDayShard when the history is archived, so the archive runs find the items')
+    parser.add_argument('--include-expired', action='store_true', help='Also write items whose TTL has passed')
+    parser.add_argument('--dry-run', action='store_true', help='Report throughput without writing to DynamoDB')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+    if not args.dry_run and not args.transactions_table:
+        parser.error('--transactions-table is required unless --dry-run')
+
+    os.makedirs(args.work_dir, exist_ok=True)
+    progress = Progress(args.work_dir, args.partitions)
+    files = export_files(args.export_dir)
+    pending_files = [path for path in files if path not in progress.state['files']]
+    logger.info(f"{len(files)} export files, {len(pending_files)} to shuffle")
+
+    def file_done(path, counters):
+        progress.record('files', path, counters)
+        logger.info(f"Shuffled {path}: {counters['revisions']} revisions, {counters['items']} items")
+
+    pending_partitions = [partition for partition in range(args.partitions)
+                          if args.dry_run or str(partition) not in progress.state['written']]
+    write_rate = args.max_write_units / max(1, min(args.processes, len(pending_partitions)))
+    written = {}
+
+    def partition_done(partition, counters):
+        written[partition] = counters
+        if counters['failed']:
+            logger.error(f"Partition {partition}: {counters['failed']} items or rollup revisions not written, "
+                         f"run again to retry")
+        elif not args.dry_run:
+            progress.record('written', partition, counters)
+
+    with ProcessPoolExecutor(max_workers=args.processes) as pool:
+        shuffle_seconds = run_stage(pool, shuffle_file, [
+            (path, (path, args.work_dir, args.partitions, args.table, args.ttl_attribute, args.expire_after_days,
+                    args.day_index_attribute))
+            for path in pending_files], file_done)
+        write_seconds = run_stage(pool, write_partition, [
+            (partition, (partition, args.work_dir, args.transactions_table, args.balances_table, write_rate,
+                         args.dry_run, args.rollups_table, args.ttl_attribute, args.include_expired))
+            for partition in pending_partitions], partition_done)
+
+    shuffled = [progress.state['files'][path] for path in pending_files]
+    revisions = total(shuffled, 'revisions')
+    items = total(written.values(), 'items')
+    units = total(written.values(), 'writeUnits')
+    logger.info(f"Shuffle: {len(shuffled)} files, {revisions} revisions, {total(shuffled, 'items')} items, "
+                f"{total(shuffled, 'spoolBytes')} spool bytes in {shuffle_seconds:.1f}s "
+                f"({revisions / max(shuffle_seconds, 1e-9):.0f} revisions/s)")
+    logger.info(f"Write: {len(written)} partitions, {items} history items, {total(written.values(), 'expired')} "
+                f"expired, {total(written.values(), 'balances')} balances, {total(written.values(), 'rollups')} "
+                f"rollup revisions, {units} write units, {total(written.values(), 'failed')} failed in "
+                f"{write_seconds:.1f}s ({items / max(write_seconds, 1e-9):.0f} items/s)")
+    if args.dry_run and args.max_write_units:
+        logger.info(f"Dry run: the writes would take {units / args.max_write_units / 3600:.2f}h "
+                    f"at {args.max_write_units:.0f} write units per second")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,403 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+"""
+Reconciliation of the balances projected by lambda_stream_transactions with the ledger.
+
+The balances table is read with a parallel scan: each of --segments segments is a key range of the table, read in
+pages of --page-size items by a pool of --workers threads. The documents of a page are read from QLDB with
+IN queries of --ledger-chunk account ids, and the balance and version of every document are compared.
+Accounts whose projection is only behind the ledger are read again once every segment is done, so revisions still
+in the stream are not reported; the others are drifted:
+   missing: the document is not in the ledger
+   balance: same version, different balance
+   ahead: the projection holds a version the ledger does not have yet
+   behind: the projection is still older than the ledger when read again
+
+Progress is saved in a checkpoint file after every page, so an interrupted run resumes where it stopped, and
+drifted accounts are appended to an NDJSON report. A page is reported before its progress is saved, so a resumed run
+skips the accounts already in the report rather than appending them twice; a new run starts a new report.
+The checkpoint of a completed run is kept, delete it to start a new run. Accounts never projected are not seen by
+the scan.
+
+Usage (from the src/ directory):
+   python tools/reconcile.py --ledger wallet --table Wallet --balances-table wallet-balances-wallet
+                             [--segments 64] [--workers 16] [--checkpoint reconcile.checkpoint.json]
+                             [--report reconcile.drift.ndjson]
+   python tools/reconcile.py --local 100000 [--drift 25]   (in-memory stand-ins for both stores)
+"""
+
+import argparse
+import decimal
+import json
+import logging
+import os
+import random
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger()
+
+# Largest page of a DynamoDB scan is 1 MB, a few thousand balance items
+DEFAULT_PAGE_SIZE = 1000
+# Account ids per IN query on the ledger's accountId index
+DEFAULT_LEDGER_CHUNK = 100
+PROJECTION_ATTRIBUTES = ('accountId', 'balance', 'version')
+
+
+class InMemoryProjection:
+    """
+    In-process stand-in for the balances table, scanned in segments like DynamoDB's parallel scan
+    """
+
+    def __init__(self, items):
+        self.items = {item['accountId']: item for item in sorted(items, key=lambda item: item['accountId'])}
+        self._segments = {}
+
+    def segment_items(self, segment, total_segments):
+        if total_segments not in self._segments:
+            items = list(self.items.values())
+            self._segments[total_segments] = [items[first::total_segments] for first in range(total_segments)]
+        return self._segments[total_segments][segment]
+
+    def scan(self, segment, total_segments, start_key=None, limit=DEFAULT_PAGE_SIZE):
+        items = self.segment_items(segment, total_segments)
+        start = 0
+        if start_key:
+            account_ids = [item['accountId'] for item in items]
+            start = account_ids.index(start_key['accountId']) + 1
+        page = [dict(item) for item in items[start:start + limit]]
+        last_key = {'accountId': page[-1]['accountId']} if page and start + limit < len(items) else None
+        return page, last_key
+
+    def get_many(self, account_ids):
+        return {account_id: dict(self.items[account_id]) for account_id in account_ids if account_id in self.items}
+
+
+class InMemoryLedger:
+    """
+    In-process stand-in for the QLDB table, holding the balance and version of every document
+    """
+
+    def __init__(self, documents):
+        self.documents = {document['accountId']: dict(document) for document in documents}
+        self.statements = 0
+
+    def get_many(self, account_ids):
+        self.statements += 1
+        return {account_id: dict(self.documents[account_id]) for account_id in account_ids
+                if account_id in self.documents}
+
+
+class DynamoDBProjection:
+    def __init__(self, table):
+        self.table = table
+
+    def scan(self, segment, total_segments, start_key=None, limit=DEFAULT_PAGE_SIZE):
+        names = {f"#a{position}": name for position, name in enumerate(PROJECTION_ATTRIBUTES)}
+        scan_arguments = {'Segment': segment, 'TotalSegments': total_segments, 'Limit': limit,
+                          'ProjectionExpression': ', '.join(names), 'ExpressionAttributeNames': names}
+        if start_key:
+            scan_arguments['ExclusiveStartKey'] = start_key
+        response = self.table.scan(**scan_arguments)
+        return response['Items'], response.get('LastEvaluatedKey')
+
+    def get_many(self, account_ids):
+        items = {}
+        for account_id in account_ids:
+            item = self.table.get_item(Key={'accountId': account_id}, ConsistentRead=True).get('Item')
+            if item:
+                items[account_id] = item
+        return items
+
+
+class QldbLedger:
+    def __init__(self, qldb_driver, table_name):
+        self.qldb_driver = qldb_driver
+        self.table_name = table_name
+
+    def get_many(self, account_ids):
+        placeholders = ', '.join('?' for _ in account_ids)
+        statement = (f"SELECT r.data.accountId, r.data.balance, r.metadata.version "
+                     f"FROM _ql_committed_{self.table_name} AS r WHERE r.data.accountId IN ({placeholders})")
+
+        def read(executor):
+            return {document['accountId']: document
+                    for document in executor.execute_statement(statement, *account_ids)}
+
+        return self.qldb_driver.execute_lambda(read)
+
+
+def compare(item, document):
+    """
+    Compares a projected balance item with its ledger document
+    Returns:
+       None when they agree, otherwise the kind of drift
+    """
+
+    if document is None:
+        return 'missing'
+    projected_version = int(item['version'])
+    ledger_version = int(document['version'])
+    if projected_version < ledger_version:
+        return 'behind'
+    if projected_version > ledger_version:
+        return 'ahead'
+    if decimal.Decimal(item['balance']) != decimal.Decimal(document['balance']):
+        return 'balance'
+    return None
+
+
+class Checkpoint:
+    """
+    Progress of a run, saved as JSON: the last key read in every segment, whether the segment is done, the accounts
+    left to read again and the counters. The file is replaced atomically, so a crash leaves the previous save.
+    """
+
+    def __init__(self, path, total_segments):
+        self.path = path
+        self.lock = threading.Lock()
+        self.resumed = False
+        self.state = {'totalSegments': total_segments, 'segments': {}, 'behind': [],
+                      'counters': {'scanned': 0, 'drifted': 0, 'behind': 0}, 'startedAt': int(time.time())}
+        if path and os.path.exists(path):
+            with open(path) as file:
+                state = json.load(file)
+            if state['totalSegments'] != total_segments:
+                raise ValueError(f"Checkpoint {path} was written with {state['totalSegments']} segments")
+            self.state = state
+            self.resumed = True
+
+    def segment(self, segment):
+        return self.state['segments'].get(str(segment), {'lastKey': None, 'done': False})
+
+    def save_page(self, segment, last_key, scanned, drifted, behind):
+        with self.lock:
+            self.state['segments'][str(segment)] = {'lastKey': last_key, 'done': last_key is None}
+            self.state['behind'].extend(behind)
+            counters = self.state['counters']
+            counters['scanned'] += scanned
+            counters['drifted'] += drifted
+            counters['behind'] += len(behind)
+            self.save()
+
+    def save(self):
+        if not self.path:
+            return
+        temporary_path = f"{self.path}.tmp"
+        with open(temporary_path, 'w') as file:
+            json.dump(self.state, file, default=str)
+        os.replace(temporary_path, self.path)
+
+
+class DriftReport:
+    """
+    Appends drifted accounts to an NDJSON file, one object per line. Every account is reported at most once: the
+    report of a resumed run is read back, and accounts already in it are skipped.
+    Parameters:
+       path (string): NDJSON file, or None to keep the drifts in memory only
+       resume (bool): Whether the run resumes from a checkpoint, otherwise an existing report is replaced
+    """
+
+    def __init__(self, path, resume=False):
+        self.path = path
+        self.lock = threading.Lock()
+        self.drifts = []
+        self.reported = set()
+        if path and os.path.exists(path):
+            if resume:
+                with open(path) as file:
+                    self.drifts = [json.loads(line) for line in file if line.strip()]
+                self.reported = {drift['accountId'] for drift in self.drifts}
+            else:
+                os.remove(path)
+
+    def add(self, drifts):
+        with self.lock:
+            drifts = [drift for drift in drifts if drift['accountId'] not in self.reported]
+            if not drifts:
+                return
+            self.drifts.extend(drifts)
+            self.reported.update(drift['accountId'] for drift in drifts)
+            if self.path:
+                with open(self.path, 'a') as file:
+                    for drift in drifts:
+                        file.write(json.dumps(drift, default=str) + '\n')
+
+
+def drift_entry(kind, item, document):
+    return {
+        'accountId': item['accountId'],
+        'drift': kind,
+        'projectedBalance': item.get('balance'),
+        'projectedVersion': item.get('version'),
+        'ledgerBalance': document and document.get('balance'),
+        'ledgerVersion': document and document.get('version')
+    }
+
+
+def chunks(values, size):
+    for start in range(0, len(values), size):
+        yield values[start:start + size]
+
+
+class Reconciler:
+    """
+    Compares the projection with the ledger, segment by segment, with a pool of workers
+    Parameters:
+       projection: DynamoDBProjection or InMemoryProjection
+       ledger: QldbLedger or InMemoryLedger
+       checkpoint (Checkpoint): Progress, possibly loaded from a previous run
+       report (DriftReport): Receives the drifted accounts
+    """
+
+    def __init__(self, projection, ledger, checkpoint, report, workers=16, page_size=DEFAULT_PAGE_SIZE,
+                 ledger_chunk=DEFAULT_LEDGER_CHUNK):
+        self.projection = projection
+        self.ledger = ledger
+        self.checkpoint = checkpoint
+        self.report = report
+        self.workers = workers
+        self.page_size = page_size
+        self.ledger_chunk = ledger_chunk
+
+    def compare_items(self, items, report_behind=False):
+        """
+        Returns:
+           (drifts, behind): the drift entries, and the account ids whose projection is behind the ledger,
+           unless report_behind makes them drifts
+        """
+
+        documents = {}
+        for account_ids in chunks([item['accountId'] for item in items], self.ledger_chunk):
+            documents.update(self.ledger.get_many(account_ids))
+
+        drifts = []
+        behind = []
+        for item in items:
+            document = documents.get(item['accountId'])
+            kind = compare(item, document)
+            if kind == 'behind' and not report_behind:
+                behind.append(item['accountId'])
+            elif kind:
+                drifts.append(drift_entry(kind, item, document))
+        return drifts, behind
+
+    def reconcile_segment(self, segment):
+        total_segments = self.checkpoint.state['totalSegments']
+        progress = self.checkpoint.segment(segment)
+        if progress['done']:
+            return
+        last_key = progress['lastKey']
+
+        while True:
+            items, last_key = self.projection.scan(segment, total_segments, start_key=last_key, limit=self.page_size)
+            drifts, behind = self.compare_items(items)
+            self.report.add(drifts)
+            self.checkpoint.save_page(segment, last_key, len(items), len(drifts), behind)
+            if last_key is None:
+                return
+
+    def recheck_behind(self):
+        """
+        Reads the accounts found behind the ledger again, reporting those still behind or drifted otherwise
+        """
+
+        account_ids = list(dict.fromkeys(self.checkpoint.state['behind']))
+        for chunk in chunks(account_ids, self.page_size):
+            drifts, _ = self.compare_items(list(self.projection.get_many(chunk).values()), report_behind=True)
+            self.report.add(drifts)
+            with self.checkpoint.lock:
+                self.checkpoint.state['counters']['drifted'] += len(drifts)
+
+        with self.checkpoint.lock:
+            self.checkpoint.state['behind'] = []
+            self.checkpoint.state['done'] = True
+            self.checkpoint.save()
+
+    def run(self):
+        """
+        Returns:
+           The counters of the run
+        """
+
+        if self.checkpoint.state.get('done'):
+            logger.info('The checkpoint is from a completed run, nothing to do')
+            return self.checkpoint.state['counters']
+
+        segments = range(self.checkpoint.state['totalSegments'])
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            # list() raises the first exception of a segment, its progress until then is in the checkpoint
+            list(pool.map(self.reconcile_segment, segments))
+        self.recheck_behind()
+
+        return self.checkpoint.state['counters']
+
+
+def local_stores(accounts, drift, seed):
+    """
+    Builds in-memory stores of accounts in the same state, except drift accounts of each kind of drift:
+    another balance, a version ahead of the ledger, and a document missing from the ledger
+    """
+
+    rng = random.Random(seed)
+    documents = [{'accountId': f"account-{position:08d}", 'balance': decimal.Decimal(rng.randint(0, 10 ** 6)) / 100,
+                  'version': rng.randint(0, 50)} for position in range(accounts)]
+    items = [dict(document) for document in documents]
+
+    drifted = rng.sample(range(accounts), min(accounts, drift * 3))
+    for position in drifted[:drift]:
+        items[position]['balance'] += 1
+    for position in drifted[drift:2 * drift]:
+        items[position]['version'] += 1
+    missing = set(drifted[2 * drift:])
+    return InMemoryProjection(items), InMemoryLedger([document for position, document in enumerate(documents)
+                                                      if position not in missing])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--ledger', help='QLDB ledger name')
+    parser.add_argument('--table', default='Wallet', help='QLDB table name')
+    parser.add_argument('--balances-table', help='DynamoDB balances table name')
+    parser.add_argument('--segments', type=int, default=64, help='Parallel scan segments of the balances table')
+    parser.add_argument('--workers', type=int, default=16)
+    parser.add_argument('--page-size', type=int, default=DEFAULT_PAGE_SIZE)
+    parser.add_argument('--ledger-chunk', type=int, default=DEFAULT_LEDGER_CHUNK)
+    parser.add_argument('--checkpoint', default=None, help='Checkpoint file, resumed when it exists')
+    parser.add_argument('--report', default=None, help='NDJSON file receiving the drifted accounts')
+    parser.add_argument('--local', type=int, default=None, help='Number of accounts of in-memory stand-ins')
+    parser.add_argument('--drift', type=int, default=10, help='Drifted accounts of each kind with --local')
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+
+    if args.local is not None:
+        projection, ledger = local_stores(args.local, args.drift, args.seed)
+    else:
+        if not args.ledger or not args.balances_table:
+            parser.error('--ledger and --balances-table are required without --local')
+        import boto3
+        from botocore.config import Config
+        sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lambda',
+                                        'wallet_core_layer'))
+        from wallet_core.qldb import create_qldb_driver
+        dynamodb = boto3.resource('dynamodb', config=Config(max_pool_connections=max(10, args.workers)))
+        projection = DynamoDBProjection(dynamodb.Table(args.balances_table))
+        ledger = QldbLedger(create_qldb_driver(args.ledger), args.table)
+
+    started = time.perf_counter()
+    checkpoint = Checkpoint(args.checkpoint, args.segments)
+    reconciler = Reconciler(projection, ledger, checkpoint, DriftReport(args.report, resume=checkpoint.resumed),
+                            workers=args.workers, page_size=args.page_size, ledger_chunk=args.ledger_chunk)
+    counters = reconciler.run()
+    logger.info(f"Reconciled {counters['scanned']} accounts in {time.perf_counter() - started:.1f}s, "
+                f"{counters['drifted']} drifted")
+    for drift in reconciler.report.drifts[:20]:
+        logger.info(json.dumps(drift, default=str))
+
+
+if __name__ == '__main__':
+    main()
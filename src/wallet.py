@@ -11,6 +11,10 @@ from aws_cdk import (
     core as cdk,
     aws_dynamodb,
     aws_kinesis,
+    aws_sqs,
+    aws_s3,
+    aws_events,
+    aws_events_targets,
     aws_apigateway as apigw
 )
 from config_file import config
@@ -20,10 +24,27 @@ ACCOUNT = config['account']
 REGION = config['region']
 LOG_LEVEL = config['log_level']
 QLDB_TABLE_NAME = config['qldb_table_name']
+QLDB_CREDITS_TABLE_NAME = config.get('qldb_credits_table_name', f"{QLDB_TABLE_NAME}Credits")
 LOG_RETENTION = config['log_retention']
 SHARD_COUNT = config['shard_count']
 TTL_ATTRIBUTE = config['ttl_attribute']
 EXPIRE_AFTER_DAYS = config['expire_after_days']
+STREAM_RETRY_ATTEMPTS = config.get('stream_retry_attempts', 10)
+STREAM_WRITE_CONCURRENCY = config.get('stream_write_concurrency', 8)
+STREAM_AGGREGATION = config.get('stream_aggregation', False)
+STREAM_BATCH_SIZE = config.get('stream_batch_size', 100)
+STREAM_BATCHING_WINDOW_SECONDS = config.get('stream_batching_window_seconds', 0)
+STREAM_PARALLELIZATION_FACTOR = config.get('stream_parallelization_factor', 1)
+STREAM_ENHANCED_FAN_OUT = config.get('stream_enhanced_fan_out', False)
+QLDB_RETRY_LIMIT = config.get('qldb_retry_limit', 4)
+QLDB_RETRY_BASE_MS = config.get('qldb_retry_base_ms', 10)
+QLDB_RETRY_MAX_MS = config.get('qldb_retry_max_ms', 2000)
+SINGLE_ROUTER_FUNCTION = config.get('single_router_function', True)
+CREDIT_BATCH_SIZE = config.get('credit_batch_size', 100)
+CREDIT_BATCHING_WINDOW_SECONDS = config.get('credit_batching_window_seconds', 2)
+ARCHIVE_HISTORY = config.get('archive_history', False)
+ARCHIVE_LEAD_DAYS = config.get('archive_lead_days', 2)
+ARCHIVE_PARTITIONS = config.get('archive_partitions', 16)
 
 
 class ServerlessWallet(cdk.Stack):
@@ -53,7 +74,7 @@ class ServerlessWallet(cdk.Stack):
                                          stream_name=f"qldb-stream-{LEDGER_NAME}",
                                          inclusive_start_time="2019-06-13T21:36:34Z",
                                          kinesis_configuration=aws_qldb.CfnStream.KinesisConfigurationProperty(
-                                             aggregation_enabled=False,
+                                             aggregation_enabled=STREAM_AGGREGATION,
                                              stream_arn=kinesis_stream.stream_arn),
                                          role_arn=qldb_stream_role.role_arn
                                          )
@@ -68,12 +89,29 @@ class ServerlessWallet(cdk.Stack):
                                        removal_policy=cdk.RemovalPolicy.DESTROY,
                                        time_to_live_attribute=TTL_ATTRIBUTE)
 
+        # Current balance of each account, projected from the QLDB stream for eventually consistent reads
+        balances_table = aws_dynamodb.Table(self, 'ddb-balances-table', table_name=f"wallet-balances-{LEDGER_NAME}",
+                                            partition_key=aws_dynamodb.Attribute(name='accountId',
+                                                                                 type=aws_dynamodb.AttributeType.STRING),
+                                            billing_mode=aws_dynamodb.BillingMode.PAY_PER_REQUEST,
+                                            removal_policy=cdk.RemovalPolicy.DESTROY)
+
+        # Daily and monthly rollups of each account, maintained from the QLDB stream
+        rollups_table = aws_dynamodb.Table(self, 'ddb-rollups-table', table_name=f"wallet-rollups-{LEDGER_NAME}",
+                                           partition_key=aws_dynamodb.Attribute(name='accountId',
+                                                                                type=aws_dynamodb.AttributeType.STRING),
+                                           billing_mode=aws_dynamodb.BillingMode.PAY_PER_REQUEST,
+                                           sort_key=aws_dynamodb.Attribute(name='period',
+                                                                           type=aws_dynamodb.AttributeType.STRING),
+                                           removal_policy=cdk.RemovalPolicy.DESTROY)
+
         # Create IAM Roles and policies for Lambda functions
         qldb_access_policy = aws_iam.PolicyStatement(actions=['qldb:SendCommand'], effect=aws_iam.Effect.ALLOW,
                                                      resources=[
                                                          f"arn:aws:qldb:{REGION}:{ACCOUNT}:ledger/{LEDGER_NAME}"])
 
-        ddb_table_policy = aws_iam.PolicyStatement(actions=['dynamodb:Query', 'dynamodb:PutItem'],
+        ddb_table_policy = aws_iam.PolicyStatement(actions=['dynamodb:Query', 'dynamodb:PutItem',
+                                                            'dynamodb:BatchWriteItem'],
                                                    effect=aws_iam.Effect.ALLOW,
                                                    resources=[ddb_table.table_arn])
 
@@ -88,55 +126,148 @@ class ServerlessWallet(cdk.Stack):
             aws_iam.ManagedPolicy.from_aws_managed_policy_name(managed_policy_name='AWSLambdaExecute'))
         lambda_ddb_role.add_to_policy(ddb_table_policy)
 
+        # Shared wallet_core package used by the API functions
+        wallet_core_layer = aws_lambda_python.PythonLayerVersion(self, 'wallet-core-layer',
+                                                                 entry='lambda/wallet_core_layer',
+                                                                 compatible_runtimes=[aws_lambda.Runtime.PYTHON_3_8])
+
         # Create Lambda functions
-        lambda_get_funds = aws_lambda_python.PythonFunction(self, 'get-funds-lambda', entry='lambda/lambda_get_funds',
-                                                            handler='lambda_handler',
-                                                            index='lambda_function.py',
-                                                            runtime=aws_lambda.Runtime.PYTHON_3_8,
-                                                            role=lambda_qldb_role,
-                                                            log_retention=LOG_RETENTION,
-                                                            memory_size=512,
-                                                            tracing=aws_lambda.Tracing.ACTIVE)
-
-        lambda_withdraw_funds = aws_lambda_python.PythonFunction(self, 'withdraw-funds-lambda',
-                                                                 entry='lambda/lambda_withdraw_funds',
-                                                                 handler='lambda_handler',
-                                                                 index='lambda_function.py',
-                                                                 runtime=aws_lambda.Runtime.PYTHON_3_8,
-                                                                 role=lambda_qldb_role,
-                                                                 log_retention=LOG_RETENTION,
-                                                                 memory_size=512,
-                                                                 tracing=aws_lambda.Tracing.ACTIVE)
-
-        lambda_add_funds = aws_lambda_python.PythonFunction(self, 'add-funds-lambda',
-                                                            entry='lambda/lambda_add_funds',
-                                                            handler='lambda_handler',
-                                                            index='lambda_function.py',
-                                                            runtime=aws_lambda.Runtime.PYTHON_3_8,
-                                                            role=lambda_qldb_role,
-                                                            log_retention=LOG_RETENTION,
-                                                            memory_size=512,
-                                                            tracing=aws_lambda.Tracing.ACTIVE)
-
-        lambda_create_account = aws_lambda_python.PythonFunction(self, 'create-account-lambda',
-                                                                 entry='lambda/lambda_create_account',
-                                                                 handler='lambda_handler',
-                                                                 index='lambda_function.py',
-                                                                 runtime=aws_lambda.Runtime.PYTHON_3_8,
-                                                                 role=lambda_qldb_role,
-                                                                 log_retention=LOG_RETENTION,
-                                                                 memory_size=512,
-                                                                 tracing=aws_lambda.Tracing.ACTIVE)
+        if SINGLE_ROUTER_FUNCTION:
+            # One function serves every API route, so all routes share warm containers and one QLDB driver
+            lambda_router_role = aws_iam.Role(self, 'lambda-router-role',
+                                              assumed_by=aws_iam.ServicePrincipal(service='lambda'))
+            lambda_router_role.add_to_policy(qldb_access_policy)
+            lambda_router_role.add_to_policy(ddb_table_policy)
+            lambda_router_role.add_managed_policy(
+                aws_iam.ManagedPolicy.from_aws_managed_policy_name(managed_policy_name='AWSLambdaExecute'))
+
+            lambda_router = aws_lambda_python.PythonFunction(self, 'router-lambda', entry='lambda',
+                                                             handler='lambda_handler',
+                                                             index='lambda_router/lambda_function.py',
+                                                             runtime=aws_lambda.Runtime.PYTHON_3_8,
+                                                             role=lambda_router_role,
+                                                             log_retention=LOG_RETENTION,
+                                                             memory_size=1024,
+                                                             timeout=cdk.Duration.seconds(60),
+                                                             tracing=aws_lambda.Tracing.ACTIVE,
+                                                             layers=[wallet_core_layer])
+            lambda_get_funds = lambda_withdraw_funds = lambda_add_funds = lambda_create_account = \
+                lambda_bulk_mutations = lambda_credit_funds = lambda_get_transactions = lambda_get_rollups = \
+                lambda_get_balance_at = lambda_router
+        else:
+            lambda_get_funds = aws_lambda_python.PythonFunction(self, 'get-funds-lambda',
+                                                                entry='lambda/lambda_get_funds',
+                                                                handler='lambda_handler',
+                                                                index='lambda_function.py',
+                                                                runtime=aws_lambda.Runtime.PYTHON_3_8,
+                                                                role=lambda_qldb_role,
+                                                                log_retention=LOG_RETENTION,
+                                                                memory_size=512,
+                                                                tracing=aws_lambda.Tracing.ACTIVE,
+                                                                layers=[wallet_core_layer])
 
-        lambda_get_transactions = aws_lambda_python.PythonFunction(self, 'get-transactions-lambda',
-                                                                   entry='lambda/lambda_get_transactions',
+            lambda_withdraw_funds = aws_lambda_python.PythonFunction(self, 'withdraw-funds-lambda',
+                                                                     entry='lambda/lambda_withdraw_funds',
+                                                                     handler='lambda_handler',
+                                                                     index='lambda_function.py',
+                                                                     runtime=aws_lambda.Runtime.PYTHON_3_8,
+                                                                     role=lambda_qldb_role,
+                                                                     log_retention=LOG_RETENTION,
+                                                                     memory_size=512,
+                                                                     tracing=aws_lambda.Tracing.ACTIVE,
+                                                                     layers=[wallet_core_layer])
+
+            lambda_add_funds = aws_lambda_python.PythonFunction(self, 'add-funds-lambda',
+                                                                entry='lambda/lambda_add_funds',
+                                                                handler='lambda_handler',
+                                                                index='lambda_function.py',
+                                                                runtime=aws_lambda.Runtime.PYTHON_3_8,
+                                                                role=lambda_qldb_role,
+                                                                log_retention=LOG_RETENTION,
+                                                                memory_size=512,
+                                                                tracing=aws_lambda.Tracing.ACTIVE,
+                                                                layers=[wallet_core_layer])
+
+            lambda_create_account = aws_lambda_python.PythonFunction(self, 'create-account-lambda',
+                                                                     entry='lambda/lambda_create_account',
+                                                                     handler='lambda_handler',
+                                                                     index='lambda_function.py',
+                                                                     runtime=aws_lambda.Runtime.PYTHON_3_8,
+                                                                     role=lambda_qldb_role,
+                                                                     log_retention=LOG_RETENTION,
+                                                                     memory_size=512,
+                                                                     timeout=cdk.Duration.seconds(60),
+                                                                     tracing=aws_lambda.Tracing.ACTIVE,
+                                                                     layers=[wallet_core_layer])
+
+            lambda_bulk_mutations = aws_lambda_python.PythonFunction(self, 'bulk-mutations-lambda',
+                                                                     entry='lambda/lambda_bulk_mutations',
+                                                                     handler='lambda_handler',
+                                                                     index='lambda_function.py',
+                                                                     runtime=aws_lambda.Runtime.PYTHON_3_8,
+                                                                     role=lambda_qldb_role,
+                                                                     log_retention=LOG_RETENTION,
+                                                                     memory_size=512,
+                                                                     timeout=cdk.Duration.seconds(60),
+                                                                     tracing=aws_lambda.Tracing.ACTIVE,
+                                                                     layers=[wallet_core_layer])
+
+            lambda_credit_funds = aws_lambda_python.PythonFunction(self, 'credit-funds-lambda',
+                                                                   entry='lambda/lambda_credit_funds',
                                                                    handler='lambda_handler',
                                                                    index='lambda_function.py',
                                                                    runtime=aws_lambda.Runtime.PYTHON_3_8,
-                                                                   role=lambda_ddb_role,
+                                                                   role=lambda_qldb_role,
                                                                    log_retention=LOG_RETENTION,
                                                                    memory_size=512,
-                                                                   tracing=aws_lambda.Tracing.ACTIVE)
+                                                                   tracing=aws_lambda.Tracing.ACTIVE,
+                                                                   layers=[wallet_core_layer])
+
+            lambda_get_transactions = aws_lambda_python.PythonFunction(self, 'get-transactions-lambda',
+                                                                       entry='lambda/lambda_get_transactions',
+                                                                       handler='lambda_handler',
+                                                                       index='lambda_function.py',
+                                                                       runtime=aws_lambda.Runtime.PYTHON_3_8,
+                                                                       role=lambda_ddb_role,
+                                                                       log_retention=LOG_RETENTION,
+                                                                       memory_size=512,
+                                                                       timeout=cdk.Duration.seconds(60),
+                                                                       tracing=aws_lambda.Tracing.ACTIVE,
+                                                                       layers=[wallet_core_layer])
+
+            lambda_get_rollups = aws_lambda_python.PythonFunction(self, 'get-rollups-lambda',
+                                                                  entry='lambda/lambda_get_rollups',
+                                                                  handler='lambda_handler',
+                                                                  index='lambda_function.py',
+                                                                  runtime=aws_lambda.Runtime.PYTHON_3_8,
+                                                                  role=lambda_ddb_role,
+                                                                  log_retention=LOG_RETENTION,
+                                                                  memory_size=512,
+                                                                  tracing=aws_lambda.Tracing.ACTIVE,
+                                                                  layers=[wallet_core_layer])
+
+            lambda_get_balance_at = aws_lambda_python.PythonFunction(self, 'get-balance-at-lambda',
+                                                                     entry='lambda/lambda_get_balance_at',
+                                                                     handler='lambda_handler',
+                                                                     index='lambda_function.py',
+                                                                     runtime=aws_lambda.Runtime.PYTHON_3_8,
+                                                                     role=lambda_ddb_role,
+                                                                     log_retention=LOG_RETENTION,
+                                                                     memory_size=512,
+                                                                     tracing=aws_lambda.Tracing.ACTIVE,
+                                                                     layers=[wallet_core_layer])
+
+        lambda_settle_credits = aws_lambda_python.PythonFunction(self, 'settle-credits-lambda',
+                                                                 entry='lambda/lambda_settle_credits',
+                                                                 handler='lambda_handler',
+                                                                 index='lambda_function.py',
+                                                                 runtime=aws_lambda.Runtime.PYTHON_3_8,
+                                                                 role=lambda_qldb_role,
+                                                                 log_retention=LOG_RETENTION,
+                                                                 memory_size=512,
+                                                                 timeout=cdk.Duration.seconds(60),
+                                                                 tracing=aws_lambda.Tracing.ACTIVE,
+                                                                 layers=[wallet_core_layer])
 
         lambda_stream_transactions = aws_lambda_python.PythonFunction(self, 'stream-transactions-lambda',
                                                                       entry='lambda/lambda_stream_transactions',
@@ -148,62 +279,243 @@ class ServerlessWallet(cdk.Stack):
                                                                       memory_size=512,
                                                                       tracing=aws_lambda.Tracing.ACTIVE)
 
-        # Associate the Kinesis stream to lambda_stream_transactions as an event source
-        event_source = lambda_event_sources.KinesisEventSource(kinesis_stream,
-                                                               starting_position=aws_lambda.StartingPosition.TRIM_HORIZON,
-                                                               enabled=True, bisect_batch_on_error=True)
-        lambda_stream_transactions.add_event_source(event_source)
+        # Dead-letter queue for records that cannot be converted or keep failing to be written
+        stream_dlq = aws_sqs.Queue(self, 'stream-transactions-dlq', queue_name=f"stream-transactions-dlq-{LEDGER_NAME}",
+                                   retention_period=cdk.Duration.days(14))
+        stream_dlq.grant_send_messages(lambda_stream_transactions)
+
+        # Associate the Kinesis stream to lambda_stream_transactions as an event source.
+        # The function reports the first failed sequence number, so only records from there onward are retried.
+        # With a parallelization factor above 1, records sharing a partition key, i.e. revisions of the same
+        # document, are still processed in order.
+        if STREAM_ENHANCED_FAN_OUT:
+            # Enhanced fan-out gives the function a dedicated read throughput of 2 MB/s per shard, pushed over HTTP/2
+            stream_consumer = aws_kinesis.CfnStreamConsumer(self, 'stream-transactions-consumer',
+                                                            consumer_name=f"stream-transactions-{LEDGER_NAME}",
+                                                            stream_arn=kinesis_stream.stream_arn)
+            kinesis_stream.grant_read(lambda_stream_transactions)
+            lambda_stream_transactions.add_to_role_policy(aws_iam.PolicyStatement(
+                actions=['kinesis:SubscribeToShard', 'kinesis:DescribeStreamConsumer'],
+                effect=aws_iam.Effect.ALLOW, resources=[stream_consumer.attr_consumer_arn]))
+            stream_event_source_mapping = aws_lambda.EventSourceMapping(
+                self, 'stream-transactions-efo-mapping', target=lambda_stream_transactions,
+                event_source_arn=stream_consumer.attr_consumer_arn,
+                starting_position=aws_lambda.StartingPosition.TRIM_HORIZON,
+                batch_size=STREAM_BATCH_SIZE,
+                max_batching_window=cdk.Duration.seconds(STREAM_BATCHING_WINDOW_SECONDS),
+                parallelization_factor=STREAM_PARALLELIZATION_FACTOR,
+                bisect_batch_on_error=False, report_batch_item_failures=True,
+                retry_attempts=STREAM_RETRY_ATTEMPTS,
+                on_failure=lambda_event_sources.SqsDlq(stream_dlq))
+            stream_event_source_mapping.node.add_dependency(lambda_stream_transactions.role)
+        else:
+            event_source = lambda_event_sources.KinesisEventSource(
+                kinesis_stream, starting_position=aws_lambda.StartingPosition.TRIM_HORIZON,
+                enabled=True, batch_size=STREAM_BATCH_SIZE,
+                max_batching_window=cdk.Duration.seconds(STREAM_BATCHING_WINDOW_SECONDS),
+                parallelization_factor=STREAM_PARALLELIZATION_FACTOR,
+                bisect_batch_on_error=False, report_batch_item_failures=True,
+                retry_attempts=STREAM_RETRY_ATTEMPTS,
+                on_failure=lambda_event_sources.SqsDlq(stream_dlq))
+            lambda_stream_transactions.add_event_source(event_source)
+
+        # Queue of accepted credits, settled in batches grouped by account by lambda_settle_credits.
+        # The visibility timeout covers six times the function timeout, as recommended for SQS event sources.
+        credits_dlq = aws_sqs.Queue(self, 'credits-dlq', queue_name=f"wallet-credits-dlq-{LEDGER_NAME}",
+                                    retention_period=cdk.Duration.days(14))
+        credits_queue = aws_sqs.Queue(self, 'credits-queue', queue_name=f"wallet-credits-{LEDGER_NAME}",
+                                      visibility_timeout=cdk.Duration.seconds(360),
+                                      dead_letter_queue=aws_sqs.DeadLetterQueue(max_receive_count=5,
+                                                                                queue=credits_dlq))
+        credits_table = aws_dynamodb.Table(self, 'ddb-credits-table', table_name=f"wallet-credits-{LEDGER_NAME}",
+                                           partition_key=aws_dynamodb.Attribute(name='creditId',
+                                                                                type=aws_dynamodb.AttributeType.STRING),
+                                           billing_mode=aws_dynamodb.BillingMode.PAY_PER_REQUEST,
+                                           removal_policy=cdk.RemovalPolicy.DESTROY)
+        credits_queue.grant_send_messages(lambda_credit_funds)
+        credits_table.grant_read_write_data(lambda_credit_funds)
+        credits_table.grant_read_write_data(lambda_settle_credits)
+
+        credit_event_source = lambda_event_sources.SqsEventSource(
+            credits_queue, batch_size=CREDIT_BATCH_SIZE,
+            max_batching_window=cdk.Duration.seconds(CREDIT_BATCHING_WINDOW_SECONDS),
+            report_batch_item_failures=True)
+        lambda_settle_credits.add_event_source(credit_event_source)
 
         # Add environment variables to Lambda functions
         for lmbd in [lambda_create_account, lambda_get_funds, lambda_withdraw_funds, lambda_add_funds,
-                     lambda_get_transactions]:
+                     lambda_bulk_mutations, lambda_credit_funds, lambda_settle_credits, lambda_get_transactions,
+                     lambda_get_rollups, lambda_get_balance_at]:
             lmbd.add_environment(key='LEDGER_NAME', value=LEDGER_NAME)
             lmbd.add_environment(key='QLDB_TABLE_NAME', value=QLDB_TABLE_NAME)
             lmbd.add_environment(key='LOG_LEVEL', value=LOG_LEVEL)
+            lmbd.add_environment(key='QLDB_RETRY_LIMIT', value=str(QLDB_RETRY_LIMIT))
+            lmbd.add_environment(key='QLDB_RETRY_BASE_MS', value=str(QLDB_RETRY_BASE_MS))
+            lmbd.add_environment(key='QLDB_RETRY_MAX_MS', value=str(QLDB_RETRY_MAX_MS))
+
+        lambda_credit_funds.add_environment(key='CREDIT_QUEUE_URL', value=credits_queue.queue_url)
+        for lmbd in [lambda_credit_funds, lambda_settle_credits]:
+            lmbd.add_environment(key='CREDITS_TABLE_NAME', value=credits_table.table_name)
+            lmbd.add_environment(key='QLDB_CREDITS_TABLE_NAME', value=QLDB_CREDITS_TABLE_NAME)
+
+        for lmbd in [lambda_get_transactions, lambda_get_balance_at]:
+            lmbd.add_environment(key='DDB_TABLE_NAME', value=f"wallet-transactions-{LEDGER_NAME}")
 
-        lambda_get_transactions.add_environment(key='DDB_TABLE_NAME', value=f"wallet-transactions-{LEDGER_NAME}")
+        # Bucket receiving NDJSON history exports
+        export_bucket = aws_s3.Bucket(self, 'wallet-exports-bucket',
+                                      block_public_access=aws_s3.BlockPublicAccess.BLOCK_ALL,
+                                      encryption=aws_s3.BucketEncryption.S3_MANAGED,
+                                      removal_policy=cdk.RemovalPolicy.DESTROY)
+        export_bucket.grant_read_write(lambda_get_transactions)
+        lambda_get_transactions.add_environment(key='EXPORT_BUCKET', value=export_bucket.bucket_name)
 
         lambda_stream_transactions.add_environment(key='DDB_TABLE_NAME', value=f"wallet-transactions-{LEDGER_NAME}")
         lambda_stream_transactions.add_environment(key='QLDB_TABLE_NAME', value=QLDB_TABLE_NAME)
         lambda_stream_transactions.add_environment(key='LOG_LEVEL', value=LOG_LEVEL)
+        lambda_stream_transactions.add_environment(key='DLQ_URL', value=stream_dlq.queue_url)
+        lambda_stream_transactions.add_environment(key='WRITE_CONCURRENCY', value=str(STREAM_WRITE_CONCURRENCY))
+        lambda_stream_transactions.add_environment(key='BALANCES_TABLE_NAME', value=balances_table.table_name)
+        balances_table.grant_write_data(lambda_stream_transactions)
+
+        for lmbd in [lambda_stream_transactions, lambda_get_rollups]:
+            lmbd.add_environment(key='ROLLUPS_TABLE_NAME', value=rollups_table.table_name)
+        rollups_table.grant_read_write_data(lambda_stream_transactions)
+        rollups_table.grant_read_data(lambda_get_rollups)
+
+        lambda_get_funds.add_environment(key='BALANCES_TABLE_NAME', value=balances_table.table_name)
+        balances_table.grant_read_data(lambda_get_funds)
 
         if TTL_ATTRIBUTE and EXPIRE_AFTER_DAYS:
             lambda_stream_transactions.add_environment(key='TTL_ATTRIBUTE', value=TTL_ATTRIBUTE)
             lambda_stream_transactions.add_environment(key='EXPIRE_AFTER_DAYS', value=str(EXPIRE_AFTER_DAYS))
 
+        if ARCHIVE_HISTORY and TTL_ATTRIBUTE and EXPIRE_AFTER_DAYS:
+            # Compressed columnar archive of the history, written daily before the TTL deletes the items.
+            # Archive files move to infrequent access storage once they are no longer recent.
+            archive_bucket = aws_s3.Bucket(self, 'wallet-archive-bucket',
+                                           block_public_access=aws_s3.BlockPublicAccess.BLOCK_ALL,
+                                           encryption=aws_s3.BucketEncryption.S3_MANAGED,
+                                           removal_policy=cdk.RemovalPolicy.RETAIN,
+                                           lifecycle_rules=[aws_s3.LifecycleRule(
+                                               prefix='archive/', transitions=[aws_s3.Transition(
+                                                   storage_class=aws_s3.StorageClass.INFREQUENT_ACCESS,
+                                                   transition_after=cdk.Duration.days(30))])])
+
+            lambda_archive_transactions = aws_lambda_python.PythonFunction(self, 'archive-transactions-lambda',
+                                                                           entry='lambda/lambda_archive_transactions',
+                                                                           handler='lambda_handler',
+                                                                           index='lambda_function.py',
+                                                                           runtime=aws_lambda.Runtime.PYTHON_3_8,
+                                                                           log_retention=LOG_RETENTION,
+                                                                           memory_size=1024,
+                                                                           timeout=cdk.Duration.minutes(15),
+                                                                           tracing=aws_lambda.Tracing.ACTIVE,
+                                                                           layers=[wallet_core_layer])
+            # Keys of the items of each day in shards of accounts, so an archive run queries the days it archives
+            # instead of scanning the table. Only the stream consumer of an archived history sets txDayShard.
+            ddb_table.add_global_secondary_index(index_name='tx-day-index',
+                                                 partition_key=aws_dynamodb.Attribute(
+                                                     name='txDayShard', type=aws_dynamodb.AttributeType.STRING),
+                                                 sort_key=aws_dynamodb.Attribute(
+                                                     name='txTime', type=aws_dynamodb.AttributeType.STRING),
+                                                 projection_type=aws_dynamodb.ProjectionType.KEYS_ONLY)
+            lambda_stream_transactions.add_environment(key='DAY_INDEX_ATTRIBUTE', value='txDayShard')
+            # Archive files holding the items of each account, one item per account and file
+            archive_index_table = aws_dynamodb.Table(self, 'ddb-archive-index-table',
+                                                     table_name=f"wallet-archive-index-{LEDGER_NAME}",
+                                                     partition_key=aws_dynamodb.Attribute(
+                                                         name='accountId', type=aws_dynamodb.AttributeType.STRING),
+                                                     sort_key=aws_dynamodb.Attribute(
+                                                         name='file', type=aws_dynamodb.AttributeType.STRING),
+                                                     billing_mode=aws_dynamodb.BillingMode.PAY_PER_REQUEST,
+                                                     removal_policy=cdk.RemovalPolicy.RETAIN)
+            ddb_table.grant_read_data(lambda_archive_transactions)
+            archive_bucket.grant_read_write(lambda_archive_transactions)
+            archive_index_table.grant_read_write_data(lambda_archive_transactions)
+            for lmbd in [lambda_get_transactions, lambda_get_balance_at]:
+                archive_bucket.grant_read(lmbd)
+                archive_index_table.grant_read_data(lmbd)
+            lambda_archive_transactions.add_environment(key='DDB_TABLE_NAME',
+                                                        value=f"wallet-transactions-{LEDGER_NAME}")
+            lambda_archive_transactions.add_environment(key='LOG_LEVEL', value=LOG_LEVEL)
+            lambda_archive_transactions.add_environment(key='EXPIRE_AFTER_DAYS', value=str(EXPIRE_AFTER_DAYS))
+            lambda_archive_transactions.add_environment(key='ARCHIVE_LEAD_DAYS', value=str(ARCHIVE_LEAD_DAYS))
+            for lmbd in [lambda_archive_transactions, lambda_get_transactions, lambda_get_balance_at]:
+                lmbd.add_environment(key='ARCHIVE_BUCKET', value=archive_bucket.bucket_name)
+                lmbd.add_environment(key='ARCHIVE_INDEX_TABLE_NAME', value=archive_index_table.table_name)
+                lmbd.add_environment(key='ARCHIVE_PARTITIONS', value=str(ARCHIVE_PARTITIONS))
+
+            aws_events.Rule(self, 'archive-transactions-schedule',
+                            schedule=aws_events.Schedule.rate(cdk.Duration.days(1)),
+                            targets=[aws_events_targets.LambdaFunction(lambda_archive_transactions)])
+
         # Create APIs in API Gateway
-        get_funds_api = apigw.LambdaRestApi(self, 'get-funds-api', handler=lambda_get_funds,
-                                            endpoint_types=[apigw.EndpointType.REGIONAL],
-                                            default_method_options=apigw.MethodOptions(
-                                                authorization_type=apigw.AuthorizationType.IAM))
-        create_account_api = apigw.LambdaRestApi(self, 'create-account-api', handler=lambda_create_account,
-                                                 endpoint_types=[apigw.EndpointType.REGIONAL],
-                                                 default_method_options=apigw.MethodOptions(
-                                                     authorization_type=apigw.AuthorizationType.IAM))
-        withdraw_funds_api = apigw.LambdaRestApi(self, 'withdraw-funds-api', handler=lambda_withdraw_funds,
-                                                 endpoint_types=[apigw.EndpointType.REGIONAL],
-                                                 default_method_options=apigw.MethodOptions(
-                                                     authorization_type=apigw.AuthorizationType.IAM))
-        add_funds_api = apigw.LambdaRestApi(self, 'add-funds-api', handler=lambda_add_funds,
-                                            endpoint_types=[apigw.EndpointType.REGIONAL],
-                                            default_method_options=apigw.MethodOptions(
-                                                authorization_type=apigw.AuthorizationType.IAM))
-
-        get_transactions_api = apigw.LambdaRestApi(self, 'get-transactions-api', handler=lambda_get_transactions,
+        if SINGLE_ROUTER_FUNCTION:
+            # Binary media types let API Gateway decode the compressed bodies returned by getTransactions
+            wallet_api = apigw.RestApi(self, 'wallet-api', endpoint_types=[apigw.EndpointType.REGIONAL],
+                                       binary_media_types=['*/*'],
+                                       default_method_options=apigw.MethodOptions(
+                                           authorization_type=apigw.AuthorizationType.IAM))
+            router_integration = apigw.LambdaIntegration(lambda_router)
+            for route in ['getFunds', 'getTransactions', 'createAccount', 'withdrawFunds', 'addFunds',
+                          'bulkMutations', 'creditFunds', 'getRollups', 'getBalanceAt']:
+                wallet_api.root.add_resource(route).add_method('POST', router_integration)
+        else:
+            get_funds_api = apigw.LambdaRestApi(self, 'get-funds-api', handler=lambda_get_funds,
+                                                endpoint_types=[apigw.EndpointType.REGIONAL],
+                                                default_method_options=apigw.MethodOptions(
+                                                    authorization_type=apigw.AuthorizationType.IAM))
+            create_account_api = apigw.LambdaRestApi(self, 'create-account-api', handler=lambda_create_account,
+                                                     endpoint_types=[apigw.EndpointType.REGIONAL],
+                                                     default_method_options=apigw.MethodOptions(
+                                                         authorization_type=apigw.AuthorizationType.IAM))
+            withdraw_funds_api = apigw.LambdaRestApi(self, 'withdraw-funds-api', handler=lambda_withdraw_funds,
+                                                     endpoint_types=[apigw.EndpointType.REGIONAL],
+                                                     default_method_options=apigw.MethodOptions(
+                                                         authorization_type=apigw.AuthorizationType.IAM))
+            add_funds_api = apigw.LambdaRestApi(self, 'add-funds-api', handler=lambda_add_funds,
+                                                endpoint_types=[apigw.EndpointType.REGIONAL],
+                                                default_method_options=apigw.MethodOptions(
+                                                    authorization_type=apigw.AuthorizationType.IAM))
+            bulk_mutations_api = apigw.LambdaRestApi(self, 'bulk-mutations-api', handler=lambda_bulk_mutations,
+                                                     endpoint_types=[apigw.EndpointType.REGIONAL],
+                                                     default_method_options=apigw.MethodOptions(
+                                                         authorization_type=apigw.AuthorizationType.IAM))
+            credit_funds_api = apigw.LambdaRestApi(self, 'credit-funds-api', handler=lambda_credit_funds,
                                                    endpoint_types=[apigw.EndpointType.REGIONAL],
                                                    default_method_options=apigw.MethodOptions(
                                                        authorization_type=apigw.AuthorizationType.IAM))
 
+            get_transactions_api = apigw.LambdaRestApi(self, 'get-transactions-api', handler=lambda_get_transactions,
+                                                       endpoint_types=[apigw.EndpointType.REGIONAL],
+                                                       binary_media_types=['*/*'],
+                                                       default_method_options=apigw.MethodOptions(
+                                                           authorization_type=apigw.AuthorizationType.IAM))
+
+            get_rollups_api = apigw.LambdaRestApi(self, 'get-rollups-api', handler=lambda_get_rollups,
+                                                  endpoint_types=[apigw.EndpointType.REGIONAL],
+                                                  default_method_options=apigw.MethodOptions(
+                                                      authorization_type=apigw.AuthorizationType.IAM))
+            get_balance_at_api = apigw.LambdaRestApi(self, 'get-balance-at-api', handler=lambda_get_balance_at,
+                                                     endpoint_types=[apigw.EndpointType.REGIONAL],
+                                                     default_method_options=apigw.MethodOptions(
+                                                         authorization_type=apigw.AuthorizationType.IAM))
+
         output1 = f"Execute the following queries in QLDB query editor for ledger {LEDGER_NAME} before using:"
         output2 = f"CREATE TABLE \"{QLDB_TABLE_NAME}\""
         output3 = f"CREATE INDEX ON \"{QLDB_TABLE_NAME}\" (accountId)"
+        output4 = f"CREATE TABLE \"{QLDB_CREDITS_TABLE_NAME}\""
+        output5 = f"CREATE INDEX ON \"{QLDB_CREDITS_TABLE_NAME}\" (creditId)"
 
         cdk.CfnOutput(self, id='stack-output1', value=output1)
         cdk.CfnOutput(self, id='stack-output2', value=output2)
         cdk.CfnOutput(self, id='stack-output3', value=output3)
+        cdk.CfnOutput(self, id='stack-output4', value=output4)
+        cdk.CfnOutput(self, id='stack-output5', value=output5)
 
 
-app = cdk.App()
-ServerlessWallet(app, "serverless-wallet", env={'account': ACCOUNT, 'region': REGION})
+if __name__ == '__main__':
+    app = cdk.App()
+    ServerlessWallet(app, "serverless-wallet", env={'account': ACCOUNT, 'region': REGION})
 
-app.synth()
+    app.synth()